@@ -0,0 +1,74 @@
+import argparse
+import logging
+import time
+from typing import List
+
+from src.config import settings
+from src.etl import ETLBase
+from src.models import EntryName
+
+logger = logging.getLogger(__name__)
+
+
+def sample_ids(etl: ETLBase, entry_name: EntryName, count: int) -> List:
+    """
+    Случайные id персон или жанров, у которых есть фильмы
+    """
+    query = f'''
+        SELECT DISTINCT {entry_name.value}_id as id
+        FROM content.{etl.fw_m2m_tables[entry_name]}
+        ORDER BY random()
+        LIMIT %s;
+    '''
+
+    return [row['id'] for row in etl.db_handler.execute_query(query, (count,))]
+
+
+def measure(etl: ETLBase, entry_name: EntryName, ids: List, staging: bool, repeats: int) -> float:
+    """
+    Лучшее время полного обхода enricher по набору id
+    """
+    staging_min_ids = settings.staging_min_ids
+    settings.staging_min_ids = 0 if staging else len(ids) + 1
+
+    timings = []
+    try:
+        for _ in range(repeats):
+            started = time.monotonic()
+            for _fw_ids in etl.iter_modified_fw_ids(ids, entry_name):
+                pass
+            timings.append(time.monotonic() - started)
+    finally:
+        settings.staging_min_ids = staging_min_ids
+
+    return min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Сравнение списка IN и временной таблицы в enricher для разного числа id'
+    )
+    parser.add_argument('--entry', choices=['genre', 'person'], default='person')
+    parser.add_argument('--sizes', default='10,50,100,250,500,1000,2500,5000')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    entry_name = EntryName(args.entry)
+    etl = ETLBase(entry_name.value)
+    # обход всех фильмов, а не только изменившихся с последнего запуска
+    etl.get_last_updated_at = lambda _entry_name: settings.default_updated_at
+
+    switch_over = None
+    for size in map(int, args.sizes.split(',')):
+        ids = sample_ids(etl, entry_name, size)
+        in_list = measure(etl, entry_name, ids, staging=False, repeats=args.repeats)
+        staged = measure(etl, entry_name, ids, staging=True, repeats=args.repeats)
+
+        logger.info('%6s ids: IN list %.4f s, temp table %.4f s', len(ids), in_list, staged)
+        if switch_over is None and staged < in_list:
+            switch_over = len(ids)
+
+    if switch_over is None:
+        logger.info('IN list is faster for all sizes')
+    else:
+        logger.info('Temp table is faster from %s ids: set STAGING_MIN_IDS=%s', switch_over, switch_over)
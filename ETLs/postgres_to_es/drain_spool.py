@@ -0,0 +1,35 @@
+import logging
+import time
+
+import requests
+
+from src.config import settings
+from src.es import BulkRejectedError, ESHandler
+from src.spool import Spool, SpoolDrainer
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    logger.info('Spool drainer started.')
+    drainer = SpoolDrainer(
+        Spool(settings.spool_dir, settings.spool_segment_max_bytes),
+        ESHandler()
+    )
+
+    while True:
+        try:
+            drained = drainer.drain()
+        except requests.exceptions.RequestException as exc:
+            # ES недоступен: записи останутся в журнале до следующей попытки
+            logger.warning('ES is unavailable, retry later: %s', exc)
+            drained = 0
+        except BulkRejectedError as exc:
+            # записи не подтверждены, позиция журнала стоит на первой из них
+            logger.warning('ES rejected spooled batch, retry later: %s', exc)
+            drained = 0
+
+        if drained:
+            logger.info('Drained %s spooled batches', drained)
+        else:
+            time.sleep(settings.spool_drain_interval)
@@ -0,0 +1,29 @@
+import argparse
+import logging
+
+from src.advisor import IndexAdvisor
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Проверка индексов и планов запросов ETL'
+    )
+    parser.add_argument(
+        '--create', action='store_true',
+        help='создать недостающие индексы (CREATE INDEX CONCURRENTLY)'
+    )
+    args = parser.parse_args()
+
+    advisor = IndexAdvisor()
+    problems = advisor.report()
+    for problem in problems:
+        logger.warning(problem)
+
+    if not problems:
+        logger.info('All ETL queries are covered by indexes.')
+
+    if args.create:
+        created = advisor.create_missing_indexes()
+        logger.info('Created %s indexes', len(created))
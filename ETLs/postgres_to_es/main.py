@@ -1,43 +1,103 @@
 import logging
 
-from src.etl import ETLBase
+from src.config import settings
+from src.etl import ETLBase, FanOutETL, PriorityETL, SearchDocETL
+from src.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 
-if __name__ == '__main__':
-    logger.info('ETL started.')
-    genre_etl = ETLBase('genre')
-    person_etl = ETLBase('person')
-    filmwork_etl = ETLBase('filmwork')
-
-    logger.info('ETL on genres changed started.')
-    genre_etl.producer(
-        genre_etl.enricher(
-            genre_etl.merger(
-                genre_etl.transformer(
-                    genre_etl.loader()
+def run_coroutines(etl: ETLBase):
+    if etl.entry_name == 'filmwork':
+        etl.producer(
+            etl.merger(
+                etl.transformer(
+                    etl.loader()
                 )
             )
         )
-    )
+        return
 
-    logger.info('ETL on persons changed started.')
-    person_etl.producer(
-        person_etl.enricher(
-            person_etl.merger(
-                person_etl.transformer(
-                    person_etl.loader()
+    etl.producer(
+        etl.enricher(
+            etl.merger(
+                etl.transformer(
+                    etl.loader()
                 )
             )
         )
     )
 
-    logger.info('ETL on filmworks changed started.')
-    filmwork_etl.producer(
-        filmwork_etl.merger(
-            filmwork_etl.transformer(
-                filmwork_etl.loader()
+
+def run_tombstones(etl: ETLBase):
+    if etl.entry_name == 'filmwork':
+        # удаления фильмов накапливаются и уходят в ES вместе с пачками индексации
+        etl.tombstones(None)
+        return
+
+    etl.tombstones(
+        etl.merger(
+            etl.transformer(
+                etl.loader()
             )
         )
     )
+
+
+if __name__ == '__main__':
+    logger.info('ETL started.')
+    genre_etl = ETLBase('genre')
+    person_etl = ETLBase('person')
+    filmwork_etl = ETLBase('filmwork')
+
+    if settings.search_doc_mode:
+        logger.info('ETL on search documents started.')
+        search_doc_etl = SearchDocETL()
+        # удаления фильмов уйдут в ES вместе с пачками документов
+        search_doc_etl.tombstones(None)
+        search_doc_etl.run()
+
+        if settings.genre_stats:
+            logger.info('ETL on genre stats started.')
+            search_doc_etl.sync_genre_stats()
+
+    elif settings.priority_lanes:
+        for etl in (genre_etl, person_etl):
+            logger.info('ETL on deleted %s started.', etl.entry_name)
+            run_tombstones(etl)
+
+        logger.info('ETL with priority lanes started.')
+        priority_etl = PriorityETL()
+        # удаления фильмов уйдут в ES вместе с пачками документов
+        priority_etl.tombstones(None)
+        priority_etl.run()
+
+    elif settings.fanout_mode:
+        for etl in (genre_etl, person_etl):
+            logger.info('ETL on deleted %s started.', etl.entry_name)
+            run_tombstones(etl)
+
+        logger.info('Fan-out ETL on all changes started.')
+        fanout_etl = FanOutETL()
+        # удаления фильмов уйдут в ES вместе с общими пачками
+        fanout_etl.tombstones(None)
+        fanout_etl.run()
+
+    else:
+        for etl in (genre_etl, person_etl, filmwork_etl):
+            logger.info('ETL on deleted %s started.', etl.entry_name)
+            run_tombstones(etl)
+
+            logger.info('ETL on %s changed started.', etl.entry_name)
+            if settings.pipeline_mode:
+                etl.run_pipeline()
+            else:
+                run_coroutines(etl)
+                etl.flush_deleted()
+
+        # FanOutETL и PriorityETL переносят статистику жанров сами
+        if settings.genre_stats:
+            logger.info('ETL on genre stats started.')
+            filmwork_etl.sync_genre_stats()
+
+    metrics.dump(force=True)
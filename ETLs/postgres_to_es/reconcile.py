@@ -0,0 +1,32 @@
+import argparse
+import logging
+
+from src.metrics import metrics
+from src.reconcile import Reconciler
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Сверка индекса фильмов с БД по контрольным суммам диапазонов id'
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='только найти расхождения, не исправляя индекс'
+    )
+    parser.add_argument(
+        '--prefix', default='',
+        help='сверить только id с этим шестнадцатеричным префиксом'
+    )
+    args = parser.parse_args()
+
+    Reconciler(dry_run=args.dry_run).reconcile(args.prefix.lower())
+
+    logger.info(
+        'Reconciliation finished: %s ranges checked, %s stale, %s orphaned documents',
+        int(metrics.get('reconcile_ranges_checked_total')),
+        int(metrics.get('reconcile_stale_total')),
+        int(metrics.get('reconcile_orphaned_total')),
+    )
+    metrics.dump(force=True)
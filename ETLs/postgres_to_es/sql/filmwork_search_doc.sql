@@ -0,0 +1,168 @@
+-- Готовые документы фильмов для индекса movies, которые поддерживаются на стороне БД.
+-- Триггеры только ставят id фильма в очередь, а сборку документов выполняет
+-- content.refresh_filmwork_search_docs (вызывается ETL или планировщиком).
+-- Версия документа - время сборки в микросекундах, она же внешняя версия в ES.
+
+CREATE TABLE IF NOT EXISTS content.filmwork_search_doc (
+    filmwork_id uuid PRIMARY KEY,
+    doc jsonb NOT NULL,
+    version bigint NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS filmwork_search_doc_version_idx
+    ON content.filmwork_search_doc (version, filmwork_id);
+
+CREATE TABLE IF NOT EXISTS content.filmwork_search_doc_queue (
+    filmwork_id uuid PRIMARY KEY,
+    queued_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+
+CREATE OR REPLACE FUNCTION content.build_filmwork_search_doc(fw_id uuid) RETURNS jsonb AS $$
+    SELECT jsonb_build_object(
+        'id', fw.id::text,
+        'title', fw.title,
+        'description', fw.description,
+        'imdb_rating', fw.rating,
+        'genre', COALESCE((
+            SELECT jsonb_agg(DISTINCT g.name)
+            FROM content.filmworks_genres fwg
+            JOIN content.genre g ON g.id = fwg.genre_id
+            WHERE fwg.filmwork_id = fw.id
+        ), '[]'),
+        'director', COALESCE((
+            SELECT jsonb_agg(DISTINCT p.first_name)
+            FROM content.filmworks_persons fwp
+            JOIN content.person p ON p.id = fwp.person_id
+            WHERE fwp.filmwork_id = fw.id AND fwp.role = 'DIRECTOR'
+        ), '[]'),
+        'actors', COALESCE((
+            SELECT jsonb_agg(DISTINCT jsonb_build_object('id', p.id::text, 'name', p.first_name))
+            FROM content.filmworks_persons fwp
+            JOIN content.person p ON p.id = fwp.person_id
+            WHERE fwp.filmwork_id = fw.id AND fwp.role = 'ACTOR'
+        ), '[]'),
+        'actors_names', COALESCE((
+            SELECT jsonb_agg(DISTINCT p.first_name)
+            FROM content.filmworks_persons fwp
+            JOIN content.person p ON p.id = fwp.person_id
+            WHERE fwp.filmwork_id = fw.id AND fwp.role = 'ACTOR'
+        ), '[]'),
+        'writers', COALESCE((
+            SELECT jsonb_agg(DISTINCT jsonb_build_object('id', p.id::text, 'name', p.first_name))
+            FROM content.filmworks_persons fwp
+            JOIN content.person p ON p.id = fwp.person_id
+            WHERE fwp.filmwork_id = fw.id AND fwp.role = 'WRITER'
+        ), '[]'),
+        'writers_names', COALESCE((
+            SELECT jsonb_agg(DISTINCT p.first_name)
+            FROM content.filmworks_persons fwp
+            JOIN content.person p ON p.id = fwp.person_id
+            WHERE fwp.filmwork_id = fw.id AND fwp.role = 'WRITER'
+        ), '[]'),
+        -- то же выражение, что DOC_CHECKSUM_SQL в src/etl.py: по нему reconcile.py сверяет индекс с БД
+        'etl_checksum', ('x' || left(md5(fw.id::text || ':' ||
+            (extract(epoch from fw.modified) * 1000000)::bigint::text), 8))::bit(32)::bigint
+    )
+    FROM content.filmwork fw
+    WHERE fw.id = fw_id;
+$$ LANGUAGE sql STABLE;
+
+
+-- Пересобирает документы из очереди, возвращает число обработанных фильмов.
+-- Advisory-лок до конца транзакции упорядочивает коммиты, поэтому версии
+-- становятся видимыми по возрастанию и ETL не пропустит изменения.
+CREATE OR REPLACE FUNCTION content.refresh_filmwork_search_docs(batch_size int DEFAULT 1000) RETURNS int AS $$
+DECLARE
+    ids uuid[];
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('content.refresh_filmwork_search_docs'));
+
+    SELECT array_agg(filmwork_id) INTO ids
+    FROM (
+        SELECT filmwork_id
+        FROM content.filmwork_search_doc_queue
+        ORDER BY queued_at
+        LIMIT batch_size
+    ) batch;
+
+    IF ids IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    DELETE FROM content.filmwork_search_doc_queue WHERE filmwork_id = ANY(ids);
+
+    INSERT INTO content.filmwork_search_doc (filmwork_id, doc, version)
+    SELECT fw.id,
+           content.build_filmwork_search_doc(fw.id),
+           (extract(epoch from clock_timestamp()) * 1000000)::bigint
+    FROM content.filmwork fw
+    WHERE fw.id = ANY(ids)
+    ON CONFLICT (filmwork_id) DO UPDATE
+        SET doc = EXCLUDED.doc, version = EXCLUDED.version;
+
+    RETURN array_length(ids, 1);
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION content.enqueue_filmwork_search_doc() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'filmwork' THEN
+        IF TG_OP = 'DELETE' THEN
+            DELETE FROM content.filmwork_search_doc WHERE filmwork_id = OLD.id;
+            RETURN OLD;
+        END IF;
+
+        INSERT INTO content.filmwork_search_doc_queue (filmwork_id)
+        VALUES (NEW.id)
+        ON CONFLICT DO NOTHING;
+
+    ELSIF TG_TABLE_NAME IN ('filmworks_persons', 'filmworks_genres') THEN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO content.filmwork_search_doc_queue (filmwork_id)
+            VALUES (OLD.filmwork_id)
+            ON CONFLICT DO NOTHING;
+        END IF;
+
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO content.filmwork_search_doc_queue (filmwork_id)
+            VALUES (NEW.filmwork_id)
+            ON CONFLICT DO NOTHING;
+        END IF;
+
+    ELSIF TG_TABLE_NAME = 'person' THEN
+        INSERT INTO content.filmwork_search_doc_queue (filmwork_id)
+        SELECT DISTINCT filmwork_id FROM content.filmworks_persons WHERE person_id = NEW.id
+        ON CONFLICT DO NOTHING;
+
+    ELSIF TG_TABLE_NAME = 'genre' THEN
+        INSERT INTO content.filmwork_search_doc_queue (filmwork_id)
+        SELECT DISTINCT filmwork_id FROM content.filmworks_genres WHERE genre_id = NEW.id
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS filmwork_search_doc ON content.filmwork;
+CREATE TRIGGER filmwork_search_doc AFTER INSERT OR UPDATE OR DELETE ON content.filmwork
+    FOR EACH ROW EXECUTE PROCEDURE content.enqueue_filmwork_search_doc();
+
+DROP TRIGGER IF EXISTS filmworks_persons_search_doc ON content.filmworks_persons;
+CREATE TRIGGER filmworks_persons_search_doc AFTER INSERT OR UPDATE OR DELETE ON content.filmworks_persons
+    FOR EACH ROW EXECUTE PROCEDURE content.enqueue_filmwork_search_doc();
+
+DROP TRIGGER IF EXISTS filmworks_genres_search_doc ON content.filmworks_genres;
+CREATE TRIGGER filmworks_genres_search_doc AFTER INSERT OR UPDATE OR DELETE ON content.filmworks_genres
+    FOR EACH ROW EXECUTE PROCEDURE content.enqueue_filmwork_search_doc();
+
+DROP TRIGGER IF EXISTS person_search_doc ON content.person;
+CREATE TRIGGER person_search_doc AFTER UPDATE ON content.person
+    FOR EACH ROW EXECUTE PROCEDURE content.enqueue_filmwork_search_doc();
+
+DROP TRIGGER IF EXISTS genre_search_doc ON content.genre;
+CREATE TRIGGER genre_search_doc AFTER UPDATE ON content.genre
+    FOR EACH ROW EXECUTE PROCEDURE content.enqueue_filmwork_search_doc();
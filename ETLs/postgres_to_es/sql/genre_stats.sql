@@ -0,0 +1,282 @@
+-- Статистика жанров для индекса genres: число фильмов, средний рейтинг,
+-- гистограмма рейтинга и лучшие фильмы. Триггеры только дописывают в журнал
+-- content.genre_stats_delta разницу от изменившегося фильма или связи: строки жанров
+-- в транзакциях приложения не блокируются, и запись в популярный жанр не выстраивается в очередь.
+-- ETL сворачивает журнал в content.genre_stats (content.fold_genre_stats) в своей транзакции,
+-- там же пересобирается список лучших фильмов жанра, из которого выбыл фильм.
+-- Строки, измененные сверткой, получают новую version, по ней ETL переносит их в индекс genres.
+
+CREATE TABLE IF NOT EXISTS content.genre_stats (
+    genre_id uuid PRIMARY KEY,
+    films_count int NOT NULL DEFAULT 0,
+    rated_count int NOT NULL DEFAULT 0,
+    rating_sum numeric NOT NULL DEFAULT 0,
+    -- число фильмов с рейтингом в [0, 1), [1, 2), ... [9, 10]
+    histogram int[] NOT NULL DEFAULT array_fill(0, ARRAY[10]),
+    top_films jsonb NOT NULL DEFAULT '[]',
+    version bigint NOT NULL DEFAULT 0
+);
+
+-- прежняя версия отмечала изменения временем modified, которое могло закоммититься позже курсора ETL
+ALTER TABLE content.genre_stats ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
+DROP INDEX IF EXISTS content.genre_stats_modified_idx;
+ALTER TABLE content.genre_stats DROP COLUMN IF EXISTS modified;
+
+CREATE INDEX IF NOT EXISTS genre_stats_version_idx ON content.genre_stats (version, genre_id);
+
+-- версии выдаются под advisory-локом свертки, поэтому становятся видимыми по возрастанию
+CREATE SEQUENCE IF NOT EXISTS content.genre_stats_version_seq;
+
+-- Вклад фильма в жанр: sign = 1 добавляет его в статистику, sign = -1 убирает
+CREATE TABLE IF NOT EXISTS content.genre_stats_delta (
+    seq bigserial PRIMARY KEY,
+    genre_id uuid NOT NULL,
+    filmwork_id uuid NOT NULL,
+    title text,
+    rating numeric,
+    sign int NOT NULL
+);
+
+
+-- Длина списка лучших фильмов жанра
+CREATE OR REPLACE FUNCTION content.genre_stats_top_n() RETURNS int AS $$
+    SELECT 10;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION content.genre_top_films(g_id uuid, exclude_id uuid DEFAULT NULL) RETURNS jsonb AS $$
+    SELECT COALESCE(
+        jsonb_agg(
+            jsonb_build_object('id', top.id::text, 'title', top.title, 'imdb_rating', top.rating)
+            ORDER BY top.rating DESC, top.id
+        ),
+        '[]'
+    )
+    FROM (
+        SELECT fw.id, fw.title, fw.rating
+        FROM content.filmworks_genres fwg
+        JOIN content.filmwork fw ON fw.id = fwg.filmwork_id
+        WHERE fwg.genre_id = g_id AND fw.rating IS NOT NULL AND fw.id IS DISTINCT FROM exclude_id
+        ORDER BY fw.rating DESC, fw.id
+        LIMIT content.genre_stats_top_n()
+    ) top;
+$$ LANGUAGE sql STABLE;
+
+
+-- прежняя версия функции вызывалась прямо из триггеров
+DROP FUNCTION IF EXISTS content.genre_stats_apply(uuid, uuid, text, numeric, int);
+
+-- Добавляет (sign = 1) или убирает (sign = -1) фильм из статистики жанра.
+-- Вызывается только сверткой журнала, которая держит advisory-лок, поэтому без FOR UPDATE
+CREATE OR REPLACE FUNCTION content.genre_stats_apply(
+    g_id uuid, fw_id uuid, fw_title text, fw_rating numeric, sign int, new_version bigint
+) RETURNS void AS $$
+DECLARE
+    -- фильм без рейтинга учитывается только в films_count
+    rated int := CASE WHEN fw_rating IS NULL THEN 0 ELSE sign END;
+    bucket int := least(greatest(floor(COALESCE(fw_rating, 0))::int, 0), 9) + 1;
+    top jsonb;
+BEGIN
+    -- жанр удаляется вместе со статистикой, связи уходят каскадом после него
+    PERFORM 1 FROM content.genre WHERE id = g_id;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO content.genre_stats (genre_id) VALUES (g_id) ON CONFLICT DO NOTHING;
+
+    SELECT top_films INTO top FROM content.genre_stats WHERE genre_id = g_id;
+
+    IF fw_rating IS NOT NULL THEN
+        IF sign < 0 AND top @> jsonb_build_array(jsonb_build_object('id', fw_id::text)) THEN
+            top := content.genre_top_films(g_id, fw_id);
+        ELSIF sign > 0 AND NOT top @> jsonb_build_array(jsonb_build_object('id', fw_id::text)) AND (
+            jsonb_array_length(top) < content.genre_stats_top_n()
+            OR fw_rating > (top -> -1 ->> 'imdb_rating')::numeric
+        ) THEN
+            SELECT jsonb_agg(e ORDER BY (e ->> 'imdb_rating')::numeric DESC, e ->> 'id') INTO top
+            FROM (
+                SELECT e
+                FROM jsonb_array_elements(top || jsonb_build_array(jsonb_build_object(
+                    'id', fw_id::text, 'title', fw_title, 'imdb_rating', fw_rating
+                ))) e
+                ORDER BY (e ->> 'imdb_rating')::numeric DESC, e ->> 'id'
+                LIMIT content.genre_stats_top_n()
+            ) merged;
+        END IF;
+    END IF;
+
+    UPDATE content.genre_stats SET
+        films_count = films_count + sign,
+        rated_count = rated_count + rated,
+        rating_sum = rating_sum + COALESCE(fw_rating, 0) * sign,
+        histogram[bucket] = histogram[bucket] + rated,
+        top_films = top,
+        version = new_version
+    WHERE genre_id = g_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Сворачивает до batch_size самых старых записей журнала, возвращает число свернутых.
+-- Незакоммиченные записи свертке не видны и останутся в журнале до следующего вызова
+CREATE OR REPLACE FUNCTION content.fold_genre_stats(batch_size int DEFAULT 1000) RETURNS int AS $$
+DECLARE
+    delta record;
+    new_version bigint;
+    folded int := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('content.fold_genre_stats'));
+    new_version := nextval('content.genre_stats_version_seq');
+
+    FOR delta IN
+        WITH batch AS (
+            DELETE FROM content.genre_stats_delta
+            WHERE seq IN (SELECT seq FROM content.genre_stats_delta ORDER BY seq LIMIT batch_size)
+            RETURNING *
+        )
+        SELECT * FROM batch ORDER BY seq
+    LOOP
+        PERFORM content.genre_stats_apply(
+            delta.genre_id, delta.filmwork_id, delta.title, delta.rating, delta.sign, new_version
+        );
+        folded := folded + 1;
+    END LOOP;
+
+    RETURN folded;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION content.genre_stats_filmworks_genres() RETURNS trigger AS $$
+DECLARE
+    fw content.filmwork%ROWTYPE;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        -- если фильм уже удален, его вклад убрал триггер на content.filmwork
+        SELECT * INTO fw FROM content.filmwork WHERE id = OLD.filmwork_id;
+        IF FOUND THEN
+            INSERT INTO content.genre_stats_delta (genre_id, filmwork_id, title, rating, sign)
+            VALUES (OLD.genre_id, fw.id, fw.title, fw.rating, -1);
+        END IF;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT * INTO fw FROM content.filmwork WHERE id = NEW.filmwork_id;
+        IF FOUND THEN
+            INSERT INTO content.genre_stats_delta (genre_id, filmwork_id, title, rating, sign)
+            VALUES (NEW.genre_id, fw.id, fw.title, fw.rating, 1);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION content.genre_stats_filmwork() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.genre_stats_delta (genre_id, filmwork_id, title, rating, sign)
+    SELECT genre_id, OLD.id, OLD.title, OLD.rating, -1
+    FROM content.filmworks_genres
+    WHERE filmwork_id = OLD.id;
+
+    IF TG_OP = 'UPDATE' THEN
+        INSERT INTO content.genre_stats_delta (genre_id, filmwork_id, title, rating, sign)
+        SELECT genre_id, NEW.id, NEW.title, NEW.rating, 1
+        FROM content.filmworks_genres
+        WHERE filmwork_id = NEW.id;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        RETURN OLD;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION content.genre_stats_genre() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM content.genre_stats WHERE genre_id = OLD.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Полный пересчет статистики: первоначальное заполнение или восстановление.
+-- Журнал очищается тем же оператором: в одном снимке пересчет учел ровно те изменения,
+-- записи которых удалены, а закоммиченные позже останутся для свертки
+CREATE OR REPLACE FUNCTION content.rebuild_genre_stats() RETURNS int AS $$
+DECLARE
+    rebuilt int;
+    new_version bigint;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('content.fold_genre_stats'));
+    new_version := nextval('content.genre_stats_version_seq');
+
+    WITH folded AS (
+        DELETE FROM content.genre_stats_delta
+    )
+    INSERT INTO content.genre_stats (genre_id, films_count, rated_count, rating_sum, histogram, top_films, version)
+    SELECT
+        g.id,
+        s.films_count,
+        s.rated_count,
+        s.rating_sum,
+        ARRAY(
+            SELECT count(fw.id)::int
+            FROM generate_series(0, 9) b
+            LEFT JOIN (
+                content.filmworks_genres fwg JOIN content.filmwork fw ON fw.id = fwg.filmwork_id
+            ) ON fwg.genre_id = g.id AND least(greatest(floor(fw.rating)::int, 0), 9) = b
+            GROUP BY b
+            ORDER BY b
+        ),
+        content.genre_top_films(g.id),
+        new_version
+    FROM content.genre g
+    CROSS JOIN LATERAL (
+        SELECT
+            count(*)::int as films_count,
+            count(fw.rating)::int as rated_count,
+            COALESCE(sum(fw.rating), 0) as rating_sum
+        FROM content.filmworks_genres fwg
+        JOIN content.filmwork fw ON fw.id = fwg.filmwork_id
+        WHERE fwg.genre_id = g.id
+    ) s
+    ON CONFLICT (genre_id) DO UPDATE SET
+        films_count = EXCLUDED.films_count,
+        rated_count = EXCLUDED.rated_count,
+        rating_sum = EXCLUDED.rating_sum,
+        histogram = EXCLUDED.histogram,
+        top_films = EXCLUDED.top_films,
+        version = EXCLUDED.version;
+
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+    RETURN rebuilt;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS filmworks_genres_genre_stats ON content.filmworks_genres;
+CREATE TRIGGER filmworks_genres_genre_stats AFTER INSERT OR UPDATE OR DELETE ON content.filmworks_genres
+    FOR EACH ROW EXECUTE PROCEDURE content.genre_stats_filmworks_genres();
+
+-- BEFORE DELETE: связи фильма еще на месте, и по ним видно, из каких жанров его убрать
+DROP TRIGGER IF EXISTS filmwork_genre_stats_delete ON content.filmwork;
+CREATE TRIGGER filmwork_genre_stats_delete BEFORE DELETE ON content.filmwork
+    FOR EACH ROW EXECUTE PROCEDURE content.genre_stats_filmwork();
+
+DROP TRIGGER IF EXISTS filmwork_genre_stats_update ON content.filmwork;
+CREATE TRIGGER filmwork_genre_stats_update AFTER UPDATE OF title, rating ON content.filmwork
+    FOR EACH ROW
+    WHEN (OLD.title IS DISTINCT FROM NEW.title OR OLD.rating IS DISTINCT FROM NEW.rating)
+    EXECUTE PROCEDURE content.genre_stats_filmwork();
+
+DROP TRIGGER IF EXISTS genre_genre_stats ON content.genre;
+CREATE TRIGGER genre_genre_stats AFTER DELETE ON content.genre
+    FOR EACH ROW EXECUTE PROCEDURE content.genre_stats_genre();
+
+SELECT content.rebuild_genre_stats();
@@ -0,0 +1,59 @@
+-- Журнал удаленных записей (tombstones) для переноса удалений в Elasticsearch.
+-- Для персон и жанров триггер запоминает фильмы, которые на них ссылались,
+-- т.к. к моменту обработки связи в filmworks_* уже будут удалены.
+
+CREATE TABLE IF NOT EXISTS content.tombstone (
+    seq bigserial PRIMARY KEY,
+    entity text NOT NULL,
+    entity_id uuid NOT NULL,
+    filmwork_ids uuid[] NOT NULL DEFAULT '{}',
+    deleted_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS tombstone_entity_seq_idx ON content.tombstone (entity, seq);
+
+
+CREATE OR REPLACE FUNCTION content.tombstone_filmwork() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.tombstone (entity, entity_id, filmwork_ids)
+    VALUES ('filmwork', OLD.id, ARRAY[OLD.id]);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION content.tombstone_person() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.tombstone (entity, entity_id, filmwork_ids)
+    VALUES (
+        'person',
+        OLD.id,
+        ARRAY(SELECT DISTINCT filmwork_id FROM content.filmworks_persons WHERE person_id = OLD.id)
+    );
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION content.tombstone_genre() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.tombstone (entity, entity_id, filmwork_ids)
+    VALUES (
+        'genre',
+        OLD.id,
+        ARRAY(SELECT DISTINCT filmwork_id FROM content.filmworks_genres WHERE genre_id = OLD.id)
+    );
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS filmwork_tombstone ON content.filmwork;
+CREATE TRIGGER filmwork_tombstone BEFORE DELETE ON content.filmwork
+    FOR EACH ROW EXECUTE PROCEDURE content.tombstone_filmwork();
+
+DROP TRIGGER IF EXISTS person_tombstone ON content.person;
+CREATE TRIGGER person_tombstone BEFORE DELETE ON content.person
+    FOR EACH ROW EXECUTE PROCEDURE content.tombstone_person();
+
+DROP TRIGGER IF EXISTS genre_tombstone ON content.genre;
+CREATE TRIGGER genre_tombstone BEFORE DELETE ON content.genre
+    FOR EACH ROW EXECUTE PROCEDURE content.tombstone_genre();
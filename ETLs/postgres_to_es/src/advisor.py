@@ -0,0 +1,233 @@
+import datetime as dt
+import importlib.util
+import json
+import logging
+import uuid
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .config import settings
+from .db import DBHanlder
+from .etl import ETLBase
+from .models import EntryName
+
+logger = logging.getLogger(__name__)
+
+
+class RequiredIndex(NamedTuple):
+    schema: str
+    table: str
+    columns: Tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        return f'{self.table}_{"_".join(self.columns)}_etl_idx'
+
+    def create_sql(self) -> str:
+        return (
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.name} '
+            f'ON {self.schema}.{self.table} ({", ".join(self.columns)});'
+        )
+
+
+# Индексы, на которые опираются запросы ETL: выборка изменений по modified/updated_at
+# с keyset-пагинацией по id и поиск фильмов по персоне или жанру
+REQUIRED_INDEXES = [
+    RequiredIndex('content', 'filmwork', ('modified',)),
+    RequiredIndex('content', 'filmwork', ('modified', 'id')),
+    RequiredIndex('content', 'person', ('modified',)),
+    RequiredIndex('content', 'genre', ('modified',)),
+    RequiredIndex('content', 'filmworks_persons', ('filmwork_id',)),
+    RequiredIndex('content', 'filmworks_persons', ('person_id',)),
+    RequiredIndex('content', 'filmworks_genres', ('filmwork_id',)),
+    RequiredIndex('content', 'filmworks_genres', ('genre_id',)),
+    RequiredIndex('cinema', 'genre', ('updated_at', 'id')),
+    RequiredIndex('cinema', 'person', ('updated_at', 'id')),
+    RequiredIndex('cinema', 'film_work', ('updated_at',)),
+    RequiredIndex('cinema', 'person_film_work', ('person_id',)),
+    RequiredIndex('cinema', 'person_film_work', ('film_work_id',)),
+]
+
+# Узлы плана, о которых сообщает советник
+REPORTED_NODES = ('Seq Scan', 'Sort')
+
+# Таблицы, которые ETL намеренно читает целиком (справочник жанров в resolve_genres):
+# Seq Scan по ним без условия - не находка
+FULL_READ_RELATIONS = ('genre',)
+
+# Запросы ETL схемы cinema (postgres_to_es_refactored/etls/queries.py): выборка окна изменений
+# и extract. Модуль без зависимостей, его загружаем по пути, чтобы не копировать запросы
+CINEMA_QUERIES_PATH = Path(__file__).resolve().parents[2] / 'postgres_to_es_refactored' / 'etls' / 'queries.py'
+
+
+def load_cinema_queries() -> Optional[ModuleType]:
+    if not CINEMA_QUERIES_PATH.exists():
+        logger.warning('Cinema ETL queries not found at %s, skipping them', CINEMA_QUERIES_PATH)
+        return None
+
+    spec = importlib.util.spec_from_file_location('cinema_etl_queries', CINEMA_QUERIES_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+class ExplainingDBHandler(DBHanlder):
+    """
+    Вместо выполнения запроса ETL сохраняет его план (EXPLAIN) и возвращает пустой результат.
+    Так проверяются ровно те запросы, которые строит ETL.
+    """
+
+    def __init__(self, dsn: dict = None):
+        super().__init__(dsn)
+        self.plans: List[Tuple[str, dict]] = []
+
+    def execute_query(self, query: str, params: tuple) -> list:
+        self.cur.execute(f'EXPLAIN (FORMAT JSON) {query}', params)
+        plan = self.cur.fetchone()['QUERY PLAN']
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        self.plans.append((' '.join(query.split()), plan[0]['Plan']))
+
+        return []
+
+    def current_wal_lsn(self) -> int:
+        return 0
+
+    def wait_for_replay(self, lsn: int, timeout: float) -> bool:
+        return True
+
+
+def iter_plan_nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from iter_plan_nodes(child)
+
+
+class IndexAdvisor:
+    def __init__(self, dsn: dict = None):
+        self.db_handler = DBHanlder(dsn)
+        self.dsn = dsn
+
+    def existing_indexes(self) -> Dict[Tuple[str, str], List[Tuple[str, ...]]]:
+        """
+        Колонки всех индексов по (схема, таблица) в порядке следования в индексе.
+        INVALID индексы после неудачного CREATE INDEX CONCURRENTLY запросам не помогают и не учитываются
+        """
+        query = '''
+            SELECT ns.nspname as schema, t.relname as table, array_agg(a.attname ORDER BY k.n) as columns
+            FROM pg_index i
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_namespace ns ON ns.oid = t.relnamespace
+            CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+            JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+            WHERE ns.nspname IN %s AND i.indisvalid
+            GROUP BY i.indexrelid, ns.nspname, t.relname;
+        '''
+        schemas = tuple({index.schema for index in REQUIRED_INDEXES})
+        indexes = {}
+        for row in self.db_handler.execute_query(query, (schemas,)):
+            indexes.setdefault((row['schema'], row['table']), []).append(tuple(row['columns']))
+
+        return indexes
+
+    def existing_tables(self) -> set:
+        query = '''
+            SELECT table_schema, table_name
+            FROM information_schema.tables
+            WHERE table_schema IN %s;
+        '''
+        schemas = tuple({index.schema for index in REQUIRED_INDEXES})
+
+        return {
+            (row['table_schema'], row['table_name'])
+            for row in self.db_handler.execute_query(query, (schemas,))
+        }
+
+    def missing_indexes(self) -> List[RequiredIndex]:
+        """
+        Требуемые индексы, которые не покрыты префиксом ни одного существующего индекса
+        """
+        tables = self.existing_tables()
+        indexes = self.existing_indexes()
+
+        return [
+            required for required in REQUIRED_INDEXES
+            if (required.schema, required.table) in tables
+            and not any(
+                columns[:len(required.columns)] == required.columns
+                for columns in indexes.get((required.schema, required.table), [])
+            )
+        ]
+
+    def explain_etl_queries(self) -> List[Tuple[str, dict]]:
+        """
+        Прогоняет запросы ETL обеих схем через EXPLAIN с типичными параметрами
+        """
+        explainer = ExplainingDBHandler(self.dsn)
+        sample_ids = [uuid.uuid4()]
+        since = dt.datetime.now() - dt.timedelta(days=1)
+        tables = self.existing_tables()
+
+        for entry_name in EntryName:
+            etl = ETLBase(entry_name.value)
+            etl._local.db_handler = explainer
+            etl._local.replica_db_handler = explainer
+            etl.get_last_updated_at = lambda _entry_name: since
+
+            etl.fetch_modified(since)
+            etl.tombstones(None)
+            if entry_name != EntryName.filmwork:
+                list(etl.iter_modified_fw_ids(sample_ids))
+
+        etl.fetch_filmwork_rows(sample_ids)
+        etl.resolve_persons(sample_ids)
+        etl.resolve_genres(sample_ids)
+
+        cinema_queries = load_cinema_queries() if ('cinema', 'genre') in tables else None
+        if cinema_queries:
+            # продолжение окна после загруженной пачки, как у большинства страниц
+            for query in cinema_queries.WINDOW_QUERIES:
+                explainer.execute_query(
+                    query, (since, dt.datetime.now(), str(uuid.UUID(int=0)), 1, 0, settings.data_sql_limit)
+                )
+            for query in cinema_queries.EXTRACT_QUERIES:
+                explainer.execute_query(query, (tuple(sample_ids),) * query.count('%s'))
+
+        return explainer.plans
+
+    def report(self) -> List[str]:
+        problems = []
+
+        for required in self.missing_indexes():
+            problems.append(
+                f'Missing index on {required.schema}.{required.table} ({", ".join(required.columns)})'
+            )
+
+        for query, plan in self.explain_etl_queries():
+            for node in iter_plan_nodes(plan):
+                full_read = node.get('Relation Name') in FULL_READ_RELATIONS and 'Filter' not in node
+                if node['Node Type'] in REPORTED_NODES and not full_read:
+                    relation = node.get('Relation Name') or ', '.join(node.get('Sort Key', []))
+                    problems.append(f'{node["Node Type"]} on {relation}: {query}')
+
+        return problems
+
+    def create_missing_indexes(self) -> List[RequiredIndex]:
+        """
+        Создает недостающие индексы без блокировки записи (CONCURRENTLY вне транзакции)
+        """
+        missing = self.missing_indexes()
+        conn = self.db_handler._get_conn()
+        conn.autocommit = True
+
+        with conn.cursor() as cur:
+            for required in missing:
+                logger.info('Creating index %s', required.name)
+                cur.execute(required.create_sql())
+
+        conn.close()
+
+        return missing
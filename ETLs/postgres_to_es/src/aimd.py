@@ -0,0 +1,104 @@
+import logging
+import threading
+
+from .config import settings
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AIMDController:
+    """
+    Подбирает число параллельных bulk-запросов и размер пачки под реальную емкость ES.
+    Пока время ответа (took) и доля ошибок в норме, параметры растут на единицу/шаг,
+    при отказах (429) или всплеске задержки уменьшаются в decrease_factor раз.
+    """
+
+    def __init__(
+        self,
+        min_concurrency: int = 1,
+        max_concurrency: int = 8,
+        min_batch_size: int = 10,
+        max_batch_size: int = 5000,
+        batch_size_step: int = 50,
+        decrease_factor: float = 0.5,
+        target_took_ms: int = 1000,
+        max_error_rate: float = 0.01,
+        initial_batch_size: int = 100,
+    ):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_size_step = batch_size_step
+        self.decrease_factor = decrease_factor
+        self.target_took_ms = target_took_ms
+        self.max_error_rate = max_error_rate
+
+        self.concurrency = min_concurrency
+        self.batch_size = max(min_batch_size, min(initial_batch_size, max_batch_size))
+        self._lock = threading.Lock()
+
+        self._publish()
+
+    def _publish(self):
+        metrics.set('es_bulk_concurrency', self.concurrency)
+        metrics.set('es_bulk_batch_size', self.batch_size)
+
+    def _increase(self):
+        self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+        self.batch_size = min(self.batch_size + self.batch_size_step, self.max_batch_size)
+        metrics.inc('es_bulk_increases_total')
+
+    def _decrease(self, reason: str):
+        self.concurrency = max(int(self.concurrency * self.decrease_factor), self.min_concurrency)
+        self.batch_size = max(int(self.batch_size * self.decrease_factor), self.min_batch_size)
+        metrics.inc('es_bulk_decreases_total')
+        logger.info(
+            'ES is overloaded (%s): concurrency %s, batch size %s',
+            reason, self.concurrency, self.batch_size
+        )
+
+    def observe(self, took_ms: int, items: int, rejected: int, errors: int):
+        """
+        Учитывает результат одного bulk-запроса
+        """
+        metrics.set('es_bulk_took_ms', took_ms)
+        metrics.inc('es_bulk_requests_total')
+        metrics.inc('es_bulk_rejected_total', rejected)
+
+        with self._lock:
+            if rejected:
+                self._decrease('rejected')
+            elif took_ms > self.target_took_ms:
+                self._decrease('latency')
+            elif items and errors / items > self.max_error_rate:
+                self._decrease('errors')
+            else:
+                self._increase()
+
+            self._publish()
+
+    def on_overload(self):
+        """
+        Весь запрос отклонен (HTTP 429)
+        """
+        metrics.inc('es_bulk_rejected_requests_total')
+
+        with self._lock:
+            self._decrease('rejected request')
+            self._publish()
+
+
+def build_controller() -> AIMDController:
+    return AIMDController(
+        min_concurrency=settings.es_min_concurrency,
+        max_concurrency=settings.es_max_concurrency,
+        min_batch_size=settings.es_min_batch_size,
+        max_batch_size=settings.es_max_batch_size,
+        batch_size_step=settings.es_batch_size_step,
+        decrease_factor=settings.es_decrease_factor,
+        target_took_ms=settings.es_target_took_ms,
+        max_error_rate=settings.es_max_error_rate,
+        initial_batch_size=settings.data_sql_limit,
+    )
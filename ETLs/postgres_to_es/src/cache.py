@@ -0,0 +1,71 @@
+import datetime as dt
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .config import settings
+
+
+class DimensionCache:
+    """
+    Кеш справочников (жанры, персоны) в памяти процесса.
+    Записи хранятся вместе с modified, поэтому устаревшее значение не перетрет более новое.
+    При заданном max_size вытесняются давно не использованные записи (LRU).
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size
+        self._items: 'OrderedDict[uuid.UUID, Tuple[dt.datetime, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get_many(self, ids: Iterable[uuid.UUID]) -> Tuple[Dict[uuid.UUID, Any], List[uuid.UUID]]:
+        """
+        Возвращает найденные значения и список id, которых нет в кеше
+        """
+        found, missing = {}, []
+        with self._lock:
+            for id in ids:
+                if id in self._items:
+                    self._items.move_to_end(id)
+                    found[id] = self._items[id][1]
+                else:
+                    missing.append(id)
+
+        return found, missing
+
+    def put(self, id: uuid.UUID, modified: dt.datetime, value: Any):
+        with self._lock:
+            cached = self._items.get(id)
+            if cached is not None and cached[0] > modified:
+                return
+
+            self._items[id] = (modified, value)
+            self._items.move_to_end(id)
+
+            if self.max_size is not None:
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+
+    def invalidate(self, rows: Iterable[Any]):
+        """
+        Удаляет записи, для которых пришла более новая версия (строки с id и modified)
+        """
+        with self._lock:
+            for row in rows:
+                cached = self._items.get(row.id)
+                if cached is not None and cached[0] < row.modified:
+                    del self._items[row.id]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# Кеши общие для всех ETL процесса: продюсеры жанров и персон их инвалидируют,
+# а merger фильмов читает из них имена
+genre_cache = DimensionCache()
+person_cache = DimensionCache(max_size=settings.person_cache_size)
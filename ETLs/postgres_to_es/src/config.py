@@ -2,6 +2,8 @@ from pydantic import BaseModel, BaseSettings
 
 import datetime as dt
 import logging
+from enum import Enum
+from typing import List, Optional
 
 
 class PgDsn(BaseModel):
@@ -12,6 +14,12 @@ class PgDsn(BaseModel):
     port: int = 5432
 
 
+class ValidationMode(str, Enum):
+    full = 'full'
+    sampled = 'sampled'
+    off = 'off'
+
+
 class Settings(BaseSettings):
     # Data storage
     pg_dsn: PgDsn = PgDsn(
@@ -23,6 +31,32 @@ class Settings(BaseSettings):
     )
     state_json_filepath: str = 'src/state.json'
 
+    # Реплики для тяжелых выборок данных фильмов, поиск изменений остается на основном сервере
+    pg_replica_dsns: List[PgDsn] = []
+    pg_replica_max_wait: float = 5.0
+    pg_replica_poll_interval: float = 0.1
+
+    # Сессии ETL: имя в pg_stat_activity и таймауты запросов (мс, 0 - без ограничения)
+    pg_application_name: str = 'movies_etl'
+    pg_statement_timeout_ms: int = 60000
+    pg_lock_timeout_ms: int = 1000
+
+    # Ограничитель нагрузки на Postgres (src/governor.py): пока задержка пробного запроса,
+    # число активных сессий или отставание реплик (с) вне бюджета, ETL ждет и уменьшает пачки
+    pg_governor_enabled: bool = False
+    pg_governor_interval: float = 1.0
+    pg_governor_max_latency_ms: float = 50.0
+    pg_governor_max_active_sessions: int = 20
+    pg_governor_max_replica_lag: float = 10.0
+    pg_governor_max_pause: float = 30.0
+    # дольше этого (с) ETL не ждет возврата нагрузки в бюджет и продолжает уменьшенными пачками
+    pg_governor_max_wait: float = 300.0
+    pg_governor_decrease_factor: float = 0.5
+    pg_governor_increase_step: float = 0.1
+
+    # Сколько часов хранить в content.tombstone записи, уже перенесенные в ES
+    tombstone_retention_hours: int = 24
+
     # Constants
     default_updated_at: dt.datetime = dt.datetime(1970, 1, 1, 0, 0, 0)
     data_sql_limit: int = 100
@@ -34,10 +68,101 @@ class Settings(BaseSettings):
     # ElasticSearch
     es_url: str = 'http://127.0.0.1:9200'
     es_index: str = 'movies'
+    es_persons_index: str = 'persons'
+    es_genres_index: str = 'genres'
+    # Статистика жанров из content.genre_stats (sql/genre_stats.sql) в документах индекса genres
+    genre_stats: bool = False
+    # Индекс подсказок автодополнения (schemas/suggest.json), названия фильмов с весом по рейтингу
+    suggest_enabled: bool = False
+    es_suggest_index: str = 'suggest'
+    es_external_versioning: bool = True
+    # пока идет _reindex в новый индекс, запись дублируется в алиас <индекс>_next;
+    # его наличие перепроверяется не чаще раза в es_dual_write_ttl секунд
+    es_dual_write_ttl: float = 10.0
+
+    # Адаптивная нагрузка на ES (AIMD)
+    es_adaptive: bool = False
+    es_min_concurrency: int = 1
+    es_max_concurrency: int = 8
+    es_min_batch_size: int = 10
+    es_max_batch_size: int = 5000
+    es_batch_size_step: int = 50
+    es_decrease_factor: float = 0.5
+    es_target_took_ms: int = 1000
+    es_max_error_rate: float = 0.01
+    es_rejected_max_retries: int = 5
+    es_rejected_retry_delay: float = 1.0
+
+    # Метрики в текстовом формате Prometheus
+    metrics_filepath: Optional[str] = None
+    metrics_dump_interval: float = 10.0
+
+    # Медленные запросы: логируются дольше порога (секунды), а для доли
+    # slow_query_explain_rate из них план EXPLAIN (ANALYZE, BUFFERS) пишется в файл
+    slow_query_threshold: float = 1.0
+    slow_query_explain_rate: float = 0.1
+    slow_query_log_filepath: Optional[str] = 'slow_queries.log'
+    slow_query_log_max_bytes: int = 10 * 1024 * 1024
+    slow_query_log_backup_count: int = 5
 
     # Backoff
     backoff_maxtime = 10
 
+    # Pipeline: стадии работают параллельно и связаны ограниченными очередями
+    pipeline_mode: bool = False
+    pipeline_queue_size: int = 4
+    pipeline_enricher_workers: int = 1
+    pipeline_merger_workers: int = 2
+    pipeline_transformer_workers: int = 1
+    pipeline_loader_workers: int = 2
+
+    # Журнал на диске между transformer и loader
+    spool_enabled: bool = False
+    spool_dir: str = 'spool'
+    spool_segment_max_bytes: int = 64 * 1024 * 1024
+    spool_drain_interval: float = 1.0
+
+    # Потоковая сборка документов: строки merger упорядочены по фильму,
+    # готовые документы уходят в loader не дожидаясь конца пачки
+    stream_transform: bool = False
+    stream_itersize: int = 1000
+    stream_buffer_max_bytes: int = 16 * 1024 * 1024
+
+    # Одна выборка изменений для индексов фильмов, персон и жанров
+    fanout_mode: bool = False
+
+    # Полосы приоритета: измененные фильмы не ждут за пачками фильмов персон и жанров
+    priority_lanes: bool = False
+    priority_live_batch_size: int = 10
+    priority_live_workers: int = 2
+    priority_bulk_workers: int = 2
+    # предел пачек в очереди bulk: при большой переиндексации чтение изменений ждет воркеров
+    priority_bulk_max_queued: int = 20
+    # пачку live, ждущую дольше, забирают и воркеры bulk
+    priority_live_target_latency: float = 1.0
+    priority_live_poll_interval: float = 1.0
+
+    # Готовые документы фильмов из content.filmwork_search_doc
+    search_doc_mode: bool = False
+    search_doc_refresh: bool = True
+
+    # Валидация строк pydantic-моделями: full, sampled или off
+    validation_mode: ValidationMode = ValidationMode.full
+    validation_sample_rate: float = 0.01
+
+    # С какого числа id enricher загружает их во временную таблицу (COPY) вместо списка IN,
+    # порог подбирается benchmark_staging.py
+    staging_min_ids: int = 500
+
+    # Кеш справочников жанров и персон для merger
+    dimension_cache_enabled: bool = True
+    person_cache_size: int = 10000
+
+    # Сверка индекса фильмов с БД по диапазонам id (reconcile.py):
+    # диапазон с расхождением делится дальше, пока в нем больше reconcile_leaf_size документов
+    reconcile_leaf_size: int = 1000
+    reconcile_id_field: str = 'id'
+
 
 settings = Settings()
 
@@ -1,12 +1,28 @@
+import io
+import time
+import uuid
+from typing import Iterator, List
+
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from psycopg2.errors import DatabaseError, ConnectionException
+from psycopg2.errors import DatabaseError, ConnectionException, LockNotAvailable, QueryCanceled
 from .config import settings
+from .governor import pg_governor, session_options
+from .slow_queries import slow_query_log
 import backoff
 
 psycopg2.extras.register_uuid()
 
 
+def parse_lsn(lsn: str) -> int:
+    """
+    Позиция WAL в виде числа из текстового представления pg_lsn (X/Y)
+    """
+    high, low = lsn.split('/')
+
+    return (int(high, 16) << 32) + int(low, 16)
+
+
 class DBHanlder:
     def __init__(self, dsn: dict = None):
         self.dsn = dsn
@@ -16,12 +32,115 @@ class DBHanlder:
         self.conn = self._get_conn()
         self.cur = self.conn.cursor()
 
+        # позиция WAL, которую реплика уже точно воспроизвела
+        self.replayed_lsn = 0
+
+    @property
+    def retries_timeouts(self) -> bool:
+        """
+        Повтор после таймаута пойдет уменьшенной пачкой: ограничитель включен и таймауты заданы
+        """
+        return pg_governor.enabled and bool(settings.pg_statement_timeout_ms or settings.pg_lock_timeout_ms)
+
     @backoff.on_exception(backoff.expo, DatabaseError, max_time=settings.backoff_maxtime)
     def execute_query(self, query: str, params: tuple) -> dict:
-        self.cur.execute(query, params)
+        """
+        При включенном ограничителе запрос выполняется в точке сохранения: ошибка (statement_timeout,
+        lock_timeout) откатывает только его, а временные таблицы и открытые серверные курсоры
+        транзакции остаются. Повтор выполняет тот же запрос, но LIMIT из BatchLimit пересчитывается
+        по уменьшенной пачке. Без ограничителя пачка не уменьшится, и лишние обращения к БД
+        на точку сохранения не нужны: ошибка откатывает транзакцию целиком
+        """
+        pg_governor.throttle()
+
+        savepoint = self.retries_timeouts
+        if savepoint:
+            self.cur.execute('SAVEPOINT etl_query;')
+        started = time.monotonic()
+        try:
+            self.cur.execute(query, params)
+            rows = self.cur.fetchall()
+        except DatabaseError as exc:
+            if isinstance(exc, (QueryCanceled, LockNotAvailable)):
+                pg_governor.on_timeout()
+            if self.conn.closed:
+                raise
+            if savepoint:
+                self.cur.execute('ROLLBACK TO SAVEPOINT etl_query;')
+            else:
+                self.conn.rollback()
+            raise
+        duration = time.monotonic() - started
+        if savepoint:
+            self.cur.execute('RELEASE SAVEPOINT etl_query;')
+        slow_query_log.observe(self.conn, query, params, duration)
         
-        return self.cur.fetchall()
+        return rows
+
+    def stage_ids(self, table: str, ids: List[uuid.UUID]) -> str:
+        """
+        Загружает id во временную таблицу сессии через COPY и возвращает ее имя.
+        Большой набор id передается в БД один раз, а запросы соединяются с таблицей
+        вместо того, чтобы каждый раз отправлять список IN из тысяч плейсхолдеров.
+        Загрузка фиксируется сразу: иначе DDL и COPY держали бы xid открытой транзакции
+        и горизонт очистки (vacuum) всей базы, а откат после таймаута запроса вернул бы
+        таблице прежние id
+        """
+        pg_governor.throttle()
+
+        self.cur.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (id uuid PRIMARY KEY);')
+        self.cur.execute(f'TRUNCATE {table};')
+        self.cur.copy_expert(
+            f'COPY {table} (id) FROM STDIN',
+            io.StringIO(''.join(f'{id}\n' for id in dict.fromkeys(ids)))
+        )
+        # статистика по таблице, чтобы планировщик выбрал подходящее соединение
+        self.cur.execute(f'ANALYZE {table};')
+        self.conn.commit()
+
+        return table
+
+    def commit(self):
+        self.conn.commit()
+
+    def current_wal_lsn(self) -> int:
+        return parse_lsn(self.execute_query('SELECT pg_current_wal_lsn()::text as lsn;', ())[0]['lsn'])
+
+    def wait_for_replay(self, lsn: int, timeout: float) -> bool:
+        """
+        Ждет, пока реплика воспроизведет WAL до позиции lsn, не дольше timeout секунд.
+        На основном сервере (не реплике) позиция считается достигнутой сразу
+        """
+        deadline = time.monotonic() + timeout
+
+        while self.replayed_lsn < lsn:
+            replayed = self.execute_query('SELECT pg_last_wal_replay_lsn()::text as lsn;', ())[0]['lsn']
+            self.replayed_lsn = lsn if replayed is None else parse_lsn(replayed)
+
+            if self.replayed_lsn < lsn:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(settings.pg_replica_poll_interval)
+
+        return True
+
+    def iter_query(self, query: str, params: tuple, itersize: int) -> Iterator[List[dict]]:
+        """
+        Выполняет запрос на серверном курсоре и отдает строки пачками по itersize,
+        не загружая весь результат в память
+        """
+        pg_governor.throttle()
+
+        # курсор открывает свою транзакцию: ее время - время снимка, из которого читаются строки
+        self.conn.commit()
+        cur = self.conn.cursor(name=f'etl_{uuid.uuid4().hex}')
+        try:
+            cur.execute(query, params)
+            while rows := cur.fetchmany(itersize):
+                yield rows
+        finally:
+            cur.close()
 
     @backoff.on_exception(backoff.expo, ConnectionException, max_time=settings.backoff_maxtime)
     def _get_conn(self):
-        return psycopg2.connect(**self.dsn, cursor_factory=RealDictCursor)
\ No newline at end of file
+        return psycopg2.connect(**self.dsn, **session_options(), cursor_factory=RealDictCursor)
\ No newline at end of file
@@ -1,15 +1,26 @@
 import json
 import logging
-from typing import List, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
 from urllib.parse import urljoin
 
 import backoff
 import requests
 
+from .aimd import build_controller
 from .config import settings
 
 logger = logging.getLogger(__name__)
 
+# алиас нового индекса, в который create_es_schemas.py переносит данные серверным _reindex
+NEXT_ALIAS_SUFFIX = '_next'
+
+
+class BulkRejectedError(Exception):
+    """Bulk-запрос или часть его действий отклонены ES временно (429, 5xx) и должны быть повторены"""
+
 
 class ESHandler:
     def __init__(
@@ -19,19 +30,138 @@ class ESHandler:
     ):
         self.es_root_url = root_url or settings.es_url
         self.index_name = index_name or settings.es_index
+
+        # индексации более старых снимков, отклоненные ES по версии
+        self.version_conflicts = 0
+        self._stats_lock = threading.Lock()
+
+        # индекс -> (время проверки, есть ли алиас <индекс>_next)
+        self._next_aliases = {}
+
+        # параллельность и размер bulk-запросов подстраиваются под нагрузку ES
+        self.controller = None
+        if settings.es_adaptive:
+            self.controller = build_controller()
+            self._executor = ThreadPoolExecutor(max_workers=settings.es_max_concurrency)
     
-    def _get_es_bulk_query(self, rows: List[dict]) -> List[str]:
+    def next_alias(self, index_name: str) -> Optional[str]:
         """
-        Подготавливает bulk-запрос в Elasticsearch
+        Алиас нового индекса, если для index_name идет _reindex: на это время запись дублируется в него
         """
-        prepared_query = []
+        checked_at, exists = self._next_aliases.get(index_name, (0, False))
+        if time.monotonic() - checked_at >= settings.es_dual_write_ttl:
+            try:
+                response = requests.head(urljoin(self.es_root_url, f'_alias/{index_name}{NEXT_ALIAS_SUFFIX}'))
+                exists = response.status_code == 200
+            except requests.exceptions.RequestException as e:
+                # ES недоступен: остается последнее известное состояние, проверка повторится через ttl
+                logger.warning(f'Failed to check alias {index_name}{NEXT_ALIAS_SUFFIX}: {e}')
+            self._next_aliases[index_name] = (time.monotonic(), exists)
+
+        return f'{index_name}{NEXT_ALIAS_SUFFIX}' if exists else None
+
+    def _get_es_bulk_query(
+        self, rows: List[dict], deleted_ids: Iterable[str] = (), dual_write: bool = True
+    ) -> str:
+        """
+        Подготавливает bulk-запрос в Elasticsearch.
+        Удаления передаются в том же запросе, что и индексация.
+        Поле _version строки уходит в метаданные действия как внешняя версия документа,
+        а поле _index позволяет смешивать в одном запросе документы разных индексов.
+        Если в строке есть _raw, в запрос без разбора подставляется этот готовый JSON документа.
+        Поле _op задает действие: index (по умолчанию), update - частичное обновление только
+        полей строки (документ создается, если его нет), delete - удаление документа с id строки.
+        Без dual_write копии для алиасов <индекс>_next не добавляются и ES не опрашивается
+        """
+        deleted_ids = list(deleted_ids)
+        actions = [
+            ({'delete': {'_index': self.index_name, '_id': str(id)}}, None)
+            for id in deleted_ids
+        ]
         for row in rows:
-            prepared_query.extend([
-                json.dumps({'index': {'_index': self.index_name, '_id': row['id']}}),
-                json.dumps(row)
-            ])
+            row = dict(row)
+            op = row.pop('_op', 'index')
+            action = {'_index': row.pop('_index', self.index_name), '_id': row['id']}
+
+            if op == 'delete':
+                actions.append(({'delete': action}, None))
+                continue
+
+            version = row.pop('_version', None)
+            if version is not None and settings.es_external_versioning and op == 'index':
+                action.update(version=version, version_type='external')
+
+            raw_source = row.pop('_raw', None)
+            source = raw_source if raw_source is not None else json.dumps(row)
+            if op == 'update':
+                source = f'{{"doc": {source}, "doc_as_upsert": true}}'
+
+            actions.append(({op: action}, source))
+
+        # подсказки удаленных фильмов; как и копии ниже, идут после основных действий
+        if settings.suggest_enabled:
+            actions.extend(
+                ({'delete': {'_index': settings.es_suggest_index, '_id': str(id)}}, None)
+                for id in deleted_ids
+            )
+
+        if dual_write:
+            actions = self._with_dual_write(actions)
+
+        return self._serialize_actions(actions)
+
+    def _with_dual_write(self, actions: List[Tuple[dict, Optional[str]]]) -> List[Tuple[dict, Optional[str]]]:
+        """
+        Двойная запись на время _reindex: копии действий идут после основных,
+        чтобы номера элементов ответа для основных действий не сдвигались
+        """
+        copies = []
+        for meta, source in actions:
+            (op, action), = meta.items()
+            next_alias = self.next_alias(action['_index'])
+            if next_alias is None:
+                continue
+
+            action = {**action, '_index': next_alias}
+            if op != 'delete':
+                # алиас уже сняли - не создавать вместо него новый индекс
+                action['require_alias'] = True
+            copies.append(({op: action}, source))
+
+        return actions + copies
+
+    @staticmethod
+    def _serialize_actions(actions: List[Tuple[dict, Optional[str]]]) -> str:
+        prepared_query = []
+        for meta, source in actions:
+            prepared_query.append(json.dumps(meta))
+            if source is not None:
+                prepared_query.append(source)
         return '\n'.join(prepared_query) + '\n'
+
+    @staticmethod
+    def _parse_actions(body: bytes) -> List[Tuple[dict, Optional[str]]]:
+        """
+        Разбирает тело bulk-запроса обратно в пары (метаданные, документ); у delete документа нет
+        """
+        lines = iter(body.decode().splitlines())
+        actions = []
+        for line in lines:
+            if not line:
+                continue
+            meta = json.loads(line)
+            source = None if 'delete' in meta else next(lines)
+            actions.append((meta, source))
+
+        return actions
     
+    def get_bulk_body(self, rows: List[dict], deleted_ids: Iterable[str] = ()) -> bytes:
+        """
+        Готовое тело bulk-запроса для сохранения в журнал.
+        Без копий для двойной записи: ее цели выбираются при отправке (upload_raw), а не при записи в журнал
+        """
+        return self._get_es_bulk_query(rows, deleted_ids, dual_write=False).encode()
+
     @backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=settings.backoff_maxtime)
     def bulk_request(self, query_data):
         """
@@ -48,16 +178,152 @@ class ESHandler:
         
         return response_json
 
-    def upload_data(self, data):
+    @backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=settings.backoff_maxtime)
+    def search(self, body: dict) -> dict:
         """
-        Загружает данные в Elasticsearch
+        Выполняет поисковый запрос к индексу
         """
-        logger.debug(f'Loading {len(data)} items to ES')
+        response = requests.post(
+            urljoin(self.es_root_url, f'{self.index_name}/_search'),
+            json=body
+        )
+        response.raise_for_status()
+
+        return response.json()
+
+    def upload_data(self, data, deleted_ids: Iterable[str] = ()):
+        """
+        Загружает данные в Elasticsearch и удаляет документы с переданными id
+        """
+        deleted_ids = list(deleted_ids)
+        logger.debug(f'Loading {len(data)} items to ES, deleting {len(deleted_ids)}')
+
+        if self.controller is not None:
+            self._upload_adaptive(list(data), deleted_ids)
+            return
         
-        prepared_data = self._get_es_bulk_query(data)
+        prepared_data = self._get_es_bulk_query(data, deleted_ids)
         json_response = self.bulk_request(prepared_data)
 
-        for item in json_response['items']:
-            error_message = item['index'].get('error')
-            if error_message:
-                logger.error(f'{error_message}')
+        self._log_item_errors(json_response)
+
+    def _send_chunk(self, rows: List[dict], deleted_ids: List[str]) -> Tuple[List[dict], List[str]]:
+        """
+        Отправляет одну пачку и возвращает отклоненные ES (429) строки и удаления для повтора
+        """
+        json_response = self.bulk_request(self._get_es_bulk_query(rows, deleted_ids))
+        
+        if 'items' not in json_response:
+            if json_response.get('status') == 429:
+                self.controller.on_overload()
+                return rows, deleted_ids
+
+            logger.error(f'Bulk request failed: {json_response.get("error")}')
+            return [], []
+
+        rejected, errors = self._log_item_errors(json_response, retry_rejected=True)
+        self.controller.observe(
+            json_response.get('took', 0), len(json_response['items']), len(rejected), errors
+        )
+
+        # порядок элементов ответа совпадает с порядком действий: сначала удаления, потом индексация,
+        # затем копии для двойной записи, которые не повторяются
+        return (
+            [rows[i - len(deleted_ids)] for i in rejected if len(deleted_ids) <= i < len(deleted_ids) + len(rows)],
+            [deleted_ids[i] for i in rejected if i < len(deleted_ids)],
+        )
+
+    def _upload_adaptive(self, rows: List[dict], deleted_ids: List[str]):
+        """
+        Делит данные на пачки текущего размера и отправляет их с текущей параллельностью.
+        Отклоненные из-за перегрузки действия повторяются после паузы
+        """
+        for attempt in range(settings.es_rejected_max_retries + 1):
+            if attempt:
+                time.sleep(settings.es_rejected_retry_delay * attempt)
+
+            retry_rows, retry_deleted = [], []
+            while rows or deleted_ids:
+                size, concurrency = self.controller.batch_size, self.controller.concurrency
+                chunks = [
+                    rows[i:i + size] for i in range(0, min(len(rows), size * concurrency), size)
+                ] or [[]]
+                rows = rows[size * concurrency:]
+
+                futures = [
+                    self._executor.submit(self._send_chunk, chunk, deleted_ids if n == 0 else [])
+                    for n, chunk in enumerate(chunks)
+                ]
+                deleted_ids = []
+
+                for future in futures:
+                    rejected_rows, rejected_deleted = future.result()
+                    retry_rows.extend(rejected_rows)
+                    retry_deleted.extend(rejected_deleted)
+
+            if not (retry_rows or retry_deleted):
+                return
+
+            rows, deleted_ids = retry_rows, retry_deleted
+
+        logger.error(f'ES rejected {len(rows) + len(deleted_ids)} actions after retries')
+
+    def upload_raw(self, body: bytes):
+        """
+        Отправляет в Elasticsearch готовое тело bulk-запроса, добавив копии для двойной записи
+        """
+        logger.debug(f'Loading {len(body)} bytes to ES')
+
+        # _reindex мог начаться или закончиться, пока тело лежало в журнале
+        body = self._serialize_actions(self._with_dual_write(self._parse_actions(body))).encode()
+        json_response = self.bulk_request(body)
+
+        rejected, errors = self._log_item_errors(json_response, retry_rejected=True)
+        if self.controller is not None:
+            self.controller.observe(
+                json_response.get('took', 0), len(json_response['items']), len(rejected), errors
+            )
+
+        # повтор всего тела безопасен: индексация проверяет внешнюю версию, а update и delete идемпотентны
+        if rejected:
+            raise BulkRejectedError(f'ES rejected {len(rejected)} of {len(json_response["items"])} actions')
+
+    def _log_item_errors(self, json_response: dict, retry_rejected: bool = False) -> Tuple[List[int], int]:
+        """
+        Логирует ошибки элементов bulk-ответа.
+        Возвращает номера элементов, отклоненных временно (429 и 5xx), и число прочих ошибок.
+        Ответ без items (ошибка всего запроса) поднимает BulkRejectedError
+        """
+        if 'items' not in json_response:
+            raise BulkRejectedError(f'Bulk request failed: {json_response.get("error")}')
+
+        conflicts = 0
+        rejected = []
+        errors = 0
+        
+        for number, item in enumerate(json_response['items']):
+            action, result = next(iter(item.items()))
+            error_message = result.get('error')
+            if not error_message:
+                continue
+
+            if result.get('status') == 409:
+                # в индексе уже более новая версия документа, пропуск безопасен
+                conflicts += 1
+                continue
+
+            if result.get('status') == 429 or result.get('status', 0) >= 500:
+                rejected.append(number)
+                if retry_rejected:
+                    continue
+            else:
+                errors += 1
+            
+            logger.error(f'{action}: {error_message}')
+
+        if conflicts:
+            with self._stats_lock:
+                self.version_conflicts += conflicts
+            logger.info(f'Skipped {conflicts} stale documents (version conflict)')
+
+        return rejected, errors
@@ -1,28 +1,57 @@
 import datetime as dt
+import itertools
 import logging
+import threading
+import time
 import uuid
-from typing import Any, Coroutine, List
+from typing import Any, Coroutine, Dict, Iterator, List, Optional, Tuple
 
 import backoff
 
+from .cache import genre_cache, person_cache
 from .config import settings
 from .db import DBHanlder
 from .es import ESHandler
+from .governor import BatchLimit
+from .metrics import metrics
 from .models import (
     EntryName, 
     ESFilmwork, 
     FilmworkId, 
     FilmworkRow, 
     Genre,
+    GenreName,
     Person, 
+    PersonName, 
     PersonData, 
-    Roles
+    Roles,
+    Tombstone
 )
+from .lanes import Lane, LaneScheduler
+from .pipeline import Pipeline, Stage
+from .spool import Spool
 from .state import JsonFileStorage, State
-from .utils import coroutine
+from .utils import coroutine, suggest_inputs
+from .validation import build_model, build_models
 
 logger = logging.getLogger(__name__)
 
+# Контрольная сумма пары (id, modified) фильма: 32 бита md5, чтобы сумма по диапазону
+# оставалась точной и в sum-агрегации ES (double). Она же поле etl_checksum документа
+DOC_CHECKSUM_SQL = (
+    "('x' || left(md5({alias}.id::text || ':' || "
+    "(extract(epoch from {alias}.modified) * 1000000)::bigint::text), 8))::bit(32)::bigint"
+)
+
+# Внешняя версия документа - время снимка, из которого он прочитан. В READ COMMITTED снимок
+# берется в начале оператора, поэтому statement_timestamp(), а не время выдачи строки.
+# Серверный курсор начинает свою транзакцию с DECLARE, и для него это transaction_timestamp():
+# statement_timestamp() при каждом FETCH был бы новым
+SNAPSHOT_VERSION_SQL = '(extract(epoch from {clock}) * 1000000)::bigint'
+
+# Статистика жанра без фильмов
+EMPTY_GENRE_STATS = {'films_count': 0, 'rated_count': 0, 'rating_sum': 0, 'histogram': [0] * 10, 'top_films': []}
+
 
 class ETLBase:
     def __init__(self, entry_name: EntryName):
@@ -39,8 +68,22 @@ class ETLBase:
             EntryName.person: 'filmworks_persons',
         }
 
+        self.dimension_caches = {
+            EntryName.genre: genre_cache,
+            EntryName.person: person_cache,
+        }
+
+        # индексы справочников, которые наполняют FanOutETL и PriorityETL
+        self.dimension_indices = {
+            EntryName.genre: settings.es_genres_index,
+            EntryName.person: settings.es_persons_index,
+        }
+
         self.es_handler = ESHandler()
-        self.db_handler = DBHanlder()
+        self.spool = None
+        if settings.spool_enabled:
+            self.spool = Spool(settings.spool_dir, settings.spool_segment_max_bytes)
+        self._local = threading.local()
         self.state_handler = State(
             JsonFileStorage(
                 file_path=settings.state_json_filepath
@@ -53,25 +96,98 @@ class ETLBase:
             Roles.actor: self._handle_actor,
         }
 
+        # id удаленных фильмов, которые уйдут в ES вместе со следующей пачкой индексации,
+        # и seq последней записи tombstone среди них
+        self.deleted_fw_ids: List[str] = []
+        self._deleted_seq = None
+        # seq забранных пачек удалений в порядке забора и seq уже загруженных из них
+        self._inflight_tombstone_seqs: List[int] = []
+        self._loaded_tombstone_seqs = set()
+        self._deleted_lock = threading.Lock()
+
+        # позиция WAL основного сервера после последнего поиска изменений:
+        # реплика должна воспроизвести ее, прежде чем из нее читаются данные этих изменений
+        self.required_lsn = 0
+        self._lsn_lock = threading.Lock()
+        self._replica_counter = itertools.count()
+
+    @property
+    def batch_limit(self) -> BatchLimit:
+        """
+        Размер пачки выборок: data_sql_limit, уменьшенный ограничителем нагрузки на Postgres.
+        Передается параметром запроса и пересчитывается при повторе после таймаута
+        """
+        return BatchLimit(settings.data_sql_limit)
+
+    @property
+    def db_handler(self) -> DBHanlder:
+        """
+        Соединение с БД отдельное для каждого потока: в режиме конвейера стадии работают параллельно
+        """
+        if not hasattr(self._local, 'db_handler'):
+            self._local.db_handler = DBHanlder()
+
+        return self._local.db_handler
+
+    @property
+    def bulk_db_handler(self) -> DBHanlder:
+        """
+        Соединение для тяжелых выборок данных фильмов: реплика из пула pg_replica_dsns.
+        Пока реплика не дошла до required_lsn, ожидание не дольше pg_replica_max_wait,
+        после чего запрос уходит на основной сервер, чтобы не прочитать устаревшие данные
+        """
+        if not settings.pg_replica_dsns:
+            return self.db_handler
+
+        if not hasattr(self._local, 'replica_db_handler'):
+            dsn = settings.pg_replica_dsns[next(self._replica_counter) % len(settings.pg_replica_dsns)]
+            self._local.replica_db_handler = DBHanlder(dsn.dict())
+
+        if self._local.replica_db_handler.wait_for_replay(self.required_lsn, settings.pg_replica_max_wait):
+            return self._local.replica_db_handler
+
+        metrics.inc('replica_fallbacks_total')
+        logger.warning('Replica lags behind, reading from primary')
+
+        return self.db_handler
+
+    def fetch_changes(self, query: str, params: tuple) -> List[dict]:
+        """
+        Выполняет запрос поиска изменений на основном сервере
+        и запоминает позицию WAL, до которой должна дойти реплика
+        """
+        rows = self.db_handler.execute_query(query, params)
+
+        if settings.pg_replica_dsns:
+            lsn = self.db_handler.current_wal_lsn()
+            with self._lsn_lock:
+                self.required_lsn = max(self.required_lsn, lsn)
+
+        return rows
+
     def _update_unique_list(self, lst: List[Any], value: Any) -> List[Any]:
         if value in lst:
             return lst
         
         return [*lst, value]
 
-    def get_or_create_esfilmwork(self, fw_row: FilmworkRow) -> ESFilmwork:
+    def get_or_create_esfilmwork(
+        self, fw_row: FilmworkRow, filmworks: Dict[str, ESFilmwork]
+    ) -> ESFilmwork:
         id = str(fw_row.fw_id)
         
-        if id in self.filmworks:
-            return self.filmworks[id]
+        if id in filmworks:
+            return filmworks[id]
         
-        filmwork = ESFilmwork(
+        filmwork = build_model(
+            ESFilmwork,
             id=id,
             title=fw_row.title,
             description=fw_row.description,
-            imdb_rating=fw_row.imdb_rating
+            imdb_rating=fw_row.imdb_rating,
+            etl_checksum=fw_row.checksum
         )
-        self.filmworks[id] = filmwork
+        filmworks[id] = filmwork
 
         return filmwork
     
@@ -81,7 +197,7 @@ class ETLBase:
         return es_fw
 
     def _handle_actor(self, es_fw: ESFilmwork, fw_row: FilmworkRow) -> ESFilmwork:
-        actor_data = PersonData(id=str(fw_row.fw_id), name=fw_row.full_name)
+        actor_data = build_model(PersonData, id=str(fw_row.fw_id), name=fw_row.full_name)
         
         es_fw.actors = self._update_unique_list(es_fw.actors, actor_data.dict())
         es_fw.actors_names = self._update_unique_list(es_fw.actors_names, actor_data.name)
@@ -89,7 +205,7 @@ class ETLBase:
         return es_fw
     
     def _handle_writer(self, es_fw: ESFilmwork, fw_row: FilmworkRow) -> ESFilmwork:
-        writer_data = PersonData(id=str(fw_row.fw_id), name=fw_row.full_name)
+        writer_data = build_model(PersonData, id=str(fw_row.fw_id), name=fw_row.full_name)
         
         es_fw.writers = self._update_unique_list(es_fw.writers, writer_data.dict())
         es_fw.writers_names = self._update_unique_list(es_fw.writers_names, writer_data.name)
@@ -97,10 +213,13 @@ class ETLBase:
         return es_fw
 
     def update_esfilmwork_info(self, es_fw: ESFilmwork, fw_row: FilmworkRow) -> ESFilmwork:
-        es_fw.genre = self._update_unique_list(es_fw.genre, fw_row.genre)
-        updated_person_es_fw = self._person_role_dispatch[fw_row.role](es_fw, fw_row)
+        # фильм, у которого удалили последний жанр или персону, остается с пустыми списками
+        if fw_row.genre is not None:
+            es_fw.genre = self._update_unique_list(es_fw.genre, fw_row.genre)
+        if fw_row.role is None or fw_row.full_name is None:
+            return es_fw
 
-        return updated_person_es_fw
+        return self._person_role_dispatch[fw_row.role](es_fw, fw_row)
 
     def get_last_updated_at(self, entry_name: EntryName) -> dt.datetime:
         updated_at = self.state_handler.get_state(f'{entry_name}_updated_at')
@@ -112,25 +231,488 @@ class ETLBase:
 
     def set_last_updated_at(self, entry_name: EntryName, value: dt.datetime):
         self.state_handler.set_state(f'{entry_name}_updated_at', value)
+
+    def get_last_tombstone_seq(self, entry_name: EntryName) -> int:
+        return self.state_handler.get_state(f'{entry_name}_tombstone_seq') or 0
+
+    def set_last_tombstone_seq(self, entry_name: EntryName, value: int):
+        self.state_handler.set_state(f'{entry_name}_tombstone_seq', value)
+
+    def add_deleted_fw_ids(self, fw_ids: List[str], seq: int):
+        with self._deleted_lock:
+            self.deleted_fw_ids.extend(fw_ids)
+            self._deleted_seq = seq
+
+    def pop_deleted_fw_ids(self) -> Tuple[List[str], Optional[int]]:
+        """
+        Забирает накопленные удаления вместе с seq, который можно сохранить после их загрузки
+        """
+        with self._deleted_lock:
+            deleted_fw_ids, self.deleted_fw_ids = self.deleted_fw_ids, []
+            seq, self._deleted_seq = self._deleted_seq, None
+            if seq is not None:
+                self._inflight_tombstone_seqs.append(seq)
+
+        return deleted_fw_ids, seq
+
+    def commit_tombstones(self, seq: Optional[int]):
+        """
+        Отмечает пачку удалений загруженной. При нескольких загрузчиках seq сохраняется,
+        только когда загружены и все забранные раньше пачки: иначе падение между
+        загрузками потеряло бы удаления еще не загруженной пачки
+        """
+        if seq is None:
+            return
+
+        with self._deleted_lock:
+            self._loaded_tombstone_seqs.add(seq)
+
+            inflight, loaded = self._inflight_tombstone_seqs, self._loaded_tombstone_seqs
+            committed = None
+            while inflight and inflight[0] in loaded:
+                committed = inflight.pop(0)
+                loaded.discard(committed)
+
+            if committed is not None:
+                self.set_last_tombstone_seq(self.entry_name, committed)
+
+    def flush_deleted(self):
+        """
+        Отправляет в ES накопленные удаления, не попавшие в пачки индексации
+        """
+        self.upload([])
+
+    def prune_tombstones(self, seq: int):
+        """
+        Удаляет из content.tombstone уже перенесенные в ES записи своей сущности (до сохраненного seq),
+        которые старше tombstone_retention_hours
+        """
+        query = '''
+            WITH pruned AS (
+                DELETE FROM content.tombstone
+                WHERE entity = %s AND seq <= %s AND deleted_at < now() - make_interval(hours => %s)
+                RETURNING seq
+            )
+            SELECT count(*) as pruned FROM pruned;
+        '''
+        rows = self.db_handler.execute_query(query, (self.entry_name, seq, settings.tombstone_retention_hours))
+        self.db_handler.commit()
+
+        if rows:
+            logger.debug(f'Pruned %s {self.entry_name} tombstones', rows[0]['pruned'])
+
+    def tombstones(self, target: Coroutine[None, List[uuid.UUID], None]):
+        """
+        Обрабатывает записи content.tombstone для своей сущности.
+        Удаленные фильмы копятся в deleted_fw_ids и уходят в ES вместе с индексацией,
+        а фильмы удаленных персон и жанров отправляются на переиндексацию в target.
+        В режимах fanout_mode и priority_lanes удаленные персоны и жанры убираются и из своих индексов.
+        """
+        seq = self.get_last_tombstone_seq(self.entry_name)
+        self.prune_tombstones(seq)
+
+        while True:
+            query = f'''
+                SELECT seq, entity, entity_id, filmwork_ids, deleted_at
+                FROM content.tombstone
+                WHERE entity = %s AND seq > %s
+                ORDER BY seq
+                LIMIT %s;
+            '''
+            params = (self.entry_name, seq, self.batch_limit)
+            result = build_models(
+                Tombstone, self.fetch_changes(query, params)
+            )
+            logger.debug(f'Fetched %s deleted {self.entry_name}', len(result))
+
+            if not result:
+                break
+
+            seq = result[-1].seq
+
+            if self.entry_name == EntryName.filmwork:
+                self.add_deleted_fw_ids([str(row.entity_id) for row in result], seq)
+                
+                if len(self.deleted_fw_ids) >= settings.data_sql_limit:
+                    self.flush_deleted()
+                continue
+
+            affected_fw_ids = list({fw_id for row in result for fw_id in row.filmwork_ids})
+            for i in range(0, len(affected_fw_ids), settings.data_sql_limit):
+                target.send(affected_fw_ids[i:i + settings.data_sql_limit])
+
+            if settings.fanout_mode or settings.priority_lanes:
+                index = self.dimension_indices[self.entry_name]
+                self.upload([{'_op': 'delete', '_index': index, 'id': str(row.entity_id)} for row in result])
+
+            self.set_last_tombstone_seq(self.entry_name, seq)
     
-    def producer(self, target: Coroutine[None, None, None]):
-        updated_at = self.get_last_updated_at(self.entry_name)
+    def fetch_modified(self, updated_at: dt.datetime) -> List[Any]:
         table_name = self.entry_name
         props = self.producer_table_props[self.entry_name]['props']
         DClass = self.producer_table_props[self.entry_name]['dataclass']
+
+        query = f'''
+            SELECT {props}
+            FROM content.{table_name}
+            WHERE modified > %s
+            ORDER BY modified
+            LIMIT %s;
+        '''
+        params = (updated_at, self.batch_limit)
+        result = build_models(
+            DClass, self.fetch_changes(query, params)
+        )
+
+        if self.entry_name in self.dimension_caches:
+            self.dimension_caches[self.entry_name].invalidate(result)
+
+        return result
+
+    def iter_modified_fw_ids(
+        self, modified_data_ids: List[uuid.UUID], entry_name: Optional[EntryName] = None
+    ) -> Iterator[List[uuid.UUID]]:
+        """
+        Постранично выдает id фильмов, связанных с изменившимися сущностями
+        """
+        entry_name = entry_name or self.entry_name
+        data_ids_placeholder = ', '.join(['%s']*len(modified_data_ids))
+        updated_at = self.get_last_updated_at(EntryName.filmwork.value)
+        
+        fw_m2m_predicate = ''
+        fw_m2m_staged_join = ''
+        ids_params = ()
+        if entry_name != EntryName.filmwork.value:
+            if len(modified_data_ids) >= settings.staging_min_ids:
+                # большой набор id передается один раз, страницы соединяются с временной таблицей
+                staged_table = self.db_handler.stage_ids('etl_staged_enricher_ids', modified_data_ids)
+                fw_m2m_staged_join = f'JOIN {staged_table} staged ON staged.id = mtm.{entry_name}_id'
+            else:
+                fw_m2m_predicate = f'AND mtm.{entry_name}_id IN ({data_ids_placeholder})'
+                ids_params = tuple(modified_data_ids)
+        
+        m2m_table_name = self.fw_m2m_tables[entry_name]
         
         while True:
             query = f'''
-                SELECT {props}
-                FROM content.{table_name}
-                WHERE modified > %s
-                ORDER BY modified
-                LIMIT {settings.data_sql_limit};
+                SELECT fw.id, fw.modified
+                FROM content.filmwork fw
+                LEFT JOIN content.{m2m_table_name} mtm ON mtm.filmwork_id = fw.id
+                {fw_m2m_staged_join}
+                WHERE fw.modified > %s {fw_m2m_predicate}
+                ORDER BY fw.modified
+                LIMIT %s;
             '''
-            params = (updated_at,)
-            result = [
-                DClass(**row) for row in self.db_handler.execute_query(query, params)
-            ]
+            params = (updated_at, *ids_params, self.batch_limit)
+            result = build_models(
+                FilmworkId, self.fetch_changes(query, params)
+            )
+
+            modified_fw_ids = [fw_id.id for fw_id in result]
+
+            if not modified_fw_ids:
+                break
+            
+            updated_at = result[-1].modified
+            yield modified_fw_ids
+
+    def resolve_genres(self, genre_ids: List[uuid.UUID]) -> Dict[uuid.UUID, str]:
+        found, missing = genre_cache.get_many(genre_ids)
+        if not missing:
+            return found
+
+        # жанров мало, поэтому при промахе перечитываем справочник целиком
+        query = 'SELECT id, name, modified FROM content.genre;'
+        for row in self.bulk_db_handler.execute_query(query, ()):
+            genre_cache.put(row['id'], row['modified'], row['name'])
+
+        found, _ = genre_cache.get_many(genre_ids)
+
+        return found
+
+    def resolve_persons(self, person_ids: List[uuid.UUID]) -> Dict[uuid.UUID, str]:
+        found, missing = person_cache.get_many(person_ids)
+        if not missing:
+            return found
+
+        data_ids_placeholder = ', '.join(['%s']*len(missing))
+        query = f'''
+            SELECT id, first_name as full_name, modified
+            FROM content.person
+            WHERE id IN ({data_ids_placeholder});
+        '''
+        for row in self.bulk_db_handler.execute_query(query, tuple(missing)):
+            person_cache.put(row['id'], row['modified'], row['full_name'])
+            found[row['id']] = row['full_name']
+
+        return found
+
+    def _filmwork_link_rows_query(self, fw_ids_count: int, ordered: bool = False) -> str:
+        data_ids_placeholder = ', '.join(['%s']*fw_ids_count)
+        order_by = 'ORDER BY fw.id' if ordered else ''
+        clock = 'transaction_timestamp()' if ordered else 'statement_timestamp()'
+        
+        return f'''
+            SELECT
+            fw.id as fw_id, 
+            fw.title, 
+            fw.description, 
+            fw.rating as imdb_rating, 
+            fw.type, 
+            fw.created, 
+            fw.modified, 
+            {SNAPSHOT_VERSION_SQL.format(clock=clock)} as version,
+            {DOC_CHECKSUM_SQL.format(alias="fw")} as checksum,
+            fwp.role, 
+            fwp.person_id,
+            fwg.genre_id
+            FROM content.filmwork fw
+            LEFT JOIN content.filmworks_persons fwp ON fwp.filmwork_id = fw.id
+            LEFT JOIN content.filmworks_genres fwg ON fwg.filmwork_id = fw.id
+            WHERE fw.id IN ({data_ids_placeholder})
+            {order_by};
+            '''
+
+    def _filmwork_rows_query(self, fw_ids_count: int, ordered: bool = False) -> str:
+        data_ids_placeholder = ', '.join(['%s']*fw_ids_count)
+        order_by = 'ORDER BY fw.id' if ordered else ''
+        clock = 'transaction_timestamp()' if ordered else 'statement_timestamp()'
+
+        return f'''
+            SELECT
+            fw.id as fw_id, 
+            fw.title, 
+            fw.description, 
+            fw.rating as imdb_rating, 
+            fw.type, 
+            fw.created, 
+            fw.modified, 
+            {SNAPSHOT_VERSION_SQL.format(clock=clock)} as version,
+            {DOC_CHECKSUM_SQL.format(alias="fw")} as checksum,
+            fwp.role, 
+            p.id as person_id, 
+            p.first_name as full_name,
+            g.name as genre
+            FROM content.filmwork fw
+            LEFT JOIN content.filmworks_persons fwp ON fwp.filmwork_id = fw.id
+            LEFT JOIN content.person p ON p.id = fwp.person_id
+            LEFT JOIN content.filmworks_genres fwg ON fwg.filmwork_id = fw.id
+            LEFT JOIN content.genre g ON g.id = fwg.genre_id
+            WHERE fw.id IN ({data_ids_placeholder})
+            {order_by};
+            '''
+
+    def _resolve_link_rows(self, rows: List[dict]) -> List[FilmworkRow]:
+        """
+        Дополняет строки связей именами персон и жанров из кеша справочников
+        """
+        persons = self.resolve_persons(list({row['person_id'] for row in rows if row['person_id']}))
+        genres = self.resolve_genres(list({row['genre_id'] for row in rows if row['genre_id']}))
+
+        return build_models(FilmworkRow, (
+            {
+                **row,
+                'full_name': persons.get(row['person_id']),
+                'genre': genres.get(row['genre_id'])
+            }
+            for row in rows
+        ))
+
+    def fetch_filmwork_link_rows(self, modified_fw_ids: List[uuid.UUID]) -> List[FilmworkRow]:
+        """
+        Выбирает фильмы только со связями на персон и жанры, имена берутся из кеша справочников
+        """
+        query = self._filmwork_link_rows_query(len(modified_fw_ids))
+        rows = self.bulk_db_handler.execute_query(query, tuple(modified_fw_ids))
+
+        return self._resolve_link_rows(rows)
+
+    def fetch_filmwork_rows(self, modified_fw_ids: List[uuid.UUID]) -> List[FilmworkRow]:
+        if settings.dimension_cache_enabled:
+            return self.fetch_filmwork_link_rows(modified_fw_ids)
+
+        query = self._filmwork_rows_query(len(modified_fw_ids))
+        params = tuple(modified_fw_ids)
+        
+        return build_models(
+            FilmworkRow, self.bulk_db_handler.execute_query(query, params)
+        )
+
+    def iter_filmwork_rows(self, modified_fw_ids: List[uuid.UUID]) -> Iterator[FilmworkRow]:
+        """
+        Потоково выдает строки фильмов, упорядоченные по id фильма
+        """
+        if settings.dimension_cache_enabled:
+            query = self._filmwork_link_rows_query(len(modified_fw_ids), ordered=True)
+        else:
+            query = self._filmwork_rows_query(len(modified_fw_ids), ordered=True)
+
+        for rows in self.bulk_db_handler.iter_query(query, tuple(modified_fw_ids), settings.stream_itersize):
+            if settings.dimension_cache_enabled:
+                yield from self._resolve_link_rows(rows)
+            else:
+                yield from build_models(FilmworkRow, rows)
+
+    @staticmethod
+    def _row_size(fw_row: FilmworkRow) -> int:
+        """
+        Грубая оценка памяти под строку: длина ее текстовых полей
+        """
+        return sum(
+            len(value) for value in (fw_row.title, fw_row.description, fw_row.full_name, fw_row.genre)
+            if value
+        )
+
+    def iter_document_batches(self, fw_rows: Iterator[FilmworkRow]) -> Iterator[List[dict]]:
+        """
+        Собирает документы из строк, упорядоченных по id фильма.
+        Документ готов, как только начинаются строки следующего фильма, а пачка
+        готовых документов отправляется дальше при достижении data_sql_limit
+        документов или stream_buffer_max_bytes оценочного объема.
+        """
+        batch, batch_bytes = [], 0
+        group, group_bytes = [], 0
+
+        for fw_row in fw_rows:
+            if group and group[-1].fw_id != fw_row.fw_id:
+                batch.extend(self.build_documents(group))
+                batch_bytes += group_bytes
+                group, group_bytes = [], 0
+
+                if len(batch) >= settings.data_sql_limit or batch_bytes >= settings.stream_buffer_max_bytes:
+                    yield batch
+                    batch, batch_bytes = [], 0
+
+            group.append(fw_row)
+            group_bytes += self._row_size(fw_row)
+
+        if group:
+            batch.extend(self.build_documents(group))
+
+        if batch:
+            yield batch
+
+    def build_documents(self, fw_rows: List[FilmworkRow]) -> List[dict]:
+        filmworks = {}
+        versions = {}
+        
+        for fw_row in fw_rows:
+            esfilmwork = self.get_or_create_esfilmwork(fw_row, filmworks)
+            self.update_esfilmwork_info(esfilmwork, fw_row)
+            versions[esfilmwork.id] = fw_row.version
+        
+        # версия документа - время снимка БД: документ из более старого снимка ES отклонит
+        return [
+            {**es_fw.dict(), '_version': versions[es_fw.id]} for es_fw in filmworks.values()
+        ]
+
+    @staticmethod
+    def build_suggestion(document: dict) -> dict:
+        """
+        Подсказка автодополнения по названию фильма, вес - рейтинг
+        """
+        return {
+            '_index': settings.es_suggest_index,
+            '_version': document['_version'],
+            'id': document['id'],
+            'type': 'film',
+            'title': document['title'],
+            'suggest': {
+                'input': suggest_inputs(document['title']),
+                'weight': max(int((document['imdb_rating'] or 0) * 10), 0),
+            },
+        }
+
+    @staticmethod
+    def build_suggestions(data: List[dict]) -> List[dict]:
+        """
+        Подсказки для индексируемых документов фильмов пачки.
+        Документы других индексов (_index) и удаления (_op) пропускаются
+        """
+        return [
+            ETLBase.build_suggestion(row) for row in data
+            if '_index' not in row and row.get('_op', 'index') == 'index' and row.get('title')
+        ]
+
+    def upload(self, data: List[dict]):
+        """
+        Загружает пачку в ES, а при включенном журнале только сохраняет ее на диск:
+        в ES ее перенесет drain_spool.py, а состояние продвигается сразу после записи
+        """
+        deleted_fw_ids, tombstone_seq = self.pop_deleted_fw_ids()
+        if settings.suggest_enabled:
+            # подсказки не входят в пачки документов, чтобы не искажать их размер и метрики
+            data = data + self.build_suggestions(data)
+
+        if data or deleted_fw_ids:
+            if self.spool is not None:
+                self.spool.append(self.es_handler.get_bulk_body(data, deleted_fw_ids))
+            else:
+                self.es_handler.upload_data(data, deleted_fw_ids)
+
+        # seq сохраняет только загрузчик, который отправил эти удаления, и только после успеха
+        self.commit_tombstones(tombstone_seq)
+        metrics.dump()
+
+    def run_pipeline(self):
+        """
+        Запускает ETL в режиме конвейера: чтение из Postgres, сборка документов
+        и загрузка в ES для соседних пачек идут одновременно.
+        Время последнего изменения сохраняется только после успешной загрузки всех пачек.
+        """
+        stages = []
+        if self.entry_name != EntryName.filmwork:
+            stages.append(
+                Stage('enricher', self.iter_modified_fw_ids, workers=settings.pipeline_enricher_workers)
+            )
+        if settings.stream_transform:
+            # в потоковом режиме чтение строк и сборка документов идут в одной стадии
+            stages.append(
+                Stage(
+                    'merger',
+                    lambda fw_ids: self.iter_document_batches(self.iter_filmwork_rows(fw_ids)),
+                    workers=settings.pipeline_merger_workers
+                )
+            )
+        else:
+            stages.extend([
+                Stage(
+                    'merger',
+                    lambda fw_ids: [self.fetch_filmwork_rows(fw_ids)],
+                    workers=settings.pipeline_merger_workers
+                ),
+                Stage(
+                    'transformer',
+                    lambda fw_rows: [self.build_documents(fw_rows)],
+                    workers=settings.pipeline_transformer_workers
+                ),
+            ])
+        stages.append(Stage('loader', self.upload, workers=settings.pipeline_loader_workers))
+
+        checkpoint = {}
+
+        def source() -> Iterator[List[uuid.UUID]]:
+            updated_at = self.get_last_updated_at(self.entry_name)
+            
+            while result := self.fetch_modified(updated_at):
+                logger.debug(f'Fetched %s modified {self.entry_name}', len(result))
+                updated_at = checkpoint['updated_at'] = result[-1].modified.isoformat()
+                yield [data.id for data in result]
+
+        Pipeline(stages, queue_size=settings.pipeline_queue_size).run(source())
+
+        if 'updated_at' in checkpoint:
+            self.set_last_updated_at(self.entry_name, checkpoint['updated_at'])
+        else:
+            logger.info(f'No updated %s found', self.entry_name)
+        
+        self.flush_deleted()
+
+    def producer(self, target: Coroutine[None, None, None]):
+        updated_at = self.get_last_updated_at(self.entry_name)
+        
+        while True:
+            result = self.fetch_modified(updated_at)
             
             modified_data_ids = [data.id for data in result]
             logger.debug(
@@ -149,89 +731,369 @@ class ETLBase:
     @coroutine
     def enricher(self, target: Coroutine[None, List[uuid.UUID], None]) -> Coroutine:
         while modified_data_ids := (yield):
-            data_ids_placeholder = ', '.join(['%s']*len(modified_data_ids))
-            updated_at = self.get_last_updated_at(EntryName.filmwork.value)
-            
-            fw_m2m_predicate = ''
-            if self.entry_name != EntryName.filmwork.value:
-                fw_m2m_predicate = f'AND mtm.{self.entry_name}_id IN ({data_ids_placeholder})'
-            
-            m2m_table_name = self.fw_m2m_tables[self.entry_name]
-            
-            while True:
-                query = f'''
-                    SELECT fw.id, fw.modified
-                    FROM content.filmwork fw
-                    LEFT JOIN content.{m2m_table_name} mtm ON mtm.filmwork_id = fw.id
-                    WHERE fw.modified > %s {fw_m2m_predicate}
-                    ORDER BY fw.modified
-                    LIMIT {settings.data_sql_limit};
-                '''
-                params = (updated_at, *modified_data_ids)
-                result = [
-                    FilmworkId(**row) for row in self.db_handler.execute_query(query, params)
-                ]
-
-                modified_fw_ids = [fw_id.id for fw_id in result]
-
-                if not modified_fw_ids:
-                    break
-                
-                updated_at = result[-1].modified
+            for modified_fw_ids in self.iter_modified_fw_ids(modified_data_ids):
                 target.send(modified_fw_ids)
     
-    
     @coroutine
     def merger(self, target: Coroutine[None, List[uuid.UUID], None]) -> Coroutine:
         while modified_fw_ids := (yield):
-            data_ids_placeholder = ', '.join(['%s']*len(modified_fw_ids))
-            query = f'''
-                SELECT
-                fw.id as fw_id, 
-                fw.title, 
-                fw.description, 
-                fw.rating as imdb_rating, 
-                fw.type, 
-                fw.created, 
-                fw.modified, 
-                fwp.role, 
-                p.id as person_id, 
-                p.first_name as full_name,
-                g.name as genre
-                FROM content.filmwork fw
-                LEFT JOIN content.filmworks_persons fwp ON fwp.filmwork_id = fw.id
-                LEFT JOIN content.person p ON p.id = fwp.person_id
-                LEFT JOIN content.filmworks_genres fwg ON fwg.filmwork_id = fw.id
-                LEFT JOIN content.genre g ON g.id = fwg.genre_id
-                WHERE fw.id IN ({data_ids_placeholder});
-                '''
-            params = tuple(modified_fw_ids)
-            result = [
-                FilmworkRow(**row) for row in self.db_handler.execute_query(query, params)
-            ]
-
-            target.send(result)
+            if settings.stream_transform:
+                # строки читаются лениво по мере сборки документов в transformer
+                target.send(self.iter_filmwork_rows(modified_fw_ids))
+            else:
+                target.send(self.fetch_filmwork_rows(modified_fw_ids))
             
     @coroutine
     def transformer(self, target: Coroutine[None, List[uuid.UUID], None]) -> Coroutine:
-        while fw_rows := (yield):
-            self.filmworks = {}
-            
-            for fw_row in fw_rows:
-                esfilmwork = self.get_or_create_esfilmwork(fw_row)
-                updated_filmwork = self.update_esfilmwork_info(esfilmwork, fw_row)
-                
-                self.filmworks[fw_row.fw_id] = updated_filmwork
-            
-            es_entries = [es_fw.dict() for es_fw in self.filmworks.values()]
+        while True:
+            fw_rows = (yield)
+            # пустая пачка (например, фильмы уже удалены) не завершает конвейер
+            if not fw_rows:
+                continue
 
-            target.send(es_entries)
+            if settings.stream_transform:
+                for es_entries in self.iter_document_batches(fw_rows):
+                    target.send(es_entries)
+            else:
+                target.send(self.build_documents(fw_rows))
 
     @coroutine
     def loader(self) -> Coroutine:
-        while data := (yield):
-            self.es_handler.upload_data(data)
+        while True:
+            data = (yield)
+            if not data:
+                continue
+
+            self.upload(data)
+
+    def fold_genre_stats(self):
+        """
+        Сворачивает журнал изменений content.genre_stats_delta в статистику жанров
+        """
+        query = 'SELECT content.fold_genre_stats(%s) as folded;'
+
+        while True:
+            folded = self.db_handler.execute_query(query, (self.batch_limit,))[0]['folded']
+            self.db_handler.commit()
+            logger.debug('Folded %s genre stats deltas', folded)
+
+            if not folded:
+                break
+
+    def fetch_genre_stats_changes(self, version: int, genre_id: str) -> List[dict]:
+        query = f'''
+            SELECT g.id, g.name, s.films_count, s.rated_count, s.rating_sum, s.histogram, s.top_films, s.version
+            FROM content.genre_stats s
+            JOIN content.genre g ON g.id = s.genre_id
+            WHERE (s.version, s.genre_id) > (%s, %s::uuid)
+            ORDER BY s.version, s.genre_id
+            LIMIT %s;
+        '''
+
+        return self.fetch_changes(query, (version, genre_id, self.batch_limit))
+
+    @staticmethod
+    def build_genre_document(genre_id: Any, name: str, stats: Optional[dict]) -> dict:
+        """
+        Частичное обновление документа жанра: имя и статистика. Гистограмма в том же виде,
+        что buckets агрегации histogram по imdb_rating с шагом 1, поэтому странице жанра
+        хватает чтения документа
+        """
+        document = {'_op': 'update', '_index': settings.es_genres_index, 'id': str(genre_id), 'title': name}
+        if not settings.genre_stats:
+            return document
+
+        stats = stats or EMPTY_GENRE_STATS
+        document.update({
+            'films_count': stats['films_count'],
+            'imdb_rating_avg': (
+                float(stats['rating_sum']) / stats['rated_count'] if stats['rated_count'] else None
+            ),
+            'imdb_rating_histogram': [
+                {'key': float(key), 'doc_count': doc_count} for key, doc_count in enumerate(stats['histogram'])
+            ],
+            'top_films': stats['top_films'],
+        })
+
+        return document
+
+    def sync_genre_stats(self):
+        """
+        Сворачивает журнал изменений статистики (sql/genre_stats.sql) и переносит
+        в индекс genres жанры, статистика которых получила новую версию.
+        Версии выдает свертка под advisory-локом, поэтому курсор по ним не пропускает строк
+        """
+        self.fold_genre_stats()
+
+        version, genre_id = self.state_handler.get_state('genre_stats_position') or [0, str(uuid.UUID(int=0))]
+
+        while result := self.fetch_genre_stats_changes(version, genre_id):
+            logger.debug('Fetched %s modified genre stats', len(result))
+            self.upload([self.build_genre_document(row['id'], row['name'], row) for row in result])
+
+            version, genre_id = result[-1]['version'], str(result[-1]['id'])
+            self.state_handler.set_state('genre_stats_position', [version, genre_id])
+            
+
+class FanOutETL(ETLBase):
+    """
+    Одна выборка изменений наполняет сразу индексы фильмов, персон и жанров.
+    Строки измененных персон и жанров читаются вместе с именами: из них строятся
+    документы своих индексов и заполняется кеш справочников для сборки фильмов.
+    Документы разных индексов уходят в ES общими bulk-запросами.
+    В индексы персон и жанров пишет и ETL схемы cinema (postgres_to_es_refactored),
+    поэтому их документы только частично обновляются полями, которые ведет этот ETL:
+    имя, а у жанров еще статистика. Остальные поля документа не затираются.
+    """
+
+    def __init__(self):
+        super().__init__(EntryName.filmwork.value)
+
+        self.dimension_props = {
+            EntryName.genre: {
+                'props': 'id, name, modified',
+                'dataclass': GenreName,
+                'name_field': 'name',
+                'index': self.dimension_indices[EntryName.genre],
+                'cache': genre_cache,
+            },
+            EntryName.person: {
+                'props': 'id, first_name as full_name, modified',
+                'dataclass': PersonName,
+                'name_field': 'full_name',
+                'index': self.dimension_indices[EntryName.person],
+                'cache': person_cache,
+            },
+        }
+
+    def fetch_dimension_changes(self, entry_name: EntryName, updated_at: dt.datetime) -> List[Any]:
+        props = self.dimension_props[entry_name]
+        query = f'''
+            SELECT {props['props']}
+            FROM content.{entry_name.value}
+            WHERE modified > %s
+            ORDER BY modified
+            LIMIT %s;
+        '''
+        result = build_models(
+            props['dataclass'], self.fetch_changes(query, (updated_at, self.batch_limit))
+        )
+
+        for row in result:
+            props['cache'].put(row.id, row.modified, getattr(row, props['name_field']))
+
+        return result
+
+    def fetch_genre_stats(self, genre_ids: List[uuid.UUID]) -> Dict[str, dict]:
+        query = '''
+            SELECT genre_id, films_count, rated_count, rating_sum, histogram, top_films
+            FROM content.genre_stats
+            WHERE genre_id IN %s;
+        '''
+        rows = self.db_handler.execute_query(query, (tuple(str(id) for id in genre_ids),))
+
+        return {str(row['genre_id']): row for row in rows}
+
+    def build_dimension_documents(self, entry_name: EntryName, rows: List[Any]) -> List[dict]:
+        index = self.dimension_props[entry_name]['index']
+
+        if entry_name == EntryName.genre:
+            stats = self.fetch_genre_stats([row.id for row in rows]) if settings.genre_stats and rows else {}
+            return [self.build_genre_document(row.id, row.name, stats.get(str(row.id))) for row in rows]
+
+        return [{'_op': 'update', '_index': index, 'id': str(row.id), 'full_name': row.full_name} for row in rows]
+
+    def run(self):
+        for entry_name in self.dimension_props:
+            updated_at = self.get_last_updated_at(entry_name.value)
+
+            while result := self.fetch_dimension_changes(entry_name, updated_at):
+                logger.debug(f'Fetched %s modified {entry_name.value}', len(result))
+                
+                # документы справочника уходят вместе с первой пачкой фильмов
+                documents = self.build_dimension_documents(entry_name, result)
+                for fw_ids in self.iter_modified_fw_ids([row.id for row in result], entry_name):
+                    self.upload(documents + self.build_documents(self.fetch_filmwork_rows(fw_ids)))
+                    documents = []
+                self.upload(documents)
+
+                updated_at = result[-1].modified.isoformat()
+                self.set_last_updated_at(entry_name.value, updated_at)
+
+        if settings.genre_stats:
+            self.sync_genre_stats()
+
+        updated_at = self.get_last_updated_at(self.entry_name)
+        while result := self.fetch_modified(updated_at):
+            self.upload(self.build_documents(self.fetch_filmwork_rows([row.id for row in result])))
+
+            updated_at = result[-1].modified.isoformat()
+            self.set_last_updated_at(self.entry_name, updated_at)
+
+        self.flush_deleted()
+
+
+class PriorityETL(FanOutETL):
+    """
+    Разводит работу по полосам приоритета: измененные фильмы идут в полосу live
+    с маленькими пачками, а фильмы измененных персон и жанров - в полосу bulk.
+    Изменения фильмов опрашиваются все время, пока разбирается bulk, поэтому
+    правка фильма попадает в ES за секунды даже во время большой переиндексации.
+    """
+
+    def process_batch(self, fw_ids: List[uuid.UUID]):
+        self.upload(self.build_documents(self.fetch_filmwork_rows(fw_ids)))
+
+    def feed_bulk(self, scheduler: LaneScheduler, checkpoints: Dict[EntryName, str]):
+        """
+        Отправляет в полосу bulk фильмы измененных персон и жанров
+        """
+        try:
+            for entry_name in self.dimension_props:
+                updated_at = self.get_last_updated_at(entry_name.value)
+
+                while result := self.fetch_dimension_changes(entry_name, updated_at):
+                    self.upload(self.build_dimension_documents(entry_name, result))
+                    for fw_ids in self.iter_modified_fw_ids([row.id for row in result], entry_name):
+                        scheduler.submit('bulk', fw_ids)
+
+                    updated_at = checkpoints[entry_name] = result[-1].modified.isoformat()
+
+                    if scheduler.failed:
+                        return
+        except BaseException as exc:
+            scheduler.abort(exc)
+
+    def feed_live(self, scheduler: LaneScheduler, bulk_feeder: threading.Thread) -> Optional[str]:
+        """
+        Опрашивает изменения фильмов, пока не разобрана полоса bulk.
+        Время изменения сохраняется, когда все отправленные пачки live обработаны
+        """
+        updated_at = saved_updated_at = self.get_last_updated_at(self.entry_name)
+
+        while not scheduler.failed:
+            result = self.fetch_modified(updated_at)
+            if result:
+                scheduler.submit('live', [row.id for row in result])
+                updated_at = result[-1].modified.isoformat()
+
+            if updated_at != saved_updated_at and not scheduler.pending('live'):
+                self.set_last_updated_at(self.entry_name, updated_at)
+                saved_updated_at = updated_at
+
+            if result:
+                continue
+
+            if not bulk_feeder.is_alive() and not scheduler.pending('bulk'):
+                break
+            time.sleep(settings.priority_live_poll_interval)
+
+        return updated_at
+
+    def run(self):
+        scheduler = LaneScheduler(
+            self.process_batch,
+            [
+                Lane('live', settings.priority_live_batch_size, settings.priority_live_workers),
+                Lane(
+                    'bulk', settings.data_sql_limit, settings.priority_bulk_workers,
+                    max_queued=settings.priority_bulk_max_queued
+                ),
+            ],
+            target_latency=settings.priority_live_target_latency
+        )
+        scheduler.start()
+
+        checkpoints = {}
+        bulk_feeder = threading.Thread(
+            target=self.feed_bulk, args=(scheduler, checkpoints), name='lane-bulk-feeder', daemon=True
+        )
+        bulk_feeder.start()
+
+        try:
+            updated_at = self.feed_live(scheduler, bulk_feeder)
+        except BaseException as exc:
+            scheduler.abort(exc)
+            raise
+        finally:
+            scheduler.close()
+            bulk_feeder.join()
+
+        scheduler.join()
+
+        # все пачки обработаны: время изменений можно сохранить
+        for entry_name, dimension_updated_at in checkpoints.items():
+            self.set_last_updated_at(entry_name.value, dimension_updated_at)
+        self.set_last_updated_at(self.entry_name, updated_at)
+
+        if settings.genre_stats:
+            self.sync_genre_stats()
+
+        self.flush_deleted()
+
+
+class SearchDocETL(ETLBase):
+    """
+    Переносит в ES готовые документы из content.filmwork_search_doc (sql/filmwork_search_doc.sql).
+    Документы собирает сама БД при изменениях, ETL только читает изменившиеся
+    строки по (version, filmwork_id) и передает JSON в bulk без разбора.
+    """
+
+    def __init__(self):
+        super().__init__(EntryName.filmwork.value)
+
+    def refresh_search_docs(self):
+        """
+        Обрабатывает очередь пересборки документов, если ее не выполняет планировщик БД
+        """
+        query = 'SELECT content.refresh_filmwork_search_docs(%s) as refreshed;'
+        
+        while True:
+            refreshed = self.db_handler.execute_query(query, (self.batch_limit,))[0]['refreshed']
+            self.db_handler.commit()
+            logger.debug('Refreshed %s search documents', refreshed)
             
+            if not refreshed:
+                break
+
+    def fetch_search_docs(self, version: int, fw_id: str) -> List[dict]:
+        query = f'''
+            SELECT
+                filmwork_id as id, doc::text as doc, version,
+                doc->>'title' as title, (doc->>'imdb_rating')::float as imdb_rating
+            FROM content.filmwork_search_doc
+            WHERE (version, filmwork_id) > (%s, %s::uuid)
+            ORDER BY version, filmwork_id
+            LIMIT %s;
+        '''
+        
+        return self.db_handler.execute_query(query, (version, fw_id, self.batch_limit))
+
+    def run(self):
+        if settings.search_doc_refresh:
+            self.refresh_search_docs()
+
+        version, fw_id = self.state_handler.get_state('search_doc_position') or [0, str(uuid.UUID(int=0))]
+
+        while result := self.fetch_search_docs(version, fw_id):
+            logger.debug('Fetched %s search documents', len(result))
+            # название и рейтинг не уходят в индекс фильмов (там _raw), по ним строятся подсказки
+            self.upload([
+                {
+                    'id': str(row['id']),
+                    '_version': row['version'],
+                    '_raw': row['doc'],
+                    'title': row['title'],
+                    'imdb_rating': row['imdb_rating'],
+                }
+                for row in result
+            ])
+
+            version, fw_id = result[-1]['version'], str(result[-1]['id'])
+            self.state_handler.set_state('search_doc_position', [version, fw_id])
+
+        self.flush_deleted()
+
 
 class ETLOnGenreChanged(ETLBase):
     def producer(self, target: Coroutine[None, List[uuid.UUID], None]):
@@ -243,12 +1105,13 @@ class ETLOnGenreChanged(ETLBase):
                 FROM content.genre
                 WHERE modified > %s
                 ORDER BY modified
-                LIMIT {settings.data_sql_limit};
+                LIMIT %s;
             '''
-            params = (genres_updated_at,)
-            result = [
-                Genre(**row) for row in self.db_handler.execute_query(query, params)
-            ]
+            params = (genres_updated_at, self.batch_limit)
+            result = build_models(
+                Genre, self.fetch_changes(query, params)
+            )
+            genre_cache.invalidate(result)
             
             modified_genres_ids = [genre_id.id for genre_id in result]
             logger.debug(f'Fetched %s modified genres', len(modified_genres_ids))
@@ -275,12 +1138,12 @@ class ETLOnGenreChanged(ETLBase):
                     LEFT JOIN content.filmworks_genres fwg ON fwg.filmwork_id = fw.id
                     WHERE fw.modified > %s AND fwg.genre_id IN ({data_ids_placeholder})
                     ORDER BY fw.modified
-                    LIMIT {settings.data_sql_limit};
+                    LIMIT %s;
                 '''
-                params = (updated_at, *modified_data_ids)
-                result = [
-                    FilmworkId(**row) for row in self.db_handler.execute_query(query, params)
-                ]
+                params = (updated_at, *modified_data_ids, self.batch_limit)
+                result = build_models(
+                    FilmworkId, self.fetch_changes(query, params)
+                )
 
                 modified_fw_ids = [fw_id.id for fw_id in result]
 
@@ -301,12 +1164,13 @@ class ETLOnPersonChanged(ETLBase):
                 FROM content.person
                 WHERE modified > %s
                 ORDER BY modified
-                LIMIT {settings.data_sql_limit};
+                LIMIT %s;
             '''
-            params = (persons_updated_at,)
-            result = [
-                Person(**row) for row in self.db_handler.execute_query(query, params)
-            ]
+            params = (persons_updated_at, self.batch_limit)
+            result = build_models(
+                Person, self.fetch_changes(query, params)
+            )
+            person_cache.invalidate(result)
             
             modified_persons_ids = [genre_id.id for genre_id in result]
             logger.debug(f'Fetched %s modified persons', len(modified_persons_ids))
@@ -333,12 +1197,12 @@ class ETLOnPersonChanged(ETLBase):
                     LEFT JOIN content.filmworks_persons fwp ON fwp.filmwork_id = fw.id
                     WHERE fw.modified > %s AND fwp.person_id IN ({data_ids_placeholder})
                     ORDER BY fw.modified
-                    LIMIT {settings.data_sql_limit};
+                    LIMIT %s;
                 '''
-                params = (updated_at, *modified_data_ids)
-                result = [
-                    FilmworkId(**row) for row in self.db_handler.execute_query(query, params)
-                ]
+                params = (updated_at, *modified_data_ids, self.batch_limit)
+                result = build_models(
+                    FilmworkId, self.fetch_changes(query, params)
+                )
 
                 modified_fw_ids = [fw_id.id for fw_id in result]
 
@@ -365,12 +1229,12 @@ class ETLOnFilmworkChanged(ETLBase):
                     FROM content.filmwork fw
                     WHERE fw.modifies > %s
                     ORDER BY fw.modified
-                    LIMIT {settings.data_sql_limit};
+                    LIMIT %s;
                 '''
-                params = (fw_updated_at, *modified_data_ids)
-                result = [
-                    FilmworkId(**row) for row in self.db_handler.execute_query(query, params)
-                ]
+                params = (fw_updated_at, *modified_data_ids, self.batch_limit)
+                result = build_models(
+                    FilmworkId, self.fetch_changes(query, params)
+                )
 
                 modified_fw_ids = [fw_id.id for fw_id in result]
 
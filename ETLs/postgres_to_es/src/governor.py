@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from typing import Optional, Tuple
+
+import psycopg2
+from psycopg2.extensions import AsIs, register_adapter
+
+from .config import settings
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Дешевые сигналы нагрузки: активные клиентские сессии и наибольшее отставание реплик.
+# replay_lag виден ролям с pg_monitor, без нее отставание считается нулевым
+SIGNALS_SQL = '''
+    SELECT
+        (
+            SELECT count(*)
+            FROM pg_stat_activity
+            WHERE state = 'active' AND backend_type = 'client backend' AND pid <> pg_backend_pid()
+        ) as active_sessions,
+        (
+            SELECT COALESCE(extract(epoch from max(replay_lag)), 0)
+            FROM pg_stat_replication
+        ) as replica_lag;
+'''
+
+
+def session_options() -> dict:
+    """
+    Параметры соединений ETL: свое имя в pg_stat_activity и таймауты, чтобы запрос ETL
+    не ждал блокировок OLTP-транзакций и не выполнялся бесконечно
+    """
+    return {
+        'application_name': settings.pg_application_name,
+        'options': (
+            f'-c statement_timeout={settings.pg_statement_timeout_ms} '
+            f'-c lock_timeout={settings.pg_lock_timeout_ms}'
+        ),
+    }
+
+
+class PgGovernor:
+    """
+    Не дает ETL перегрузить Postgres. Перед запросами ETL, не чаще раза в interval секунд,
+    снимает сигналы: время пробного запроса, число активных сессий и отставание реплик.
+    Пока хоть один сигнал выходит за бюджет, все запросы ETL ждут с растущей паузой,
+    а доля пачки от data_sql_limit уменьшается в decrease_factor раз. В пределах
+    бюджета доля восстанавливается на increase_step за замер. Дольше max_wait секунд
+    ETL не ждет: например, если пробный запрос не проходит из-за самого ограничителя,
+    запросы продолжаются уменьшенными пачками под statement_timeout.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        interval: float = 1.0,
+        max_latency_ms: float = 50.0,
+        max_active_sessions: int = 20,
+        max_replica_lag: float = 10.0,
+        max_pause: float = 30.0,
+        max_wait: float = 300.0,
+        decrease_factor: float = 0.5,
+        increase_step: float = 0.1,
+        min_scale: float = 0.05,
+    ):
+        self.enabled = enabled
+        self.interval = interval
+        self.max_latency_ms = max_latency_ms
+        self.max_active_sessions = max_active_sessions
+        self.max_replica_lag = max_replica_lag
+        self.max_pause = max_pause
+        self.max_wait = max_wait
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.min_scale = min_scale
+
+        self.scale = 1.0
+        self._sampled_at = 0.0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            **settings.pg_dsn.dict(),
+            application_name=f'{settings.pg_application_name}_governor',
+            # пробный запрос дольше бюджета задержки сам по себе признак перегрузки
+            options=f'-c statement_timeout={max(int(self.max_latency_ms * 10), 100)}'
+        )
+        conn.autocommit = True
+
+        return conn
+
+    def sample(self) -> Tuple[float, int, float]:
+        """
+        Задержка пробного запроса (мс), активные сессии и отставание реплик (с)
+        """
+        if self._conn is None:
+            self._conn = self._connect()
+
+        started = time.monotonic()
+        with self._conn.cursor() as cur:
+            cur.execute(SIGNALS_SQL)
+            active_sessions, replica_lag = cur.fetchone()
+        latency_ms = (time.monotonic() - started) * 1000
+
+        metrics.set('pg_governor_latency_ms', latency_ms)
+        metrics.set('pg_governor_active_sessions', active_sessions)
+        metrics.set('pg_governor_replica_lag_seconds', float(replica_lag))
+
+        return latency_ms, active_sessions, float(replica_lag)
+
+    def _over_budget(self) -> Optional[str]:
+        try:
+            latency_ms, active_sessions, replica_lag = self.sample()
+        except psycopg2.Error as exc:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            return f'probe failed: {exc}'.strip()
+
+        if latency_ms > self.max_latency_ms:
+            return f'latency {latency_ms:.0f} ms'
+        if active_sessions > self.max_active_sessions:
+            return f'{active_sessions} active sessions'
+        if replica_lag > self.max_replica_lag:
+            return f'replica lag {replica_lag:.1f} s'
+
+        return None
+
+    def _decrease(self):
+        self.scale = max(self.scale * self.decrease_factor, self.min_scale)
+        metrics.set('pg_governor_batch_scale', self.scale)
+
+    def throttle(self):
+        """
+        Вызывается перед каждым запросом ETL и держит его, пока нагрузка вне бюджета
+        """
+        if not self.enabled or time.monotonic() - self._sampled_at < self.interval:
+            return
+
+        with self._lock:
+            if time.monotonic() - self._sampled_at < self.interval:
+                return
+
+            pause = self.interval
+            deadline = time.monotonic() + self.max_wait
+            within_budget = True
+            while reason := self._over_budget():
+                self._decrease()
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    metrics.inc('pg_governor_wait_timeouts_total')
+                    logger.error(
+                        'Postgres is over budget (%s) for %.0f s: continue with batch scale %.2f',
+                        reason, self.max_wait, self.scale
+                    )
+                    within_budget = False
+                    break
+
+                metrics.inc('pg_governor_pauses_total')
+                logger.warning(
+                    'Postgres is over budget (%s): pause %.1f s, batch scale %.2f', reason, pause, self.scale
+                )
+                time.sleep(min(pause, left))
+                pause = min(pause * 2, self.max_pause)
+
+            if within_budget:
+                self.scale = min(self.scale + self.increase_step, 1.0)
+                metrics.set('pg_governor_batch_scale', self.scale)
+            self._sampled_at = time.monotonic()
+
+    def on_timeout(self):
+        """
+        Запрос ETL прерван statement_timeout или lock_timeout: пачка тяжела для текущей нагрузки
+        """
+        metrics.inc('pg_governor_timeouts_total')
+
+        with self._lock:
+            self._decrease()
+
+    def batch_size(self, limit: int) -> int:
+        if not self.enabled:
+            return limit
+
+        return max(int(limit * self.scale), 1)
+
+
+pg_governor = PgGovernor(
+    enabled=settings.pg_governor_enabled,
+    interval=settings.pg_governor_interval,
+    max_latency_ms=settings.pg_governor_max_latency_ms,
+    max_active_sessions=settings.pg_governor_max_active_sessions,
+    max_replica_lag=settings.pg_governor_max_replica_lag,
+    max_pause=settings.pg_governor_max_pause,
+    max_wait=settings.pg_governor_max_wait,
+    decrease_factor=settings.pg_governor_decrease_factor,
+    increase_step=settings.pg_governor_increase_step,
+)
+
+
+class BatchLimit:
+    """
+    LIMIT пачки в параметрах запроса. Число берется у ограничителя при каждом выполнении
+    запроса, поэтому повтор после statement_timeout идет уже с уменьшенной пачкой
+    """
+
+    def __init__(self, limit: int, governor: PgGovernor = pg_governor):
+        self.limit = limit
+        self.governor = governor
+
+    def __int__(self) -> int:
+        return self.governor.batch_size(self.limit)
+
+    def __repr__(self) -> str:
+        return f'BatchLimit({int(self)})'
+
+
+register_adapter(BatchLimit, lambda batch_limit: AsIs(int(batch_limit)))
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Lane:
+    """
+    Очередь пачек id одного приоритета со своим размером пачки и числом воркеров.
+    Если задан max_queued, submit ждет, пока в очереди не освободится место
+    """
+
+    def __init__(self, name: str, batch_size: int, workers: int, max_queued: int = 0):
+        self.name = name
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_queued = max_queued
+
+        # (время постановки в очередь, пачка id)
+        self.batches: Deque[Tuple[float, List[Any]]] = deque()
+        # пачки в очереди и в обработке
+        self.pending = 0
+
+
+class LaneScheduler:
+    """
+    Обрабатывает пачки id из нескольких полос, перечисленных по убыванию приоритета.
+    У каждой полосы свои воркеры, а воркер младшей полосы сначала забирает пачку
+    старшей полосы, если она ждет дольше target_latency. Поэтому правки редакторов
+    не стоят в очереди за тысячами пачек фоновой переиндексации.
+    Первая ошибка останавливает воркеров и пробрасывается из join().
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[Any]], None],
+        lanes: List[Lane],
+        target_latency: float,
+        poll_interval: float = 0.1
+    ):
+        self.process = process
+        self.lanes = lanes
+        self.target_latency = target_latency
+        self.poll_interval = poll_interval
+
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._threads: List[threading.Thread] = []
+
+    def _lane(self, name: str) -> Lane:
+        return next(lane for lane in self.lanes if lane.name == name)
+
+    @property
+    def failed(self) -> bool:
+        return self._error is not None
+
+    def start(self):
+        for lane in self.lanes:
+            self._threads.extend(
+                threading.Thread(
+                    target=self._work, args=(lane,), name=f'lane-{lane.name}-{n}', daemon=True
+                )
+                for n in range(lane.workers)
+            )
+
+        for thread in self._threads:
+            thread.start()
+
+    def _full(self, lane: Lane) -> bool:
+        return bool(lane.max_queued) and len(lane.batches) >= lane.max_queued
+
+    def submit(self, lane_name: str, ids: List[Any]):
+        """
+        Ставит id в очередь полосы пачками по batch_size. Пока очередь полна, ждет воркеров,
+        поэтому источник не читает изменения быстрее, чем они обрабатываются.
+        После ошибки воркера пачки не принимаются
+        """
+        lane = self._lane(lane_name)
+
+        with self._cond:
+            for i in range(0, len(ids), lane.batch_size):
+                while self._full(lane) and self._error is None:
+                    self._cond.wait(self.poll_interval)
+                if self._error is not None:
+                    return
+
+                lane.batches.append((time.monotonic(), ids[i:i + lane.batch_size]))
+                lane.pending += 1
+                self._cond.notify_all()
+
+            metrics.set(f'lane_{lane.name}_queued', len(lane.batches))
+
+    def pending(self, lane_name: str) -> int:
+        with self._cond:
+            return self._lane(lane_name).pending
+
+    def abort(self, exc: BaseException):
+        with self._cond:
+            if self._error is None:
+                self._error = exc
+            self._closed = True
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Новых пачек не будет: воркеры завершаются, разобрав свои очереди
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def join(self):
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(self.poll_interval)
+
+        if self._error is not None:
+            logger.error('Lane worker failed: %s', self._error)
+            raise self._error
+
+    def _take(self, own: Lane) -> Optional[Tuple[Lane, float, List[Any]]]:
+        now = time.monotonic()
+
+        for lane in self.lanes:
+            if lane is own:
+                break
+            if lane.batches and now - lane.batches[0][0] >= self.target_latency:
+                return (lane, *lane.batches.popleft())
+
+        if own.batches:
+            return (own, *own.batches.popleft())
+
+        return None
+
+    def _work(self, own: Lane):
+        while True:
+            with self._cond:
+                while (item := self._take(own)) is None:
+                    if self._closed:
+                        return
+                    self._cond.wait(self.poll_interval)
+
+                if self._error is not None:
+                    return
+                # в очереди освободилось место для submit
+                self._cond.notify_all()
+
+            lane, enqueued_at, ids = item
+            metrics.set(f'lane_{lane.name}_wait_seconds', time.monotonic() - enqueued_at)
+
+            try:
+                self.process(ids)
+            except BaseException as exc:
+                self.abort(exc)
+                return
+
+            with self._cond:
+                lane.pending -= 1
+                metrics.inc(f'lane_{lane.name}_batches_total')
+                metrics.set(f'lane_{lane.name}_queued', len(lane.batches))
+                self._cond.notify_all()
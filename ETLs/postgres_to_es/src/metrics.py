@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from .config import settings
+
+
+class Metrics:
+    """
+    Метрики ETL в памяти процесса.
+    Периодически сохраняются в файл в текстовом формате Prometheus
+    (для textfile collector node_exporter), если задан file_path.
+    """
+
+    def __init__(self, file_path: Optional[str] = None, dump_interval: float = 10.0, prefix: str = 'etl_'):
+        self.file_path = file_path
+        self.dump_interval = dump_interval
+        self.prefix = prefix
+
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # dump вызывают параллельные загрузчики: файл пишет один поток за раз
+        self._dump_lock = threading.Lock()
+        self._last_dump = 0.0
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name: str, default: float = 0) -> float:
+        return self._values.get(name, default)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def dump(self, force: bool = False):
+        """
+        Сохраняет метрики в файл не чаще раза в dump_interval секунд
+        """
+        if self.file_path is None:
+            return
+
+        # пока другой поток пишет файл, обычный вызов не ждет: его значения попадут в следующий
+        if not self._dump_lock.acquire(blocking=force):
+            return
+
+        try:
+            now = time.monotonic()
+            if not force and now - self._last_dump < self.dump_interval:
+                return
+            self._last_dump = now
+
+            lines = [f'{self.prefix}{name} {value}' for name, value in sorted(self.snapshot().items())]
+            tmp_path = f'{self.file_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, self.file_path)
+        finally:
+            self._dump_lock.release()
+
+
+metrics = Metrics(settings.metrics_filepath, settings.metrics_dump_interval)
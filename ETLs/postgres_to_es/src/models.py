@@ -1,7 +1,7 @@
 import datetime as dt
 import uuid
 from enum import Enum
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -33,6 +33,18 @@ class Person(BaseModel):
     modified: dt.datetime
 
 
+class GenreName(BaseModel):
+    id: uuid.UUID
+    modified: dt.datetime
+    name: str
+
+
+class PersonName(BaseModel):
+    id: uuid.UUID
+    modified: dt.datetime
+    full_name: str
+
+
 class FilmworkId(BaseModel):
     id: uuid.UUID
     modified: dt.datetime
@@ -46,10 +58,13 @@ class FilmworkRow(BaseModel):
     type: str
     created: dt.datetime
     modified: dt.datetime
-    role: str
-    person_id: uuid.UUID
-    full_name: str
-    genre: str
+    # у фильма без персон или жанров LEFT JOIN дает пустые поля связи
+    role: Optional[str] = None
+    person_id: Optional[uuid.UUID] = None
+    full_name: Optional[str] = None
+    genre: Optional[str] = None
+    version: Optional[int] = None
+    checksum: Optional[int] = None
 
 
 class ESFilmwork(BaseModel):
@@ -63,8 +78,17 @@ class ESFilmwork(BaseModel):
     director: List[str] = []
     actors_names: List[str] = []
     writers_names: List[str] = []
+    etl_checksum: Optional[int] = None
 
 
 class PersonData(BaseModel):
     id: str
     name: str
+
+
+class Tombstone(BaseModel):
+    seq: int
+    entity: EntryName
+    entity_id: uuid.UUID
+    filmwork_ids: List[uuid.UUID] = []
+    deleted_at: dt.datetime
@@ -0,0 +1,159 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Маркер конца потока данных между стадиями
+_STOP = object()
+
+
+class Stage:
+    """
+    Стадия конвейера: func получает элемент из входной очереди и возвращает
+    итерируемое с элементами для следующей стадии (или None для последней стадии)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Optional[Iterable[Any]]],
+        workers: int = 1,
+        queue_size: Optional[int] = None
+    ):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+
+
+class Pipeline:
+    """
+    Конвейер, в котором источник и стадии работают одновременно в отдельных потоках
+    и связаны ограниченными очередями. Заполненная очередь блокирует предыдущую
+    стадию (backpressure), поэтому в памяти одновременно не больше queue_size пачек
+    на каждую стадию. Первая ошибка останавливает все стадии и пробрасывается из run().
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 4, poll_interval: float = 0.1):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._error: Optional[BaseException] = None
+        self._error_stage: Optional[str] = None
+
+    def _fail(self, stage_name: str, exc: BaseException):
+        with self._lock:
+            if self._error is None:
+                self._error, self._error_stage = exc, stage_name
+        self._stopped.set()
+
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stopped.is_set():
+            try:
+                return q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+
+        return _STOP
+
+    def _feed(self, source: Iterable[Any], out_q: queue.Queue, consumers: int):
+        try:
+            for item in source:
+                if not self._put(out_q, item):
+                    return
+        except BaseException as exc:
+            self._fail('source', exc)
+            return
+
+        for _ in range(consumers):
+            self._put(out_q, _STOP)
+
+    def _work(
+        self,
+        stage: Stage,
+        in_q: queue.Queue,
+        out_q: Optional[queue.Queue],
+        consumers: int,
+        finished: List[int]
+    ):
+        try:
+            while (item := self._get(in_q)) is not _STOP:
+                outputs = stage.func(item)
+                if out_q is None or outputs is None:
+                    continue
+
+                for output in outputs:
+                    if not self._put(out_q, output):
+                        return
+        except BaseException as exc:
+            self._fail(stage.name, exc)
+            return
+
+        with self._lock:
+            finished[0] += 1
+            last_worker = finished[0] == stage.workers
+
+        # последний завершившийся воркер закрывает очередь следующей стадии
+        if last_worker and out_q is not None:
+            for _ in range(consumers):
+                self._put(out_q, _STOP)
+
+    def run(self, source: Iterable[Any]):
+        queues = [
+            queue.Queue(maxsize=stage.queue_size or self.queue_size)
+            for stage in self.stages
+        ]
+        threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(source, queues[0], self.stages[0].workers),
+                name='pipeline-source',
+                daemon=True
+            )
+        ]
+
+        for i, stage in enumerate(self.stages):
+            is_last = i == len(self.stages) - 1
+            out_q = None if is_last else queues[i + 1]
+            consumers = 0 if is_last else self.stages[i + 1].workers
+            finished = [0]
+
+            threads.extend(
+                threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], out_q, consumers, finished),
+                    name=f'pipeline-{stage.name}-{n}',
+                    daemon=True
+                )
+                for n in range(stage.workers)
+            )
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(self.poll_interval)
+        except BaseException as exc:
+            self._fail('main', exc)
+            raise
+
+        if self._error is not None:
+            logger.error('Pipeline stage %s failed: %s', self._error_stage, self._error)
+            raise self._error
@@ -0,0 +1,131 @@
+import logging
+import uuid
+from typing import Dict, List, NamedTuple, Tuple
+
+from .config import settings
+from .etl import DOC_CHECKSUM_SQL, ETLBase
+from .metrics import metrics
+from .models import EntryName
+
+logger = logging.getLogger(__name__)
+
+HEX_DIGITS = '0123456789abcdef'
+
+
+def prefix_bounds(prefix: str) -> Tuple[str, str]:
+    """
+    Границы (включительно) диапазона id с общим шестнадцатеричным префиксом.
+    Текстовый вид uuid упорядочен так же, как uuid в PostgreSQL, поэтому
+    одни и те же границы подходят и для БД, и для keyword-поля в ES
+    """
+    return tuple(
+        f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+        for h in (prefix.ljust(32, '0'), prefix.ljust(32, 'f'))
+    )
+
+
+class RangeSummary(NamedTuple):
+    count: int
+    checksum: int
+
+
+class Reconciler:
+    """
+    Сверяет индекс фильмов с БД без полного обхода.
+    Для диапазона id сравниваются число документов и сумма контрольных сумм (id, modified),
+    которые считают сама БД и sum-агрегация ES. Совпавший диапазон пропускается, остальные
+    делятся на 16 поддиапазонов по следующей цифре id, пока не станут меньше reconcile_leaf_size.
+    В таких диапазонах разошедшиеся документы переиндексируются, а лишние удаляются.
+    """
+
+    def __init__(self, dry_run: bool = False):
+        self.etl = ETLBase(EntryName.filmwork.value)
+        self.es_handler = self.etl.es_handler
+        self.id_field = settings.reconcile_id_field
+        self.dry_run = dry_run
+
+    def pg_summary(self, prefix: str) -> RangeSummary:
+        query = f'''
+            SELECT count(*) as count, COALESCE(sum({DOC_CHECKSUM_SQL.format(alias="fw")}), 0) as checksum
+            FROM content.filmwork fw
+            WHERE fw.id BETWEEN %s AND %s;
+        '''
+        row = self.etl.db_handler.execute_query(query, prefix_bounds(prefix))[0]
+
+        return RangeSummary(row['count'], int(row['checksum']))
+
+    def es_summary(self, prefix: str) -> RangeSummary:
+        response = self.es_handler.search({
+            'size': 0,
+            'track_total_hits': True,
+            'query': self._es_range_query(prefix),
+            'aggs': {'checksum': {'sum': {'field': 'etl_checksum'}}},
+        })
+
+        return RangeSummary(
+            response['hits']['total']['value'], int(response['aggregations']['checksum']['value'])
+        )
+
+    def pg_checksums(self, prefix: str) -> Dict[str, int]:
+        query = f'''
+            SELECT fw.id::text as id, {DOC_CHECKSUM_SQL.format(alias="fw")} as checksum
+            FROM content.filmwork fw
+            WHERE fw.id BETWEEN %s AND %s;
+        '''
+        rows = self.etl.db_handler.execute_query(query, prefix_bounds(prefix))
+
+        return {row['id']: row['checksum'] for row in rows}
+
+    def es_checksums(self, prefix: str, size: int) -> Dict[str, int]:
+        response = self.es_handler.search({
+            'size': size,
+            '_source': ['etl_checksum'],
+            'query': self._es_range_query(prefix),
+        })
+
+        return {hit['_id']: hit['_source'].get('etl_checksum') for hit in response['hits']['hits']}
+
+    def _es_range_query(self, prefix: str) -> dict:
+        lo, hi = prefix_bounds(prefix)
+
+        return {'range': {self.id_field: {'gte': lo, 'lte': hi}}}
+
+    def reconcile(self, prefix: str = ''):
+        pg, es = self.pg_summary(prefix), self.es_summary(prefix)
+        metrics.inc('reconcile_ranges_checked_total')
+
+        if pg == es:
+            return
+
+        if max(pg.count, es.count) <= settings.reconcile_leaf_size or len(prefix) == 32:
+            self.repair_range(prefix, es.count)
+            return
+
+        logger.debug('Range %s differs: postgres %s, es %s', prefix or '*', pg, es)
+        for digit in HEX_DIGITS:
+            self.reconcile(prefix + digit)
+
+    def repair_range(self, prefix: str, es_count: int):
+        pg_checksums = self.pg_checksums(prefix)
+        es_checksums = self.es_checksums(prefix, es_count)
+
+        stale = [id for id, checksum in pg_checksums.items() if es_checksums.get(id) != checksum]
+        orphaned = [id for id in es_checksums if id not in pg_checksums]
+
+        logger.info(
+            'Range %s: %s stale or missing, %s orphaned documents', prefix, len(stale), len(orphaned)
+        )
+        metrics.inc('reconcile_stale_total', len(stale))
+        metrics.inc('reconcile_orphaned_total', len(orphaned))
+
+        if not self.dry_run:
+            self.reindex(stale)
+            if orphaned:
+                self.es_handler.upload_data([], orphaned)
+
+    def reindex(self, ids: List[str]):
+        for i in range(0, len(ids), settings.data_sql_limit):
+            fw_ids = [uuid.UUID(id) for id in ids[i:i + settings.data_sql_limit]]
+            self.es_handler.upload_data(
+                self.etl.build_documents(self.etl.fetch_filmwork_rows(fw_ids))
+            )
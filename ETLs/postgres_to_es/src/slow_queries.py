@@ -0,0 +1,100 @@
+import logging
+import logging.handlers
+import random
+import re
+import reprlib
+from typing import Optional
+
+import psycopg2
+
+from .config import settings
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Запрос в одну строку со свернутыми списками плейсхолдеров: одинаковые запросы
+    с разным числом id выглядят одинаково
+    """
+    return re.sub(r'%s(?:\s*,\s*%s)+', '%s, ...', ' '.join(query.split()))
+
+
+class SlowQueryLog:
+    """
+    Логирует запросы дольше threshold секунд вместе с параметрами, а для доли
+    explain_rate из них сохраняет план EXPLAIN (ANALYZE, BUFFERS) в ротируемый файл
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        explain_rate: float,
+        file_path: Optional[str] = None,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5
+    ):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+
+        self.plan_logger = logging.getLogger(f'{__name__}.plans')
+        self.plan_logger.propagate = False
+        if file_path is not None:
+            # файл создается при первом плане, а не при импорте модуля
+            self.plan_logger.addHandler(
+                logging.handlers.RotatingFileHandler(
+                    file_path, maxBytes=max_bytes, backupCount=backup_count, delay=True
+                )
+            )
+
+    def observe(self, conn, query: str, params: tuple, duration: float):
+        if duration < self.threshold:
+            return
+
+        normalized = normalize_query(query)
+        metrics.inc('slow_queries_total')
+        logger.warning('Slow query %.3f s: %s params=%s', duration, normalized, reprlib.repr(params))
+
+        if not self.plan_logger.handlers or random.random() >= self.explain_rate:
+            return
+
+        try:
+            plan = self.explain(conn, query, params)
+        except psycopg2.Error as e:
+            logger.warning('Can not explain slow query: %s', e)
+            return
+
+        self.plan_logger.warning(
+            '%.3f s: %s\nparams=%s\n%s\n', duration, normalized, reprlib.repr(params), plan
+        )
+
+    @staticmethod
+    def explain(conn, query: str, params: tuple) -> str:
+        """
+        Повторно выполняет запрос под EXPLAIN ANALYZE внутри точки сохранения:
+        изменения, которые делает запрос (например, пересборка документов), откатываются
+        """
+        in_transaction = not conn.autocommit
+
+        with conn.cursor() as cur:
+            if in_transaction:
+                cur.execute('SAVEPOINT slow_query_explain;')
+            try:
+                cur.execute(f'EXPLAIN (ANALYZE, BUFFERS) {query}', params)
+                rows = cur.fetchall()
+            finally:
+                if in_transaction:
+                    cur.execute('ROLLBACK TO SAVEPOINT slow_query_explain;')
+                    cur.execute('RELEASE SAVEPOINT slow_query_explain;')
+
+        return '\n'.join(row['QUERY PLAN'] for row in rows)
+
+
+slow_query_log = SlowQueryLog(
+    settings.slow_query_threshold,
+    settings.slow_query_explain_rate,
+    settings.slow_query_log_filepath,
+    settings.slow_query_log_max_bytes,
+    settings.slow_query_log_backup_count,
+)
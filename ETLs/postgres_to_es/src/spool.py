@@ -0,0 +1,192 @@
+import logging
+import mmap
+import os
+import threading
+import zlib
+from typing import Iterator, List, Tuple
+
+from .state import JsonFileStorage, State
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.ndjson'
+INDEX_SUFFIX = '.idx'
+
+
+class SpoolCorruptedError(Exception):
+    """Запись сегмента не совпадает со своей контрольной суммой"""
+
+
+class Spool:
+    """
+    Журнал на диске между transformer и loader.
+    Каждая пачка пишется готовым телом bulk-запроса в конец текущего сегмента (*.ndjson),
+    а в индекс сегмента (*.idx) добавляется строка "offset length crc32".
+    Запись считается сохраненной после fsync обоих файлов.
+    Сегмент закрывается при превышении max_segment_bytes, закрытыми считаются все
+    сегменты, кроме последнего.
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, segment: int, suffix: str) -> str:
+        return os.path.join(self.directory, f'{segment:012d}{suffix}')
+
+    def segments(self) -> List[int]:
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _current_segment(self) -> int:
+        segments = self.segments()
+        if not segments:
+            return 1
+
+        last = segments[-1]
+        if os.path.getsize(self._path(last, SEGMENT_SUFFIX)) >= self.max_segment_bytes:
+            return last + 1
+
+        return last
+
+    def _truncate_torn_index(self, segment: int):
+        """
+        Обрезает недописанную после падения процесса последнюю строку индекса,
+        иначе следующая запись склеилась бы с ней и read_index потерял бы ее и все после нее
+        """
+        try:
+            with open(self._path(segment, INDEX_SUFFIX), 'rb+') as index_file:
+                content = index_file.read()
+                if not content or content.endswith(b'\n'):
+                    return
+
+                logger.warning('Truncating torn spool index line of segment %s', segment)
+                index_file.truncate(content.rfind(b'\n') + 1)
+                os.fsync(index_file.fileno())
+        except FileNotFoundError:
+            pass
+
+    def append(self, body: bytes):
+        """
+        Дописывает тело bulk-запроса в журнал и дожидается записи на диск
+        """
+        with self._lock:
+            segment = self._current_segment()
+            self._truncate_torn_index(segment)
+
+            with open(self._path(segment, SEGMENT_SUFFIX), 'ab') as data_file:
+                offset = data_file.tell()
+                data_file.write(body)
+                data_file.flush()
+                os.fsync(data_file.fileno())
+
+            with open(self._path(segment, INDEX_SUFFIX), 'a') as index_file:
+                index_file.write(f'{offset} {len(body)} {zlib.crc32(body)}\n')
+                index_file.flush()
+                os.fsync(index_file.fileno())
+
+        logger.debug('Spooled %s bytes to segment %s', len(body), segment)
+
+    def read_index(self, segment: int) -> List[Tuple[int, int, int]]:
+        try:
+            with open(self._path(segment, INDEX_SUFFIX)) as index_file:
+                lines = index_file.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        for line in lines:
+            parts = line.split()
+            # недописанная последняя строка после падения процесса
+            if len(parts) != 3:
+                break
+            entries.append(tuple(int(part) for part in parts))
+
+        return entries
+
+    def replay(
+        self, segment: int, start: int = 0, skip_corrupted: bool = False
+    ) -> Iterator[Tuple[int, bytes]]:
+        """
+        Выдает записи сегмента начиная с номера start, читая файл через mmap.
+        Пропущенная при skip_corrupted запись выдается с телом None, чтобы позиция прошла ее
+        """
+        entries = self.read_index(segment)[start:]
+        if not entries:
+            return
+
+        with open(self._path(segment, SEGMENT_SUFFIX), 'rb') as data_file:
+            with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for number, (offset, length, crc) in enumerate(entries, start=start):
+                    body = data[offset:offset + length]
+                    if len(body) != length or zlib.crc32(body) != crc:
+                        if not skip_corrupted:
+                            raise SpoolCorruptedError(f'segment {segment} record {number}')
+                        logger.error('Skipping corrupted spool record %s of segment %s', number, segment)
+                        yield number, None
+                        continue
+
+                    yield number, body
+
+    def remove(self, segment: int):
+        for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+            try:
+                os.remove(self._path(segment, suffix))
+            except FileNotFoundError:
+                pass
+
+
+class SpoolDrainer:
+    """
+    Переносит записи журнала в Elasticsearch.
+    Позиция (сегмент и номер записи) хранится в drainer.json в каталоге журнала и
+    сдвигается только после подтверждения записи ES. Закрытый сегмент удаляется,
+    когда подтверждены все его записи.
+    """
+
+    def __init__(self, spool: Spool, es_handler):
+        self.spool = spool
+        self.es_handler = es_handler
+        self.state = State(
+            JsonFileStorage(file_path=os.path.join(spool.directory, 'drainer.json'))
+        )
+
+    def _position(self, segment: int) -> int:
+        position = self.state.get_state('position')
+        if not position or position[0] != segment:
+            return 0
+
+        return position[1]
+
+    def drain(self) -> int:
+        """
+        Отправляет все доступные записи, возвращает их количество
+        """
+        drained = 0
+        segments = self.spool.segments()
+
+        for segment in segments:
+            is_sealed = segment != segments[-1]
+            start = self._position(segment)
+
+            try:
+                for number, body in self.spool.replay(segment, start, skip_corrupted=is_sealed):
+                    # отклоненная ES запись (BulkRejectedError) останавливает перенос до следующей попытки
+                    if body is not None:
+                        self.es_handler.upload_raw(body)
+                        drained += 1
+                    self.state.set_state('position', [segment, number + 1])
+            except SpoolCorruptedError:
+                # запись текущего сегмента может быть еще не дописана
+                break
+
+            if is_sealed and self._position(segment) >= len(self.spool.read_index(segment)):
+                self.spool.remove(segment)
+
+        return drained
@@ -1,4 +1,5 @@
 from functools import wraps
+from typing import List
 
 def coroutine(func):
     @wraps(func)
@@ -9,3 +10,13 @@ def coroutine(func):
 
     return inner 
 
+
+def suggest_inputs(text: str, max_tails: int = 3) -> List[str]:
+    """
+    Варианты ввода для автодополнения: текст целиком и его хвосты со второго слова,
+    чтобы название находилось и по слову из середины
+    """
+    words = text.split()
+
+    return [' '.join(words[i:]) for i in range(min(len(words), max_tails + 1))]
+
@@ -0,0 +1,57 @@
+import random
+from typing import Iterable, List, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from .config import ValidationMode, settings
+from .metrics import metrics
+
+Model = TypeVar('Model', bound=BaseModel)
+
+
+def _validate_all(model: Type[Model], rows: List[dict]) -> List[Model]:
+    built = []
+    for row in rows:
+        try:
+            built.append(model(**row))
+        except ValidationError:
+            metrics.inc('validation_failures_total')
+            raise
+
+    metrics.inc('validated_rows_total', len(rows))
+
+    return built
+
+
+def build_models(model: Type[Model], rows: Iterable[dict]) -> List[Model]:
+    """
+    Создает модели из строк пачки в зависимости от settings.validation_mode:
+    full - валидирует каждую строку, off - собирает модели без проверки (construct),
+    sampled - проверяет долю validation_sample_rate строк, а если хотя бы одна
+    из них не прошла проверку, валидирует всю пачку целиком.
+    """
+    rows = list(rows)
+    mode = settings.validation_mode
+
+    if mode == ValidationMode.full:
+        return _validate_all(model, rows)
+
+    built = []
+    for row in rows:
+        if mode == ValidationMode.sampled and random.random() < settings.validation_sample_rate:
+            try:
+                built.append(model(**row))
+            except ValidationError:
+                metrics.inc('validation_sampled_failures_total')
+                return _validate_all(model, rows)
+
+            metrics.inc('validated_rows_total')
+            continue
+
+        built.append(model.construct(**row))
+
+    return built
+
+
+def build_model(model: Type[Model], **values) -> Model:
+    return build_models(model, [values])[0]
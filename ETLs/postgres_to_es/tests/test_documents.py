@@ -0,0 +1,70 @@
+import datetime as dt
+import uuid
+
+import pytest
+
+from src.config import ValidationMode, settings
+from src.etl import ETLBase
+from src.models import FilmworkRow
+from src.validation import build_models
+
+
+@pytest.fixture
+def etl(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'state_json_filepath', str(tmp_path / 'state.json'))
+    monkeypatch.setattr(settings, 'validation_mode', ValidationMode.full)
+    return ETLBase('filmwork')
+
+
+def filmwork_row(fw_id: uuid.UUID, **links) -> dict:
+    return {
+        'fw_id': fw_id,
+        'title': 'Alien',
+        'description': 'In space no one can hear you scream',
+        'imdb_rating': 8.4,
+        'type': 'movie',
+        'created': dt.datetime(2021, 1, 1),
+        'modified': dt.datetime(2021, 1, 2),
+        'version': 1,
+        'role': None,
+        'person_id': None,
+        'full_name': None,
+        'genre': None,
+        **links,
+    }
+
+
+def test_film_without_links_is_indexed_with_empty_lists(etl):
+    fw_id = uuid.uuid4()
+    # LEFT JOIN для фильма, у которого удалили последний жанр и последнюю персону
+    rows = build_models(FilmworkRow, [filmwork_row(fw_id)])
+
+    documents = etl.build_documents(rows)
+
+    assert len(documents) == 1
+    assert documents[0]['id'] == str(fw_id)
+    assert documents[0]['genre'] == []
+    assert documents[0]['actors'] == []
+    assert documents[0]['writers'] == []
+
+
+def test_film_without_persons_keeps_genres(etl):
+    fw_id = uuid.uuid4()
+    rows = build_models(FilmworkRow, [filmwork_row(fw_id, genre='Horror'), filmwork_row(fw_id, genre='Sci-Fi')])
+
+    documents = etl.build_documents(rows)
+
+    assert documents[0]['genre'] == ['Horror', 'Sci-Fi']
+    assert documents[0]['actors_names'] == []
+
+
+def test_film_without_genres_keeps_persons(etl):
+    fw_id = uuid.uuid4()
+    rows = build_models(FilmworkRow, [
+        filmwork_row(fw_id, role='ACTOR', person_id=uuid.uuid4(), full_name='Sigourney Weaver'),
+    ])
+
+    documents = etl.build_documents(rows)
+
+    assert documents[0]['genre'] == []
+    assert documents[0]['actors_names'] == ['Sigourney Weaver']
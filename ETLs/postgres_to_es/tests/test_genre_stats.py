@@ -0,0 +1,188 @@
+import uuid
+from pathlib import Path
+
+import psycopg2
+import pytest
+from psycopg2.extras import RealDictCursor
+
+from src.config import settings
+from src.etl import FanOutETL
+
+GENRE_STATS_SQL = Path(__file__).parent.parent / 'sql' / 'genre_stats.sql'
+
+
+def test_build_genre_document_without_stats_updates_only_title(monkeypatch):
+    monkeypatch.setattr(settings, 'genre_stats', False)
+
+    document = FanOutETL.build_genre_document('genre-1', 'Drama', None)
+
+    assert document == {'_op': 'update', '_index': settings.es_genres_index, 'id': 'genre-1', 'title': 'Drama'}
+
+
+def test_build_genre_document_with_stats(monkeypatch):
+    monkeypatch.setattr(settings, 'genre_stats', True)
+    stats = {
+        'films_count': 3,
+        'rated_count': 2,
+        'rating_sum': 15,
+        'histogram': [0, 0, 0, 0, 0, 0, 0, 1, 1, 0],
+        'top_films': [{'id': 'fw-1', 'title': 'A', 'imdb_rating': 8}, {'id': 'fw-2', 'title': 'B', 'imdb_rating': 7}],
+    }
+
+    document = FanOutETL.build_genre_document('genre-1', 'Drama', stats)
+
+    assert document['_op'] == 'update'
+    assert document['films_count'] == 3
+    assert document['imdb_rating_avg'] == 7.5
+    assert document['imdb_rating_histogram'][7] == {'key': 7.0, 'doc_count': 1}
+    assert len(document['imdb_rating_histogram']) == 10
+    assert document['top_films'] == stats['top_films']
+    # описание жанра ведет ETL схемы cinema, частичное обновление его не затирает
+    assert 'description' not in document
+
+
+def test_build_genre_document_for_genre_without_films(monkeypatch):
+    monkeypatch.setattr(settings, 'genre_stats', True)
+
+    document = FanOutETL.build_genre_document('genre-1', 'Drama', None)
+
+    assert document['films_count'] == 0
+    assert document['imdb_rating_avg'] is None
+    assert document['top_films'] == []
+
+
+@pytest.fixture
+def cur():
+    """
+    Курсор в транзакции с триггерами sql/genre_stats.sql, которая откатывается после теста
+    """
+    try:
+        conn = psycopg2.connect(**settings.pg_dsn.dict(), cursor_factory=RealDictCursor)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'postgres is not available: {e}')
+
+    conn.set_client_encoding('UTF8')
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('content.filmworks_genres') IS NOT NULL as exists")
+            if not cur.fetchone()['exists']:
+                pytest.skip('content schema is not created')
+
+            cur.execute(GENRE_STATS_SQL.read_text())
+            yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def add_genre(cur) -> uuid.UUID:
+    genre_id = uuid.uuid4()
+    cur.execute('INSERT INTO content.genre (id, name) VALUES (%s, %s)', (str(genre_id), 'genre'))
+    return genre_id
+
+
+def add_film(cur, genre_id: uuid.UUID, rating) -> uuid.UUID:
+    fw_id = uuid.uuid4()
+    cur.execute('INSERT INTO content.filmwork (id, title, rating) VALUES (%s, %s, %s)', (str(fw_id), 'film', rating))
+    cur.execute(
+        'INSERT INTO content.filmworks_genres (filmwork_id, genre_id) VALUES (%s, %s)', (str(fw_id), str(genre_id))
+    )
+    return fw_id
+
+
+def fold(cur) -> int:
+    cur.execute('SELECT content.fold_genre_stats(1000) as folded')
+    return cur.fetchone()['folded']
+
+
+def genre_stats(cur, genre_id: uuid.UUID) -> dict:
+    cur.execute('SELECT * FROM content.genre_stats WHERE genre_id = %s', (str(genre_id),))
+    return cur.fetchone()
+
+
+def top_ids(stats: dict) -> list:
+    return [film['id'] for film in stats['top_films']]
+
+
+def test_insert_is_journaled_and_folded(cur):
+    genre_id = add_genre(cur)
+    fw_id = add_film(cur, genre_id, 7.5)
+    add_film(cur, genre_id, None)
+
+    # триггер только дописывает журнал, строку статистики меняет свертка
+    assert genre_stats(cur, genre_id) is None
+    assert fold(cur) == 2
+
+    stats = genre_stats(cur, genre_id)
+    assert stats['films_count'] == 2
+    assert stats['rated_count'] == 1
+    assert stats['rating_sum'] == 7.5
+    assert stats['histogram'][7] == 1
+    assert top_ids(stats) == [str(fw_id)]
+    assert fold(cur) == 0
+
+
+def test_delete_removes_film(cur):
+    genre_id = add_genre(cur)
+    kept_id = add_film(cur, genre_id, 6)
+    deleted_id = add_film(cur, genre_id, 9)
+    fold(cur)
+    version = genre_stats(cur, genre_id)['version']
+
+    cur.execute('DELETE FROM content.filmwork WHERE id = %s', (str(deleted_id),))
+    fold(cur)
+
+    stats = genre_stats(cur, genre_id)
+    assert stats['films_count'] == 1
+    assert stats['rated_count'] == 1
+    assert stats['rating_sum'] == 6
+    assert stats['histogram'][9] == 0
+    assert top_ids(stats) == [str(kept_id)]
+    # ETL переносит строку в индекс по новой версии
+    assert stats['version'] > version
+
+
+def test_rating_change_moves_film_between_buckets(cur):
+    genre_id = add_genre(cur)
+    first_id = add_film(cur, genre_id, 8)
+    second_id = add_film(cur, genre_id, 5)
+    fold(cur)
+
+    cur.execute('UPDATE content.filmwork SET rating = 9 WHERE id = %s', (str(second_id),))
+    fold(cur)
+
+    stats = genre_stats(cur, genre_id)
+    assert stats['films_count'] == 2
+    assert stats['rating_sum'] == 17
+    assert stats['histogram'][5] == 0
+    assert stats['histogram'][9] == 1
+    assert top_ids(stats) == [str(second_id), str(first_id)]
+
+
+def test_top_films_eviction(cur):
+    cur.execute('SELECT content.genre_stats_top_n() as top_n')
+    top_n = cur.fetchone()['top_n']
+
+    genre_id = add_genre(cur)
+    fw_ids = [add_film(cur, genre_id, rating / 2) for rating in range(1, top_n + 2)]
+    fold(cur)
+
+    # фильм с наименьшим рейтингом не входит в список
+    stats = genre_stats(cur, genre_id)
+    assert len(stats['top_films']) == top_n
+    assert str(fw_ids[0]) not in top_ids(stats)
+
+    # лучший фильм вытесняет последний фильм списка
+    best_id = add_film(cur, genre_id, 9.9)
+    fold(cur)
+    stats = genre_stats(cur, genre_id)
+    assert top_ids(stats)[0] == str(best_id)
+    assert str(fw_ids[1]) not in top_ids(stats)
+
+    # выбывший из списка фильм заменяется следующим по рейтингу
+    cur.execute('DELETE FROM content.filmworks_genres WHERE filmwork_id = %s', (str(best_id),))
+    fold(cur)
+    stats = genre_stats(cur, genre_id)
+    assert len(stats['top_films']) == top_n
+    assert str(best_id) not in top_ids(stats)
+    assert str(fw_ids[1]) in top_ids(stats)
@@ -0,0 +1,155 @@
+import pytest
+from psycopg2.extensions import adapt
+
+from src import db as db_module
+from src import governor as governor_module
+from src.db import DBHanlder
+from src.governor import BatchLimit, PgGovernor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(governor_module, 'time', clock)
+    return clock
+
+
+def make_governor(signals, **kwargs) -> PgGovernor:
+    """
+    Ограничитель, у которого замеры по очереди возвращают причины из signals (None - в бюджете)
+    """
+    governor = PgGovernor(enabled=True, interval=1.0, max_pause=4.0, **kwargs)
+    signals = iter(signals)
+    governor._over_budget = lambda: next(signals)
+    return governor
+
+
+def test_disabled_governor_keeps_batch_and_does_not_sample(clock):
+    governor = make_governor([])
+    governor.enabled = False
+
+    governor.throttle()
+
+    assert governor.batch_size(100) == 100
+    assert clock.sleeps == []
+
+
+def test_over_budget_pauses_with_growing_pause_and_shrinks_batch(clock):
+    governor = make_governor(['latency', 'latency', 'latency', 'latency', None])
+
+    governor.throttle()
+
+    assert clock.sleeps == [1.0, 2.0, 4.0, 4.0]
+    # четыре уменьшения вдвое и один шаг восстановления после возврата в бюджет
+    assert governor.scale == pytest.approx(1 / 16 + 0.1)
+    assert governor.batch_size(100) == 16
+
+
+def test_scale_recovers_within_budget_and_is_capped(clock):
+    governor = make_governor([None] * 10)
+    governor.on_timeout()
+    assert governor.scale == 0.5
+
+    for _ in range(10):
+        clock.now += governor.interval
+        governor.throttle()
+
+    assert governor.scale == 1.0
+
+
+def test_throttle_samples_once_per_interval(clock):
+    governor = make_governor([None])
+
+    governor.throttle()
+    # следующий замер только через interval: пустой список замеров бросил бы StopIteration
+    clock.now += governor.interval / 2
+    governor.throttle()
+
+
+def test_on_timeout_does_not_go_below_min_scale():
+    governor = PgGovernor(enabled=True, min_scale=0.05)
+
+    for _ in range(10):
+        governor.on_timeout()
+
+    assert governor.scale == 0.05
+    assert governor.batch_size(10) == 1
+
+
+def test_throttle_gives_up_after_max_wait(clock):
+    governor = make_governor(['probe failed'] * 100, max_wait=10.0)
+
+    governor.throttle()
+
+    assert sum(clock.sleeps) == pytest.approx(10.0)
+    # нагрузка не вернулась в бюджет: пачка не восстанавливается
+    assert governor.scale == governor.min_scale
+
+
+def test_batch_limit_follows_current_scale():
+    governor = PgGovernor(enabled=True)
+    batch_limit = BatchLimit(100, governor)
+    assert adapt(batch_limit).getquoted() == b'100'
+
+    governor.on_timeout()
+
+    # тот же параметр при повторе запроса дает уже уменьшенный LIMIT
+    assert adapt(batch_limit).getquoted() == b'50'
+
+
+class FakeCursor:
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append(query)
+
+    def fetchall(self) -> list:
+        return []
+
+
+class FakeConn:
+    closed = False
+
+    def rollback(self):
+        pass
+
+
+def make_db_handler(monkeypatch, governor_enabled: bool) -> DBHanlder:
+    governor = PgGovernor(enabled=governor_enabled)
+    monkeypatch.setattr(governor, 'throttle', lambda: None)
+    monkeypatch.setattr(db_module, 'pg_governor', governor)
+    monkeypatch.setattr(db_module.slow_query_log, 'observe', lambda *args: None)
+
+    db_handler = DBHanlder.__new__(DBHanlder)
+    db_handler.conn, db_handler.cur = FakeConn(), FakeCursor()
+    return db_handler
+
+
+def test_query_without_governor_skips_savepoint(monkeypatch):
+    db_handler = make_db_handler(monkeypatch, governor_enabled=False)
+
+    db_handler.execute_query('SELECT 1', ())
+
+    assert db_handler.cur.queries == ['SELECT 1']
+
+
+def test_query_with_governor_runs_in_savepoint(monkeypatch):
+    db_handler = make_db_handler(monkeypatch, governor_enabled=True)
+
+    db_handler.execute_query('SELECT 1', ())
+
+    assert db_handler.cur.queries == ['SAVEPOINT etl_query;', 'SELECT 1', 'RELEASE SAVEPOINT etl_query;']
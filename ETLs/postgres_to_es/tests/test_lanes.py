@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from src.lanes import Lane, LaneScheduler
+
+
+def run_scheduler(scheduler: LaneScheduler):
+    scheduler.start()
+    return scheduler
+
+
+def test_submit_splits_ids_into_lane_batches():
+    processed = []
+    scheduler = run_scheduler(
+        LaneScheduler(processed.append, [Lane('live', 2, 1)], target_latency=1.0, poll_interval=0.01)
+    )
+
+    scheduler.submit('live', [1, 2, 3, 4, 5])
+    scheduler.close()
+    scheduler.join()
+
+    assert processed == [[1, 2], [3, 4], [5]]
+    assert scheduler.pending('live') == 0
+
+
+def test_submit_blocks_while_lane_is_full():
+    release = threading.Event()
+    processed = []
+
+    def process(ids):
+        release.wait(5)
+        processed.append(ids)
+
+    scheduler = run_scheduler(
+        LaneScheduler(process, [Lane('bulk', 1, 1, max_queued=1)], target_latency=1.0, poll_interval=0.01)
+    )
+    # первая пачка у воркера, вторая занимает очередь
+    scheduler.submit('bulk', [1])
+    time.sleep(0.05)
+    scheduler.submit('bulk', [2])
+
+    feeder = threading.Thread(target=scheduler.submit, args=('bulk', [3]))
+    feeder.start()
+    feeder.join(0.2)
+    assert feeder.is_alive()
+
+    release.set()
+    feeder.join(5)
+    assert not feeder.is_alive()
+
+    scheduler.close()
+    scheduler.join()
+    assert processed == [[1], [2], [3]]
+
+
+def test_overdue_live_batch_is_taken_by_bulk_worker():
+    processed = []
+    scheduler = run_scheduler(
+        LaneScheduler(
+            lambda ids: processed.append((threading.current_thread().name, ids)),
+            [Lane('live', 10, 0), Lane('bulk', 10, 1)],
+            target_latency=0.0,
+            poll_interval=0.01
+        )
+    )
+
+    scheduler.submit('live', ['film'])
+    scheduler.close()
+    scheduler.join()
+
+    assert processed == [('lane-bulk-0', ['film'])]
+
+
+def test_worker_error_is_raised_from_join_and_unblocks_submit():
+    def process(ids):
+        raise ValueError('broken batch')
+
+    scheduler = run_scheduler(
+        LaneScheduler(process, [Lane('bulk', 1, 1, max_queued=1)], target_latency=1.0, poll_interval=0.01)
+    )
+    scheduler.submit('bulk', [1, 2, 3, 4])
+
+    assert scheduler.failed
+    with pytest.raises(ValueError):
+        scheduler.join()
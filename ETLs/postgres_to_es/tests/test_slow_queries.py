@@ -0,0 +1,43 @@
+import logging
+
+import psycopg2
+import pytest
+from psycopg2.extras import RealDictCursor
+
+from src.config import settings
+from src.slow_queries import SlowQueryLog, normalize_query
+
+
+def test_normalize_query_folds_placeholder_lists():
+    assert normalize_query('SELECT *\n  FROM t WHERE id IN (%s, %s,%s)') == 'SELECT * FROM t WHERE id IN (%s, ...)'
+
+
+def test_plan_file_is_created_with_first_plan(tmp_path, monkeypatch):
+    # логгер планов общий с экземпляром модуля, его файл тест не трогает
+    monkeypatch.setattr(logging.getLogger('src.slow_queries.plans'), 'handlers', [])
+    file_path = tmp_path / 'slow_queries.log'
+    slow_query_log = SlowQueryLog(0, 1, str(file_path))
+    assert not file_path.exists()
+
+    slow_query_log.plan_logger.warning('plan')
+    assert file_path.exists()
+    slow_query_log.plan_logger.handlers[0].close()
+
+
+def test_explain_releases_savepoint():
+    try:
+        conn = psycopg2.connect(**settings.pg_dsn.dict(), cursor_factory=RealDictCursor)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'postgres is not available: {e}')
+
+    try:
+        plan = SlowQueryLog.explain(conn, 'SELECT %s', (1,))
+        assert 'Result' in plan
+
+        # точка сохранения снята, а транзакция осталась открытой
+        with conn.cursor() as cur:
+            with pytest.raises(psycopg2.errors.InvalidSavepointSpecification):
+                cur.execute('RELEASE SAVEPOINT slow_query_explain;')
+    finally:
+        conn.rollback()
+        conn.close()
@@ -0,0 +1,141 @@
+import json
+
+import pytest
+import requests
+
+from src.es import BulkRejectedError, ESHandler
+from src.spool import INDEX_SUFFIX, Spool, SpoolDrainer
+
+
+class FakeES:
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.uploaded = []
+
+    def upload_raw(self, body: bytes):
+        if body in self.reject:
+            raise BulkRejectedError('rejected')
+        self.uploaded.append(body)
+
+
+def seal(spool: Spool, bodies):
+    """
+    Пишет записи в первый сегмент и закрывает его записью во второй
+    """
+    for body in bodies:
+        spool.append(body)
+    spool.max_segment_bytes = 1
+    spool.append(b'tail')
+
+
+def test_rejected_record_is_kept_and_retried(tmp_path):
+    spool = Spool(str(tmp_path), max_segment_bytes=1024)
+    seal(spool, [b'a', b'b', b'c'])
+
+    es = FakeES(reject={b'b'})
+    drainer = SpoolDrainer(spool, es)
+    with pytest.raises(BulkRejectedError):
+        drainer.drain()
+
+    # позиция стоит на отклоненной записи, сегмент не удален
+    assert es.uploaded == [b'a']
+    assert spool.segments() == [1, 2]
+
+    es.reject.clear()
+    drainer.drain()
+
+    assert es.uploaded == [b'a', b'b', b'c', b'tail']
+    assert spool.segments() == [2]
+
+
+def test_torn_index_line_is_truncated_before_append(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(b'a')
+    # процесс упал посреди записи строки индекса
+    with open(tmp_path / f'{1:012d}{INDEX_SUFFIX}', 'a') as index_file:
+        index_file.write('1 5')
+
+    spool.append(b'b')
+    spool.append(b'c')
+
+    assert [body for _number, body in spool.replay(1)] == [b'a', b'b', b'c']
+
+
+def test_sealed_segment_with_corrupted_record_is_drained(tmp_path):
+    spool = Spool(str(tmp_path), max_segment_bytes=1024)
+    seal(spool, [b'a', b'b'])
+    with open(tmp_path / f'{1:012d}.ndjson', 'r+b') as data_file:
+        data_file.seek(1)
+        data_file.write(b'x')
+
+    es = FakeES()
+    SpoolDrainer(spool, es).drain()
+
+    assert es.uploaded == [b'a', b'tail']
+    assert spool.segments() == [2]
+
+
+BODY = b'{"index": {"_index": "movies", "_id": "1"}}\n{"id": "1"}\n'
+
+
+def test_error_only_bulk_response_is_rejected(monkeypatch):
+    es_handler = ESHandler(root_url='http://es:9200')
+    monkeypatch.setattr(es_handler, 'next_alias', lambda index_name: None)
+    monkeypatch.setattr(es_handler, 'bulk_request', lambda body: {'error': 'cluster_block_exception', 'status': 503})
+
+    with pytest.raises(BulkRejectedError):
+        es_handler.upload_raw(BODY)
+
+
+def test_item_rejections_are_raised(monkeypatch):
+    es_handler = ESHandler(root_url='http://es:9200')
+    monkeypatch.setattr(es_handler, 'next_alias', lambda index_name: None)
+    response = {'took': 1, 'items': [
+        {'index': {'status': 201}},
+        {'index': {'status': 429, 'error': 'es_rejected_execution_exception'}},
+    ]}
+    monkeypatch.setattr(es_handler, 'bulk_request', lambda body: response)
+
+    with pytest.raises(BulkRejectedError):
+        es_handler.upload_raw(BODY)
+
+
+def test_spooled_body_has_no_dual_write_copies(monkeypatch):
+    def head(url):
+        raise requests.exceptions.ConnectionError('es is down')
+
+    monkeypatch.setattr(requests, 'head', head)
+    es_handler = ESHandler(root_url='http://es:9200')
+
+    body = es_handler.get_bulk_body([{'id': '1', '_index': 'movies'}], ['2'])
+
+    actions = [json.loads(line) for line in body.decode().splitlines()]
+    assert [next(iter(action)) for action in actions] == ['delete', 'index', 'id']
+    assert es_handler._next_aliases == {}
+
+
+def test_dual_write_targets_are_chosen_at_drain_time(monkeypatch):
+    es_handler = ESHandler(root_url='http://es:9200')
+    body = es_handler.get_bulk_body([{'id': '1', '_index': 'movies'}], ['2'])
+
+    sent = []
+    monkeypatch.setattr(es_handler, 'next_alias', lambda index_name: f'{index_name}_next')
+    monkeypatch.setattr(es_handler, 'bulk_request', lambda body: sent.append(body) or {'items': []})
+    es_handler.upload_raw(body)
+
+    lines = [json.loads(line) for line in sent[0].decode().splitlines()]
+    assert lines[3] == {'delete': {'_index': 'movies_next', '_id': '2'}}
+    assert lines[4] == {'index': {'_index': 'movies_next', '_id': '1', 'require_alias': True}}
+    assert lines[5] == {'id': '1'}
+
+
+def test_alias_probe_failure_keeps_cached_state(monkeypatch):
+    es_handler = ESHandler(root_url='http://es:9200')
+    es_handler._next_aliases['movies'] = (0, True)
+
+    def head(url):
+        raise requests.exceptions.ConnectionError('es is down')
+
+    monkeypatch.setattr(requests, 'head', head)
+
+    assert es_handler.next_alias('movies') == 'movies_next'
@@ -0,0 +1,48 @@
+from src.config import settings
+from src.etl import ETLBase
+from src.utils import suggest_inputs
+
+
+def test_suggest_inputs_adds_tails_from_second_word():
+    assert suggest_inputs('The Lord of the Rings') == [
+        'The Lord of the Rings', 'Lord of the Rings', 'of the Rings', 'the Rings'
+    ]
+    assert suggest_inputs('Star  Wars') == ['Star Wars', 'Wars']
+    assert suggest_inputs('Alien') == ['Alien']
+    assert suggest_inputs('') == []
+
+
+def test_build_suggestion_weights_by_rating():
+    suggestion = ETLBase.build_suggestion(
+        {'id': 'fw-1', '_version': 10, 'title': 'Star Wars', 'imdb_rating': 8.65}
+    )
+
+    assert suggestion == {
+        '_index': settings.es_suggest_index,
+        '_version': 10,
+        'id': 'fw-1',
+        'type': 'film',
+        'title': 'Star Wars',
+        'suggest': {'input': ['Star Wars', 'Wars'], 'weight': 86},
+    }
+
+
+def test_build_suggestion_without_rating_has_zero_weight():
+    suggestion = ETLBase.build_suggestion({'id': 'fw-1', '_version': 10, 'title': 'Alien', 'imdb_rating': None})
+
+    assert suggestion['suggest']['weight'] == 0
+
+
+def test_build_suggestions_skips_other_indices_and_deletes():
+    rows = [
+        {'id': 'fw-1', '_version': 1, 'title': 'Alien', 'imdb_rating': 8.4},
+        {'id': 'fw-2', '_version': 2, '_raw': '{}', 'title': 'Aliens', 'imdb_rating': 8.3},
+        {'id': 'fw-3', '_version': 3, '_raw': '{}', 'title': None, 'imdb_rating': None},
+        {'_op': 'update', '_index': settings.es_genres_index, 'id': 'genre-1', 'title': 'Horror'},
+        {'_op': 'delete', '_index': settings.es_persons_index, 'id': 'person-1'},
+    ]
+
+    suggestions = ETLBase.build_suggestions(rows)
+
+    assert [row['id'] for row in suggestions] == ['fw-1', 'fw-2']
+    assert all(row['_index'] == settings.es_suggest_index for row in suggestions)
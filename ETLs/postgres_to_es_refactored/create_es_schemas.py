@@ -1,36 +1,343 @@
+import argparse
+import copy
+import hashlib
 import json
 import os
+import time
 from pathlib import Path
+from typing import Dict, List, Optional
 from urllib.parse import urljoin
 
 import requests
 from utils.logger import logger
 
+# алиас нового индекса на время _reindex и интервал, с которым ETL перепроверяет его наличие
+# (ES_DUAL_WRITE_TTL в etls/config.py); скрипт запускается до ETL и не зависит от его пакета
+dual_write_suffix = '_next'
+dual_write_ttl = float(os.getenv('ES_DUAL_WRITE_TTL', 10))
 
-def init_schema(url, name: str, schema_json: json):
-    """ Создает ES индекс согласно переданной json схеме. """
+# смены типа поля, при которых _reindex переносит сохраненные значения без ошибок
+COMPATIBLE_TYPE_CHANGES = {
+    ('text', 'keyword'), ('keyword', 'text'), ('text', 'search_as_you_type'), ('search_as_you_type', 'text'),
+    ('byte', 'short'), ('byte', 'integer'), ('byte', 'long'), ('short', 'integer'), ('short', 'long'),
+    ('integer', 'long'), ('half_float', 'float'), ('half_float', 'double'), ('float', 'double'),
+    ('integer', 'float'), ('integer', 'double'), ('long', 'double'),
+    ('byte', 'keyword'), ('short', 'keyword'), ('integer', 'keyword'), ('long', 'keyword'),
+    ('float', 'keyword'), ('double', 'keyword'), ('boolean', 'keyword'), ('date', 'keyword'),
+    ('object', 'nested'), ('nested', 'object'),
+}
 
-    response = requests.put(
-        urljoin(url, name),
-        json=schema_json,
-        headers={'Content-Type': 'application/json'}
+
+def schema_hash(schema_json: dict) -> str:
+    """ Короткий хеш схемы, входит в имя индекса: индекс с другой схемой получает новое имя. """
+    return hashlib.sha1(json.dumps(schema_json, sort_keys=True).encode()).hexdigest()[:8]
+
+
+def flatten_properties(properties: dict, prefix: str = '') -> Dict[str, dict]:
+    """ Описания полей маппинга по полному пути поля, без вложенных properties. """
+    fields = {}
+    for name, definition in properties.items():
+        path = f'{prefix}{name}'
+        # ES не возвращает type: object для полей с properties
+        fields[path] = {
+            key: value for key, value in definition.items()
+            if key != 'properties' and (key, value) != ('type', 'object')
+        }
+        fields.update(flatten_properties(definition.get('properties', {}), f'{path}.'))
+    return fields
+
+
+def _stringify(value):
+    """ ES возвращает настройки строками, для сравнения приводим к строкам и схему. """
+    if isinstance(value, dict):
+        return {key: _stringify(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_stringify(item) for item in value]
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def resolve_index(url: str, name: str) -> Optional[str]:
+    """ Индекс за именем: сам индекс или индекс, на который указывает алиас. """
+    response = requests.get(urljoin(url, name))
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return next(iter(response.json()))
+
+
+def get_meta(url: str, index: str) -> dict:
+    response = requests.get(urljoin(url, f'{index}/_mapping'))
+    response.raise_for_status()
+    return response.json()[index]['mappings'].get('_meta', {})
+
+
+def field_type(definition: dict) -> str:
+    """ Тип поля маппинга; flatten_properties убирает type: object, поле без типа - object. """
+    return definition.get('type', 'object')
+
+
+def diff_schema(url: str, index: str, schema_json: dict) -> Dict[str, list]:
+    """
+    Отличия схемы от развернутого индекса: добавленные, удаленные и измененные поля и анализаторы.
+    В incompatible - измененные поля, значения которых _reindex в новый тип не перенесет.
+    """
+    mapping = requests.get(urljoin(url, f'{index}/_mapping')).json()[index]['mappings']
+    settings = requests.get(urljoin(url, f'{index}/_settings')).json()[index]['settings']
+
+    deployed = flatten_properties(mapping.get('properties', {}))
+    stored = flatten_properties(schema_json['mappings'].get('properties', {}))
+
+    analysis_changed = (
+        _stringify(schema_json.get('settings', {}).get('analysis', {}))
+        != _stringify(settings['index'].get('analysis', {}))
     )
+
+    changed = sorted(
+        path for path in stored.keys() & deployed.keys()
+        if _stringify(stored[path]) != _stringify(deployed[path])
+    )
+
+    return {
+        'added': sorted(stored.keys() - deployed.keys()),
+        'removed': sorted(deployed.keys() - stored.keys()),
+        'changed': changed,
+        'incompatible': [
+            path for path in changed
+            if field_type(deployed[path]) != field_type(stored[path])
+            and (field_type(deployed[path]), field_type(stored[path])) not in COMPATIBLE_TYPE_CHANGES
+        ],
+        'analysis': ['analysis'] if analysis_changed else [],
+    }
+
+
+
+def create_index(url: str, index: str, schema_json: dict, meta: dict) -> bool:
+    body = copy.deepcopy(schema_json)
+    body['mappings']['_meta'] = meta
+
+    response = requests.put(urljoin(url, index), json=body)
     if response.status_code == 200:
-        logger.info('create es schema %s', response.text)
-    elif response.status_code == 400:
-        logger.info('es schema %s already exists', response.text)
+        logger.info('create es index %s', index)
+        return True
+
+    logger.error('error create es index %s: %s', index, response.text)
+    return False
+
+
+def put_mapping(url: str, index: str, schema_json: dict, meta: dict):
+    """
+    Добавляет новые поля схемы в маппинг индекса без переноса данных.
+    Существующие поля в запросе не меняются, а хеш схемы в _meta отмечает индекс актуальным.
+    """
+    body = {**schema_json['mappings'], '_meta': meta}
+    response = requests.put(urljoin(url, f'{index}/_mapping'), json=body)
+    response.raise_for_status()
+    logger.info('update es mapping %s', index)
+
+
+def update_aliases(url: str, actions: List[dict]):
+    """ Атомарно применяет действия с алиасами. """
+    response = requests.post(urljoin(url, '_aliases'), json={'actions': actions})
+    response.raise_for_status()
+
+
+def start_reindex(url: str, name: str, source: str, target: str, meta: dict, removed: List[str], rps: float):
+    """
+    Запускает серверный _reindex из source в target без участия Postgres.
+    Сначала на target ставится алиас <name>_next, в который ETL дублирует запись,
+    и выдерживается пауза, чтобы ETL успел его увидеть: тогда изменения, сделанные
+    после снимка _reindex, не потеряются. Версии документов переносятся как внешние,
+    поэтому более новые документы двойной записи не перезаписываются старыми.
+    """
+    next_alias = f'{name}{dual_write_suffix}'
+    update_aliases(url, [{'add': {'index': target, 'alias': next_alias}}])
+    time.sleep(2 * dual_write_ttl)
+
+    body = {
+        'conflicts': 'proceed',
+        'source': {'index': source},
+        'dest': {'index': target, 'version_type': 'external'},
+    }
+    if removed:
+        body['script'] = {'source': ' '.join(f"ctx._source.remove('{field}');" for field in removed)}
+
+    response = requests.post(
+        urljoin(url, f'_reindex?wait_for_completion=false&slices=auto&requests_per_second={rps}'),
+        json=body
+    )
+    if not response.ok:
+        # без алиаса ETL перестанет дублировать запись в индекс, который не наполнится
+        update_aliases(url, [{'remove': {'index': target, 'alias': next_alias}}])
+        response.raise_for_status()
+    task = response.json()['task']
+
+    # задача и исходный индекс хранятся в _meta нового индекса для --follow
+    requests.put(
+        urljoin(url, f'{target}/_mapping'),
+        json={'_meta': {**meta, 'reindex_task': task, 'reindex_source': source}}
+    ).raise_for_status()
+    logger.info('start reindex %s -> %s, task %s', source, target, task)
+
+
+def init_schema(url, name: str, schema_json: json, rps: float):
+    """
+    Создает ES индекс согласно переданной json схеме.
+    Индекс называется <name>_<хеш схемы>, а name - алиас на него. Новые поля добавляются
+    в маппинг текущего индекса, при прочих совместимых изменениях маппинга или анализаторов
+    данные переносятся серверным _reindex, а несовместимые смены типа требуют переиндексации
+    из Postgres через ETL.
+    """
+    digest = schema_hash(schema_json)
+    target = f'{name}_{digest}'
+    meta = {'schema_hash': digest}
+
+    current = resolve_index(url, name)
+    if current is None:
+        if create_index(url, target, schema_json, meta):
+            update_aliases(url, [{'add': {'index': target, 'alias': name}}])
+        return
+
+    if current == target or get_meta(url, current).get('schema_hash') == digest:
+        logger.info('es schema %s is up to date', name)
+        return
+
+    if resolve_index(url, f'{name}{dual_write_suffix}') == target:
+        logger.info('reindex into %s is already in progress', target)
+        return
+
+    diff = diff_schema(url, current, schema_json)
+    if not any(diff.values()):
+        logger.info('es schema %s is up to date', name)
+        return
+
+    logger.info('es schema %s differs from %s: %s', name, current, diff)
+    nested_removed = [path for path in diff['removed'] if '.' in path]
+    if nested_removed or diff['incompatible']:
+        logger.error(
+            'es schema %s: fields %s need data from Postgres, reindex %s with ETL',
+            name, nested_removed + diff['incompatible'], name
+        )
+        return
+
+    if diff['added']:
+        # документы получат новые поля при следующей загрузке ETL
+        logger.info('es schema %s: fields %s are filled by ETL', name, diff['added'])
+        if not (diff['removed'] or diff['changed'] or diff['analysis']):
+            put_mapping(url, current, schema_json, {**get_meta(url, current), **meta})
+            return
+
+    if create_index(url, target, schema_json, meta):
+        start_reindex(url, name, current, target, meta, diff['removed'], rps)
+
+
+def replay_deletes(url: str, source: str, target: str, page_size: int = 1000):
+    """
+    Повторяет в target удаления, сделанные во время _reindex. Документ, удаленный из обоих
+    индексов двойной записью, _reindex мог уже после этого скопировать из своего снимка.
+    Пока идет двойная запись, документ есть в target без source только в таком случае.
+    """
+    requests.post(urljoin(url, f'{source},{target}/_refresh')).raise_for_status()
+
+    replayed = 0
+    response = requests.post(
+        urljoin(url, f'{target}/_search'),
+        params={'scroll': '5m'},
+        json={'size': page_size, '_source': False, 'sort': ['_doc']}
+    )
+    while True:
+        response.raise_for_status()
+        page = response.json()
+        hits = page['hits']['hits']
+        if not hits:
+            break
+
+        response = requests.post(
+            urljoin(url, f'{source}/_mget'), json={'ids': [hit['_id'] for hit in hits]}, params={'_source': 'false'}
+        )
+        response.raise_for_status()
+        deleted = [doc['_id'] for doc in response.json()['docs'] if not doc.get('found')]
+        if deleted:
+            bulk = ''.join(json.dumps({'delete': {'_index': target, '_id': id}}) + '\n' for id in deleted)
+            requests.post(
+                urljoin(url, '_bulk'), data=bulk, headers={'Content-Type': 'application/x-ndjson'}
+            ).raise_for_status()
+            replayed += len(deleted)
+
+        response = requests.post(urljoin(url, '_search/scroll'), json={'scroll': '5m', 'scroll_id': page['_scroll_id']})
+
+    requests.delete(urljoin(url, '_search/scroll'), json={'scroll_id': page['_scroll_id']})
+    logger.info('replay %s deletes from %s into %s', replayed, source, target)
+
+
+def follow_reindex(url: str, name: str, poll_interval: float):
+    """ Отслеживает ход _reindex и после его завершения переключает алиас name на новый индекс. """
+    next_alias = f'{name}{dual_write_suffix}'
+    target = resolve_index(url, next_alias)
+    if target is None:
+        return
+
+    meta = get_meta(url, target)
+    source = meta['reindex_source']
+
+    while True:
+        status = requests.get(urljoin(url, f'_tasks/{meta["reindex_task"]}')).json()
+        progress = status['task']['status']
+        logger.info(
+            'reindex %s -> %s: %s of %s documents, %s conflicts',
+            source, target, progress['created'] + progress['updated'], progress['total'],
+            progress['version_conflicts']
+        )
+        if status.get('completed'):
+            break
+        time.sleep(poll_interval)
+
+    failures = status.get('error') or status.get('response', {}).get('failures')
+    if failures:
+        update_aliases(url, [{'remove': {'index': target, 'alias': next_alias}}])
+        logger.error('reindex %s -> %s failed, dual writes stopped: %s', source, target, failures)
+        return
+
+    replay_deletes(url, source, target)
+
+    if source == name:
+        # прежний индекс занимает имя алиаса и удаляется в том же атомарном запросе
+        switch = {'remove_index': {'index': source}}
     else:
-        logger.error('error create es schema %s', response.text)
+        switch = {'remove': {'index': source, 'alias': name}}
+
+    update_aliases(url, [
+        switch,
+        {'add': {'index': target, 'alias': name}},
+        {'remove': {'index': target, 'alias': next_alias}},
+    ])
+    logger.info('switch %s to %s', name, target)
+    if source != name:
+        logger.info('previous index %s is kept, delete it when no longer needed', source)
 
 
 if __name__ == '__main__':
     """ Процесс создания ES индексов загруженных в папку es_schemas. """
 
+    parser = argparse.ArgumentParser(description='Создание и миграция ES индексов')
+    parser.add_argument(
+        '--follow', action='store_true',
+        help='отслеживать запущенные _reindex и переключать алиасы после их завершения'
+    )
+    args = parser.parse_args()
+
     es_url = os.getenv('ES_URL', 'http://127.0.0.1:9200/')
+    # ограничение скорости _reindex, документов в секунду
+    reindex_rps = float(os.getenv('ES_REINDEX_RPS', 500))
     BASE_DIR = Path(__file__).resolve(strict=True).parent
     schemas = list(BASE_DIR.joinpath('schemas').glob('**/*.json'))
 
     for schema in schemas:
+        if args.follow:
+            follow_reindex(url=es_url, name=schema.stem, poll_interval=float(os.getenv('ES_REINDEX_POLL', 30)))
+            continue
+
         with open(str(schema), 'r') as f:
             schema_json = json.load(f)
-            init_schema(url=es_url, name=schema.stem, schema_json=schema_json)
+            init_schema(url=es_url, name=schema.stem, schema_json=schema_json, rps=reindex_rps)
@@ -11,17 +11,10 @@ done
 echo "try create es index"
 python3 create_es_schemas.py
 
+# переключение алиасов после серверного _reindex изменившихся схем
+python3 create_es_schemas.py --follow &
 
-while true
-do
-
-echo "start genre_etl"
-python3  postgres_to_es_refactored/genre_etl.py
-
-echo "start person_etl"
-python3  postgres_to_es_refactored/person_etl.py
 
-echo "next launch in" $ETL_SLEEP_TIME
-sleep $ETL_SLEEP_TIME
-
-done
+# интервалы опроса подстраиваются под поток изменений, см. ETL_<ENTITY>_MIN_INTERVAL/MAX_INTERVAL/JITTER
+echo "start etl scheduler"
+python3 scheduler.py
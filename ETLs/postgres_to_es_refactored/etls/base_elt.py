@@ -1,19 +1,95 @@
-from datetime import datetime
-from typing import Tuple
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
 
+from new_etl.config import (
+    dsl, governor, governor_enabled, json_passthrough, max_tries, slow_query_explain_rate, slow_query_threshold,
+    suggest_enabled, suggest_index
+)
 from new_etl.es_loader import ESLoader
+from psycopg2.errors import LockNotAvailable, QueryCanceled
 from psycopg2.extensions import connection as pg_connection
+from utils.governor import BatchLimit, PgGovernor
+from utils.logger import logger
+from utils.replica import replica_lag
+from utils.slow_query import execute
 from utils.state import State
 from utils.utils import coroutine
 
+# общий для всех запусков ETL в процессе, чтобы размер пачек не сбрасывался между циклами
+pg_governor = PgGovernor(dsl, **governor) if governor_enabled else None
+
 
 class BaseETL:
     """ Базовый класс для ETL процессов. """
 
-    def __init__(self, conn: pg_connection, es_loader: ESLoader, state: State):
+    # размер пачки id при выборке изменений
+    batch_size = 100
+    # дешевый запрос, результат которого меняется при любых изменениях данных ETL
+    probe_sql = None
+    # запрос extract, в котором Postgres сам собирает документ индекса (json_passthrough)
+    passthrough_sql = None
+    # сущность в журнале удалений cinema.tombstone (sql/tombstones.sql)
+    tombstone_entity = None
+    # документы индекса только частично обновляются своими полями (ESLoader, PARTIAL_UPDATE_SCRIPT)
+    partial_update = False
+
+    def __init__(
+        self,
+        conn: pg_connection,
+        es_loader: ESLoader,
+        state: State,
+        replica_conn: Optional[pg_connection] = None,
+    ):
         self.es_loader = es_loader
         self.conn = conn
+        # соединение для тяжелых выборок extract, без реплики - основное
+        self.replica_conn = replica_conn or conn
         self.state = state
+        self.extracted = 0
+
+    @property
+    def batch_limit(self) -> BatchLimit:
+        """ Размер пачки id, уменьшенный ограничителем нагрузки на Postgres. """
+        return BatchLimit(self.batch_size, pg_governor)
+
+    @staticmethod
+    def _execute(cur, sql: str, params: tuple):
+        """
+        Выполняет запрос, медленные запросы логируются вместе с планом. Запрос, прерванный
+        statement_timeout или lock_timeout, откатывается до точки сохранения и повторяется
+        до max_tries раз: транзакция ETL продолжается, а LIMIT (BatchLimit) уже уменьшен.
+        """
+        conn = cur.connection
+        for attempt in range(1, max_tries + 1):
+            if pg_governor:
+                pg_governor.throttle()
+
+            # команды точки сохранения идут отдельным курсором, чтобы не затереть результат запроса
+            with conn.cursor() as savepoint_cur:
+                if not conn.autocommit:
+                    savepoint_cur.execute('SAVEPOINT etl_query')
+                try:
+                    execute(cur, sql, params, slow_query_threshold, slow_query_explain_rate)
+                except (QueryCanceled, LockNotAvailable) as e:
+                    if not conn.autocommit:
+                        savepoint_cur.execute('ROLLBACK TO SAVEPOINT etl_query')
+                    if pg_governor:
+                        pg_governor.on_timeout()
+                    if attempt == max_tries:
+                        raise
+                    logger.warning('query canceled (%s), retry %s of %s', str(e).strip(), attempt, max_tries)
+                    continue
+
+                if not conn.autocommit:
+                    savepoint_cur.execute('RELEASE SAVEPOINT etl_query')
+                return
+
+    @staticmethod
+    def _partition_state_key(name: str, partition: int, partitions: int) -> str:
+        """ Ключ состояния партиции, у каждой партиции свой прогресс. """
+        if partitions == 1:
+            return name
+        return f'{name}_{partition}_of_{partitions}'
 
     def _get_filter_period(self, name: str) -> Tuple:
         """ Возвращает время послелнего процесса elt и текущее время. """
@@ -22,18 +98,84 @@ class BaseETL:
             state_time = datetime(year=2000, month=1, day=1)
 
         # зафиксируем время начала процесса,
-        # если изменения произойдут во время работы etl мы их обработает в следующий раз
+        # если изменения произойдут во время работы etl мы их обработает в следующий раз;
+        # изменения, которые реплика еще не воспроизвела, тоже остаются на следующий раз
         start_time = datetime.now()
+        if self.replica_conn is not self.conn:
+            start_time -= timedelta(seconds=replica_lag(self.replica_conn))
         return state_time, start_time
 
+    def _get_window(self, name: str) -> Tuple:
+        """
+        Возвращает окно изменений и последний загруженный id.
+        Если прошлый запуск прервался посреди окна, продолжает его с сохраненного курсора.
+        """
+        cursor = self.state.get_state(f'{name}_cursor')
+        if cursor:
+            logger.info('resume %s window %s - %s after id %s', name, *cursor)
+            return tuple(cursor)
+
+        state_time, start_time = self._get_filter_period(name)
+        return state_time, start_time, ''
+
+    def _ack_batch(self, name: str, state_time, start_time, last_id: str):
+        """ Сохраняет курсор после загруженной в ElasticSearch пачки: после сбоя повторится не больше пачки. """
+        self.state.set_state(f'{name}_cursor', [state_time, start_time, last_id])
+
+    def _finish_window(self, name: str, start_time):
+        """ Окно обработано целиком: сдвигаем время и сбрасываем курсор. """
+        self.state.set_state(name, start_time)
+        self.state.set_state(f'{name}_cursor', None)
+
     @staticmethod
     def transform(data: dict) -> dict:
         raise NotImplementedError
 
+    @staticmethod
+    def suggest(data: dict) -> dict:
+        """ Подсказки автодополнения для пачки, по умолчанию их нет. """
+        return {}
+
+    @staticmethod
+    def transform_raw(data: dict) -> dict:
+        """ Документы уже собраны Postgres, их JSON передается в ElasticSearch без разбора. """
+        return {row['id']: {'id': row['id'], '_version': row['version'], '_raw': row['doc']} for row in data}
+
+    def delete_removed(self, index_name: str):
+        """ Удаляет из индекса и подсказок документы записей из журнала cinema.tombstone. """
+        sql = '''
+            SELECT seq, entity_id
+            FROM cinema.tombstone
+            WHERE entity = %s AND seq > %s
+            ORDER BY seq
+            LIMIT %s
+        '''
+        state_key = f'{self.tombstone_entity}_tombstone_seq'
+        seq = self.state.get_state(state_key) or 0
+        while True:
+            cur = self.conn.cursor()
+            self._execute(cur, sql, (self.tombstone_entity, seq, self.batch_limit))
+            rows = cur.fetchall()
+            if not rows:
+                return
+
+            ids = [row['entity_id'] for row in rows]
+            self.es_loader.delete_from_es(ids, index_name)
+            if suggest_enabled and type(self).suggest is not BaseETL.suggest:
+                self.es_loader.delete_from_es(ids, suggest_index)
+
+            seq = rows[-1]['seq']
+            logger.info('deleted %s %s', len(ids), self.tombstone_entity)
+            self.state.set_state(state_key, seq)
+
     @coroutine
     def load(self, index_name: str):
         """ Обрабатывает полученную пачку данных методом transform и загружает в ElasticSearch. """
         while True:
             data = (yield)
-            records = self.transform(data)
-            self.es_loader.load_to_es(records, index_name)
+            records = self.transform_raw(data) if json_passthrough else self.transform(data)
+            self.es_loader.load_to_es(records, index_name, partial=self.partial_update)
+
+            suggestions = self.suggest(data) if suggest_enabled else {}
+            if suggestions:
+                self.es_loader.load_to_es(suggestions, suggest_index)
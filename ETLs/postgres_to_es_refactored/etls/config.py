@@ -1,20 +1,78 @@
 import os
 
 
-# postgres
+# postgres: сессии ETL видны в pg_stat_activity под своим именем, а таймауты (мс)
+# не дают запросам ETL ждать блокировок OLTP-транзакций и выполняться бесконечно
 dsl = {
     'dbname': os.getenv('PG_DB'),
     'user': os.getenv('PG_USER'),
     'password': os.getenv('PG_PASS'),
     'host': os.getenv('PG_HOST'),
     'port': os.getenv('PG_PORT'),
+    'application_name': os.getenv('PG_APPLICATION_NAME', 'movies_etl'),
+    'options': '-c statement_timeout={} -c lock_timeout={}'.format(
+        os.getenv('PG_STATEMENT_TIMEOUT', 60000), os.getenv('PG_LOCK_TIMEOUT', 1000)
+    ),
 }
 
+# ограничитель нагрузки (utils/governor.py): пока задержка пробного запроса (с), число активных
+# сессий или отставание реплик (с) вне бюджета, ETL ждет и уменьшает пачки
+governor_enabled = os.getenv('PG_GOVERNOR', 'false') == 'true'
+governor = {
+    'interval': float(os.getenv('PG_GOVERNOR_INTERVAL', 1)),
+    'max_latency': float(os.getenv('PG_GOVERNOR_MAX_LATENCY', 0.05)),
+    'max_active_sessions': int(os.getenv('PG_GOVERNOR_MAX_ACTIVE_SESSIONS', 20)),
+    'max_replica_lag': float(os.getenv('PG_GOVERNOR_MAX_REPLICA_LAG', 10)),
+    'max_pause': float(os.getenv('PG_GOVERNOR_MAX_PAUSE', 30)),
+    # дольше этого ETL не ждет возврата нагрузки в бюджет
+    'max_wait': float(os.getenv('PG_GOVERNOR_MAX_WAIT', 300)),
+}
+
+# реплики для тяжелых выборок extract (хосты через запятую, остальные параметры как у dsl);
+# поиск изменений идет на основном сервере, а окно изменений отстает на лаг реплики
+replica_hosts = [host for host in os.getenv('PG_REPLICA_HOSTS', '').split(',') if host]
+
 # ElasticSearch
 es_url = os.getenv('ES_URL')
 
 storage_path = os.getenv('STORAGE', '/storage/state.json')
 
+# версия документа в ES - время чтения снимка из Postgres (version_type=external)
+external_versioning = os.getenv('ES_EXTERNAL_VERSIONING', 'true') == 'true'
+
+# документы genres и persons собирает Postgres (json_build_object),
+# а их JSON уходит в bulk-запрос без разбора в Python
+json_passthrough = os.getenv('ES_JSON_PASSTHROUGH', 'false') == 'true'
+
+# пока create_es_schemas.py переносит индекс серверным _reindex, ETL пишет и в новый индекс
+# через алиас <index>_next; его наличие перепроверяется не чаще раза в dual_write_ttl секунд
+dual_write_suffix = '_next'
+dual_write_ttl = float(os.getenv('ES_DUAL_WRITE_TTL', 10))
+
+# индекс подсказок автодополнения (schemas/suggest.json): имена персон с весом по числу фильмов
+suggest_enabled = os.getenv('ES_SUGGEST', 'false') == 'true'
+suggest_index = os.getenv('ES_SUGGEST_INDEX', 'suggest')
+
+# горизонтальное масштабирование: число хеш-партиций id, которые реплики делят
+# через advisory-локи; при partitions > 1 состояние хранится в Postgres
+partitions = int(os.getenv('ETL_PARTITIONS', 1))
+state_table = os.getenv('ETL_STATE_TABLE', 'etl_state')
+
+# адаптивный планировщик запусков ETL, интервалы в секундах
+schedule = {
+    name: {
+        'min_interval': float(os.getenv(f'ETL_{name.upper()}_MIN_INTERVAL', 1)),
+        'max_interval': float(os.getenv(f'ETL_{name.upper()}_MAX_INTERVAL', 300)),
+        'jitter': float(os.getenv(f'ETL_{name.upper()}_JITTER', 0.1)),
+    }
+    for name in ('genre', 'person')
+}
+
+# медленные запросы extract: логируются дольше порога (секунды),
+# а для доли slow_query_explain_rate из них план EXPLAIN ANALYZE пишется в slow_queries.log
+slow_query_threshold = float(os.getenv('SLOW_QUERY_THRESHOLD', 1))
+slow_query_explain_rate = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+
 # back_off
 max_tries = 5
 max_time = 300
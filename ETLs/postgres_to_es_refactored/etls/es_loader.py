@@ -1,5 +1,6 @@
 import json
-from typing import Dict, List
+import time
+from typing import Dict, Iterable, List, Optional
 from urllib.parse import urljoin
 
 import backoff
@@ -7,31 +8,89 @@ import requests
 from utils.logger import logger
 from utils.utils import default_json_encoder
 
-from .config import max_time, max_tries
+from .config import dual_write_suffix, dual_write_ttl, external_versioning, max_time, max_tries
+
+
+# частичное обновление с проверкой версии: поля документа заменяются, только если снимок
+# новее записанного в etl_version, остальные поля (статистику жанров ведет ETL схемы content) не трогаются
+PARTIAL_UPDATE_SCRIPT = (
+    'if (params.version == null || ctx._source.etl_version == null '
+    '|| ctx._source.etl_version < params.version) {'
+    ' ctx._source.putAll(params.doc);'
+    ' if (params.version != null) { ctx._source.etl_version = params.version; }'
+    ' } else { ctx.op = "none"; }'
+)
 
 
 class ESLoader:
     """ Класс для загрузки данных в ElasticSearch. """
     def __init__(self, url: str):
         self.url = url
+        self.version_conflicts = 0
+        self._next_aliases = {}
+
+    def _next_alias(self, index_name: str) -> Optional[str]:
+        """ Алиас нового индекса, в который идет _reindex (create_es_schemas.py), если он есть. """
+        checked_at, exists = self._next_aliases.get(index_name, (0, False))
+        if time.monotonic() - checked_at >= dual_write_ttl:
+            response = requests.head(urljoin(self.url, f'_alias/{index_name}{dual_write_suffix}'))
+            exists = response.status_code == 200
+            self._next_aliases[index_name] = (time.monotonic(), exists)
+
+        return f'{index_name}{dual_write_suffix}' if exists else None
 
     @staticmethod
-    def _get_es_bulk_query(rows: Dict, index_name: str) -> List[str]:
-        """ Подготавливает bulk-запрос в ElasticSearch. """
+    def _get_es_bulk_query(
+        rows: Dict, index_name: str, require_alias: bool = False, partial: bool = False
+    ) -> List[str]:
+        """
+        Подготавливает bulk-запрос в ElasticSearch, _version записи уходит во внешнюю версию документа.
+        Если в записи есть _raw, вместо записи в запрос подставляется этот готовый JSON документа.
+        При partial документ не заменяется, а обновляются только его поля (PARTIAL_UPDATE_SCRIPT).
+        """
         prepared_query = []
         for row in rows.values():
+            row = dict(row)
+            action = {'_index': index_name, '_id': row['id']}
+            if require_alias:
+                # алиас уже сняли - не создавать вместо него новый индекс
+                action['require_alias'] = True
+            version = row.pop('_version', None)
+            if not external_versioning:
+                version = None
+
+            raw_source = row.pop('_raw', None)
+            source = raw_source if raw_source is not None else json.dumps(row, default=default_json_encoder)
+
+            if partial:
+                # документ подставляется в параметры скрипта как есть, без повторного разбора _raw
+                params = f'{{"version": {json.dumps(version)}, "doc": {source}}}'
+                script = f'{{"source": {json.dumps(PARTIAL_UPDATE_SCRIPT)}, "params": {params}}}'
+                prepared_query.extend([
+                    json.dumps({'update': action}, default=default_json_encoder),
+                    f'{{"scripted_upsert": true, "upsert": {{}}, "script": {script}}}',
+                ])
+                continue
+
+            if version is not None:
+                action.update(version=version, version_type='external')
             prepared_query.extend([
-                json.dumps(
-                    {'index': {'_index': index_name, '_id': row['id']}}),
-                json.dumps(row, default=default_json_encoder)
+                json.dumps({'index': action}, default=default_json_encoder),
+                source
             ])
         return prepared_query
 
     @backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
                           max_tries=max_tries, max_time=max_time, logger=logger)
-    def load_to_es(self, records: Dict, index_name: str):
+    def load_to_es(self, records: Dict, index_name: str, partial: bool = False):
         """ Отправка запроса в ES и разбор ошибок сохранения данных. """
-        prepared_query = self._get_es_bulk_query(records, index_name)
+        prepared_query = self._get_es_bulk_query(records, index_name, partial=partial)
+        next_alias = self._next_alias(index_name)
+        if next_alias:
+            # двойная запись на время _reindex
+            prepared_query.extend(
+                self._get_es_bulk_query(records, next_alias, require_alias=True, partial=partial)
+            )
         str_query = '\n'.join(prepared_query) + '\n'
 
         response = requests.post(
@@ -42,7 +101,41 @@ class ESLoader:
         logger.info('bulk %s objects with status %s', len(records), response.status_code)
 
         json_response = json.loads(response.content.decode())
+        conflicts = 0
         for item in json_response['items']:
-            error_message = item['index'].get('error')
+            _action, result = next(iter(item.items()))
+            error_message = result.get('error')
+            if (error_message and result.get('status') == 409) or result.get('result') == 'noop':
+                # в индексе уже более новый снимок документа
+                conflicts += 1
+            elif error_message:
+                logger.error(error_message)
+
+        if conflicts:
+            self.version_conflicts += conflicts
+            logger.info('skip %s stale objects (version conflict)', conflicts)
+
+    @backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
+                          max_tries=max_tries, max_time=max_time, logger=logger)
+    def delete_from_es(self, ids: Iterable[str], index_name: str):
+        """ Удаляет документы с переданными id, на время _reindex и из нового индекса. """
+        index_names = [index_name]
+        next_alias = self._next_alias(index_name)
+        if next_alias:
+            index_names.append(next_alias)
+        str_query = ''.join(
+            json.dumps({'delete': {'_index': name, '_id': str(id)}}) + '\n' for name in index_names for id in ids
+        )
+
+        response = requests.post(
+            urljoin(self.url, '_bulk'),
+            data=str_query,
+            headers={'Content-Type': 'application/x-ndjson'}
+        )
+        logger.info('bulk delete from %s with status %s', index_name, response.status_code)
+
+        # удаление отсутствующего документа (status 404) ошибкой не считается
+        for item in json.loads(response.content.decode())['items']:
+            error_message = item['delete'].get('error')
             if error_message:
                 logger.error(error_message)
@@ -1,40 +1,48 @@
 import backoff
 import psycopg2
 from new_etl.base_elt import BaseETL
-from new_etl.config import dsl, es_url, max_time, max_tries, storage_path
+from new_etl.config import (
+    dsl, es_url, json_passthrough, max_time, max_tries, partitions, replica_hosts, state_table, storage_path
+)
 from new_etl.es_loader import ESLoader
+from new_etl.queries import GENRE_EXTRACT_SQL, GENRE_PASSTHROUGH_SQL, GENRE_WINDOW_SQL
 from psycopg2.extras import DictCursor
 from utils.logger import logger
-from utils.state import JsonFileStorage, State
+from utils.partition import PartitionLock
+from utils.replica import connect_replica
+from utils.state import JsonFileStorage, PostgresStorage, State
 from utils.utils import coroutine
 
 
 class GenreETL(BaseETL):
     """ ETL обработки изменений в жанрах. """
 
+    batch_size = 10
+    tombstone_entity = 'genre'
+    # статистику в документах жанров ведет ETL схемы content (postgres_to_es, GENRE_STATS)
+    partial_update = True
+    # удаление жанра не меняет max(updated_at), поэтому в маркер входит и журнал удалений
+    probe_sql = '''
+        SELECT concat(
+            (SELECT max(updated_at) FROM cinema.genre), '/',
+            (SELECT max(seq) FROM cinema.tombstone WHERE entity = 'genre')
+        )
+    '''
+    # документ в формате schemas/genres.json
+    passthrough_sql = GENRE_PASSTHROUGH_SQL
+
     @coroutine
     @backoff.on_exception(backoff.expo, psycopg2.Error, max_tries=max_tries, max_time=max_time, logger=logger)
-    def extract_genres(self, target):
+    def extract_genres(self, target, partition: int = 0, partitions: int = 1):
         """ Корутина выгружает пачки жанров, которые изменились с момента сохраненного в state. """
-        sql = '''
-            WITH params (time_from, time_to, ids) as (values (%s, %s, %s))
-            SELECT id
-            FROM cinema.genre, params
-            WHERE CASE
-                WHEN ids=''
-                    THEN updated_at BETWEEN time_from::timestamp  AND time_to::timestamp
-                    ELSE updated_at BETWEEN time_from::timestamp  AND time_to::timestamp and id > ids::uuid
-                END
-            ORDER BY id, updated_at
-            LIMIT 10
-        '''
-        state_time, start_time = self._get_filter_period('genre_elt_time')
-        ids = ''
+        sql = GENRE_WINDOW_SQL
+        state_key = self._partition_state_key('genre_elt_time', partition, partitions)
+        state_time, start_time, ids = self._get_window(state_key)
         logger.info('start extract_genres state time %s start time %s', state_time, start_time)
         while True:
             genre_ids = []
             cur = self.conn.cursor()
-            cur.execute(sql, (state_time, start_time, ids))
+            self._execute(cur, sql, (state_time, start_time, ids, partitions, partition, self.batch_limit))
 
             last_id = ''
             for genre in cur:
@@ -45,10 +53,13 @@ class GenreETL(BaseETL):
 
             if genre_ids:
                 logger.info('extract_genres send %s', len(genre_ids))
+                self.extracted += len(genre_ids)
                 target.send(genre_ids)
+                # пачка загружена в ElasticSearch
+                self._ack_batch(state_key, state_time, start_time, ids)
             else:
                 # данные закончились, сохраним время и выйдем из корутины
-                self.state.set_state('genre_elt_time', start_time)
+                self._finish_window(state_key, start_time)
                 logger.info('stop extract_genres  %s  %s', state_time, ids)
                 raise GeneratorExit
 
@@ -56,18 +67,14 @@ class GenreETL(BaseETL):
     @backoff.on_exception(backoff.expo, psycopg2.Error, max_tries=max_tries, max_time=max_time, logger=logger)
     def extract(self, target):
         """ Корутина получения полных данных по жанру из Postgres. """
-        sql = '''
-            SELECT
-                g.id as genre_id,
-                g.title as title,
-                g.description as description
-            FROM cinema.genre g
-            WHERE g.id IN %s;
-           '''
+        sql = GENRE_EXTRACT_SQL
+        if json_passthrough:
+            sql = self.passthrough_sql
+
         while True:
             genre_ids = (yield)
-            cur = self.conn.cursor()
-            cur.execute(sql, (tuple(genre_ids),))
+            cur = self.replica_conn.cursor()
+            self._execute(cur, sql, (tuple(genre_ids),))
             data = cur.fetchall()
             logger.info('extract send %s ', len(genre_ids))
             target.send(data)
@@ -83,23 +90,47 @@ class GenreETL(BaseETL):
                     'id': genre_id,
                     'title': row['title'],
                     'description': row['description'],
+                    '_version': row['version'],
                 }
 
         return records
 
 
-if __name__ == "__main__":
+def run_genre_etl() -> GenreETL:
     """ Запускает ETL Process обработки изменений жанров. """
 
     loader = ESLoader(url=es_url)
-    storage = JsonFileStorage(storage_path)
+
+    # в распределенном режиме реплики делят партиции и хранят состояние в Postgres
+    shared_conn = psycopg2.connect(**dsl) if partitions > 1 else None
+    storage = PostgresStorage(shared_conn, state_table) if shared_conn else JsonFileStorage(storage_path)
+
+    replica_conn = connect_replica(dsl, replica_hosts, cursor_factory=DictCursor)
 
     with psycopg2.connect(**dsl, cursor_factory=DictCursor) as pg_conn:
-        etl = GenreETL(conn=pg_conn, es_loader=loader, state=State(storage))
-        try:
-            load_data = etl.load('genres')
-            all_data = etl.extract(load_data)
-            etl.extract_genres(all_data)
-
-        except GeneratorExit:
-            logger.info('exit genre ETL')
+        etl = GenreETL(conn=pg_conn, es_loader=loader, state=State(storage), replica_conn=replica_conn)
+        partition_lock = PartitionLock(shared_conn, 'genre_etl', partitions) if shared_conn else None
+        claimed = partition_lock.claim_each() if partition_lock else [0]
+
+        for partition in claimed:
+            # до захвата партиции ее состояние могла продвинуть другая реплика
+            etl.state.refresh()
+            if partition == 0:
+                # журнал удалений общий, его разбирает реплика с нулевой партицией
+                etl.delete_removed('genres')
+            try:
+                load_data = etl.load('genres')
+                all_data = etl.extract(load_data)
+                etl.extract_genres(all_data, partition, partitions)
+
+            except GeneratorExit:
+                logger.info('exit genre ETL partition %s', partition)
+
+    if replica_conn:
+        replica_conn.close()
+
+    return etl
+
+
+if __name__ == "__main__":
+    run_genre_etl()
@@ -1,40 +1,52 @@
 import backoff
 import psycopg2
 from new_etl.base_elt import BaseETL
-from new_etl.config import dsl, es_url, max_time, max_tries, storage_path
+from new_etl.config import (
+    dsl, es_url, json_passthrough, max_time, max_tries, partitions, replica_hosts, state_table, storage_path
+)
 from new_etl.es_loader import ESLoader
+from new_etl.queries import (
+    PERSON_BY_FILMS_WINDOW_SQL, PERSON_EXTRACT_SQL, PERSON_PASSTHROUGH_SQL, PERSON_WINDOW_SQL
+)
 from psycopg2.extras import DictCursor
 from utils.logger import logger
-from utils.state import JsonFileStorage, State
-from utils.utils import coroutine
+from utils.partition import PartitionLock
+from utils.replica import connect_replica
+from utils.state import JsonFileStorage, PostgresStorage, State
+from models.movie import MovieRole
+from utils.utils import coroutine, suggest_inputs
 
 
 class PersonETL(BaseETL):
     """ ETL обработки изменений в персонах. """
 
+    batch_size = 100
+    tombstone_entity = 'person'
+    # удаление персоны не меняет max(updated_at), поэтому в маркер входит и журнал удалений
+    probe_sql = '''
+        SELECT concat(
+            greatest(
+                (SELECT max(updated_at) FROM cinema.person),
+                (SELECT max(updated_at) FROM cinema.film_work)
+            ), '/',
+            (SELECT max(seq) FROM cinema.tombstone WHERE entity = 'person')
+        )
+    '''
+    # документ в формате schemas/persons.json, те же поля, что собирает transform
+    passthrough_sql = PERSON_PASSTHROUGH_SQL
+
     @coroutine
     @backoff.on_exception(backoff.expo, psycopg2.Error, max_tries=max_tries, max_time=max_time, logger=logger)
-    def extract_persons(self, target):
+    def extract_persons(self, target, partition: int = 0, partitions: int = 1):
         """ Корутина выгружает пачки персон, которые изменились с момента сохраненного в state. """
-        sql = '''
-            WITH params (time_from, time_to, ids) as (values (%s, %s, %s))
-            SELECT id
-            FROM cinema.person, params
-            WHERE CASE
-                WHEN ids=''
-                    THEN updated_at BETWEEN time_from::timestamp  AND time_to::timestamp
-                    ELSE updated_at BETWEEN time_from::timestamp  AND time_to::timestamp and id > ids::uuid
-                END
-            ORDER BY id, updated_at
-            LIMIT 100
-        '''
-        state_time, start_time = self._get_filter_period('person_elt_time')
-        ids = ''
+        sql = PERSON_WINDOW_SQL
+        state_key = self._partition_state_key('person_elt_time', partition, partitions)
+        state_time, start_time, ids = self._get_window(state_key)
         logger.info('start extract_persons state time %s start time %s', state_time, start_time)
         while True:
             person_ids = []
             cur = self.conn.cursor()
-            cur.execute(sql, (state_time, start_time, ids))
+            self._execute(cur, sql, (state_time, start_time, ids, partitions, partition, self.batch_limit))
 
             last_id = ''
             for person in cur:
@@ -45,28 +57,59 @@ class PersonETL(BaseETL):
 
             if person_ids:
                 logger.info('extract persons send %s', len(person_ids))
+                self.extracted += len(person_ids)
                 target.send(person_ids)
+                # пачка загружена в ElasticSearch
+                self._ack_batch(state_key, state_time, start_time, ids)
             else:
                 # данные закончились, сохраним время и выйдем из корутины
-                self.state.set_state('person_elt_time', start_time)
+                self._finish_window(state_key, start_time)
                 logger.info('stop extract persons  %s  %s', state_time, ids)
                 raise GeneratorExit
 
+    @coroutine
+    @backoff.on_exception(backoff.expo, psycopg2.Error, max_tries=max_tries, max_time=max_time, logger=logger)
+    def extract_persons_by_films(self, target, partition: int = 0, partitions: int = 1):
+        """ Корутина выгружает пачки персон из фильмов, которые изменились с момента сохраненного в state. """
+        sql = PERSON_BY_FILMS_WINDOW_SQL
+        state_key = self._partition_state_key('person_film_elt_time', partition, partitions)
+        state_time, start_time, ids = self._get_window(state_key)
+        logger.info('start extract_persons_by_films state time %s start time %s', state_time, start_time)
+        while True:
+            person_ids = []
+            cur = self.conn.cursor()
+            self._execute(cur, sql, (state_time, start_time, ids, partitions, partition, self.batch_limit))
+
+            last_id = ''
+            for person in cur:
+                last_id = person['id']
+                person_ids.append(last_id)
+
+            ids = last_id  # сохраним последний id для фильтрации
+
+            if person_ids:
+                logger.info('extract persons by films send %s', len(person_ids))
+                self.extracted += len(person_ids)
+                target.send(person_ids)
+                # пачка загружена в ElasticSearch
+                self._ack_batch(state_key, state_time, start_time, ids)
+            else:
+                self._finish_window(state_key, start_time)
+                logger.info('stop extract persons by films  %s  %s', state_time, ids)
+                raise GeneratorExit
+
     @coroutine
     @backoff.on_exception(backoff.expo, psycopg2.Error, max_tries=max_tries, max_time=max_time, logger=logger)
     def extract(self, target):
-        """ Корутина получения полных данных по персоне из Postgres. """
-        sql = '''
-            SELECT
-                p.id as person_id,
-                p.full_name as full_name
-            FROM cinema.person p
-            WHERE p.id IN %s;
-        '''
+        """ Корутина получения полных данных по персоне вместе с ее фильмами и ролями одним запросом. """
+        sql = PERSON_EXTRACT_SQL
+        if json_passthrough:
+            sql = self.passthrough_sql
+
         while True:
             person_ids = (yield)
-            cur = self.conn.cursor()
-            cur.execute(sql, (tuple(person_ids),))
+            cur = self.replica_conn.cursor()
+            self._execute(cur, sql, (tuple(person_ids), tuple(person_ids)))
             data = cur.fetchall()
             logger.info('extract send %s ', len(person_ids))
             target.send(data)
@@ -77,27 +120,84 @@ class PersonETL(BaseETL):
         records = {}
         for row in data:
             person_id = row['person_id']
-            if person_id not in records:
-                records[person_id] = {
-                    'id': person_id,
-                    'full_name': row['full_name'],
-                }
+            if person_id in records:
+                continue
+
+            films = row['films']
+            films_count = {role.value: 0 for role in MovieRole}
+            for film in films:
+                for role in film['roles']:
+                    films_count[role] = films_count.get(role, 0) + 1
+
+            records[person_id] = {
+                'id': person_id,
+                'full_name': row['full_name'],
+                'roles': [role for role, count in films_count.items() if count],
+                'film_ids': [film['id'] for film in films],
+                'films': films,
+                'films_count': films_count,
+                '_version': row['version'],
+            }
 
         return records
 
+    @staticmethod
+    def suggest(data: dict) -> dict:
+        """ Подсказки автодополнения по имени персоны, вес - число ее фильмов. """
+        return {
+            row['person_id']: {
+                'id': row['person_id'],
+                'type': 'person',
+                'title': row['full_name'],
+                'suggest': {'input': suggest_inputs(row['full_name']), 'weight': row['films_total']},
+                '_version': row['version'],
+            }
+            for row in data
+        }
 
-if __name__ == "__main__":
+
+def run_person_etl() -> PersonETL:
     """ Запускает ETL Process обработки изменений персон. """
 
     loader = ESLoader(url=es_url)
-    storage = JsonFileStorage(storage_path)
+
+    # в распределенном режиме реплики делят партиции и хранят состояние в Postgres
+    shared_conn = psycopg2.connect(**dsl) if partitions > 1 else None
+    storage = PostgresStorage(shared_conn, state_table) if shared_conn else JsonFileStorage(storage_path)
+
+    replica_conn = connect_replica(dsl, replica_hosts, cursor_factory=DictCursor)
 
     with psycopg2.connect(**dsl, cursor_factory=DictCursor) as pg_conn:
-        etl = PersonETL(conn=pg_conn, es_loader=loader, state=State(storage))
-        try:
-            load_data = etl.load('persons')
-            all_data = etl.extract(load_data)
-            etl.extract_persons(all_data)
-
-        except GeneratorExit:
-            logger.info('exit person ETL')
+        etl = PersonETL(conn=pg_conn, es_loader=loader, state=State(storage), replica_conn=replica_conn)
+        partition_lock = PartitionLock(shared_conn, 'person_etl', partitions) if shared_conn else None
+        claimed = partition_lock.claim_each() if partition_lock else [0]
+
+        load_data = etl.load('persons')
+        all_data = etl.extract(load_data)
+        for partition in claimed:
+            # до захвата партиции ее состояние могла продвинуть другая реплика
+            etl.state.refresh()
+            if partition == 0:
+                # журнал удалений общий, его разбирает реплика с нулевой партицией
+                etl.delete_removed('persons')
+            try:
+                etl.extract_persons(all_data, partition, partitions)
+
+            except GeneratorExit:
+                logger.info('exit person ETL partition %s', partition)
+
+            # фильмографии персон обновляются при изменении их фильмов
+            try:
+                etl.extract_persons_by_films(all_data, partition, partitions)
+
+            except GeneratorExit:
+                logger.info('exit person by films ETL partition %s', partition)
+
+    if replica_conn:
+        replica_conn.close()
+
+    return etl
+
+
+if __name__ == "__main__":
+    run_person_etl()
@@ -0,0 +1,142 @@
+"""
+Запросы ETL схемы cinema. Вынесены в модуль без зависимостей, чтобы их без копирования
+проверял советник индексов postgres_to_es (src/advisor.py)
+"""
+
+# окно изменений жанров: (time_from, time_to, ids, partitions, partition, limit)
+GENRE_WINDOW_SQL = '''
+    WITH params (time_from, time_to, ids, partitions, partition) as (values (%s, %s, %s, %s, %s))
+    SELECT id
+    FROM cinema.genre, params
+    WHERE mod(hashtext(id::text) & 2147483647, partitions) = partition AND CASE
+        WHEN ids=''
+            THEN updated_at BETWEEN time_from::timestamp  AND time_to::timestamp
+            ELSE updated_at BETWEEN time_from::timestamp  AND time_to::timestamp and id > ids::uuid
+        END
+    ORDER BY id, updated_at
+    LIMIT %s
+'''
+
+GENRE_EXTRACT_SQL = '''
+    SELECT
+        g.id as genre_id,
+        g.title as title,
+        g.description as description,
+        (extract(epoch from statement_timestamp()) * 1000000)::bigint as version
+    FROM cinema.genre g
+    WHERE g.id IN %s;
+'''
+
+GENRE_PASSTHROUGH_SQL = '''
+    SELECT
+        g.id as id,
+        json_build_object(
+            'id', g.id,
+            'title', g.title,
+            'description', g.description
+        )::text as doc,
+        (extract(epoch from statement_timestamp()) * 1000000)::bigint as version
+    FROM cinema.genre g
+    WHERE g.id IN %s;
+'''
+
+# окно изменений персон: (time_from, time_to, ids, partitions, partition, limit)
+PERSON_WINDOW_SQL = '''
+    WITH params (time_from, time_to, ids, partitions, partition) as (values (%s, %s, %s, %s, %s))
+    SELECT id
+    FROM cinema.person, params
+    WHERE mod(hashtext(id::text) & 2147483647, partitions) = partition AND CASE
+        WHEN ids=''
+            THEN updated_at BETWEEN time_from::timestamp  AND time_to::timestamp
+            ELSE updated_at BETWEEN time_from::timestamp  AND time_to::timestamp and id > ids::uuid
+        END
+    ORDER BY id, updated_at
+    LIMIT %s
+'''
+
+# персоны из фильмов, изменившихся за окно, параметры те же
+PERSON_BY_FILMS_WINDOW_SQL = '''
+    WITH params (time_from, time_to, ids, partitions, partition) as (values (%s, %s, %s, %s, %s))
+    SELECT DISTINCT pfw.person_id as id
+    FROM cinema.film_work fw
+    JOIN cinema.person_film_work pfw ON pfw.film_work_id = fw.id, params
+    WHERE mod(hashtext(pfw.person_id::text) & 2147483647, partitions) = partition AND CASE
+        WHEN ids=''
+            THEN fw.updated_at BETWEEN time_from::timestamp  AND time_to::timestamp
+            ELSE fw.updated_at BETWEEN time_from::timestamp  AND time_to::timestamp and pfw.person_id > ids::uuid
+        END
+    ORDER BY pfw.person_id
+    LIMIT %s
+'''
+
+PERSON_EXTRACT_SQL = '''
+    WITH person_films AS (
+        SELECT
+            pfw.person_id,
+            pfw.film_work_id,
+            array_agg(DISTINCT pfw.role) as roles
+        FROM cinema.person_film_work pfw
+        WHERE pfw.person_id IN %s
+        GROUP BY pfw.person_id, pfw.film_work_id
+    )
+    SELECT
+        p.id as person_id,
+        p.full_name as full_name,
+        COALESCE(
+            json_agg(json_build_object('id', pf.film_work_id, 'roles', pf.roles))
+                FILTER (WHERE pf.film_work_id IS NOT NULL),
+            '[]'
+        ) as films,
+        count(pf.film_work_id) as films_total,
+        (extract(epoch from statement_timestamp()) * 1000000)::bigint as version
+    FROM cinema.person p
+    LEFT JOIN person_films pf ON pf.person_id = p.id
+    WHERE p.id IN %s
+    GROUP BY p.id, p.full_name;
+'''
+
+PERSON_PASSTHROUGH_SQL = '''
+    WITH person_films AS (
+        SELECT
+            pfw.person_id,
+            pfw.film_work_id,
+            array_agg(DISTINCT pfw.role) as roles
+        FROM cinema.person_film_work pfw
+        WHERE pfw.person_id IN %s
+        GROUP BY pfw.person_id, pfw.film_work_id
+    )
+    SELECT
+        p.id as id,
+        p.id as person_id,
+        p.full_name as full_name,
+        cardinality(c.film_ids) as films_total,
+        json_build_object(
+            'id', p.id,
+            'full_name', p.full_name,
+            'roles', array_remove(ARRAY[
+                CASE WHEN c.actor > 0 THEN 'actor' END,
+                CASE WHEN c.director > 0 THEN 'director' END,
+                CASE WHEN c.writer > 0 THEN 'writer' END
+            ], NULL),
+            'film_ids', c.film_ids,
+            'films', c.films,
+            'films_count', json_build_object('actor', c.actor, 'director', c.director, 'writer', c.writer)
+        )::text as doc,
+        (extract(epoch from statement_timestamp()) * 1000000)::bigint as version
+    FROM cinema.person p
+    CROSS JOIN LATERAL (
+        SELECT
+            COALESCE(array_agg(pf.film_work_id), '{}') as film_ids,
+            COALESCE(json_agg(json_build_object('id', pf.film_work_id, 'roles', pf.roles)), '[]') as films,
+            count(*) FILTER (WHERE 'actor' = ANY(pf.roles)) as actor,
+            count(*) FILTER (WHERE 'director' = ANY(pf.roles)) as director,
+            count(*) FILTER (WHERE 'writer' = ANY(pf.roles)) as writer
+        FROM person_films pf
+        WHERE pf.person_id = p.id
+    ) c
+    WHERE p.id IN %s;
+'''
+
+# запросы, которые советник индексов прогоняет через EXPLAIN
+WINDOW_QUERIES = [GENRE_WINDOW_SQL, PERSON_WINDOW_SQL, PERSON_BY_FILMS_WINDOW_SQL]
+EXTRACT_QUERIES = [GENRE_EXTRACT_SQL, GENRE_PASSTHROUGH_SQL, PERSON_EXTRACT_SQL, PERSON_PASSTHROUGH_SQL]
@@ -0,0 +1,42 @@
+import psycopg2
+from new_etl.config import dsl, schedule
+from new_etl.genre_etl import GenreETL, run_genre_etl
+from new_etl.person_etl import PersonETL, run_person_etl
+from utils.logger import logger
+from utils.scheduler import AdaptiveScheduler, EntitySchedule
+
+
+def make_probe(conn, sql: str):
+    """ Дешевая проверка наличия изменений перед запуском цикла ETL. """
+    def probe():
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            return cur.fetchone()[0]
+    return probe
+
+
+if __name__ == '__main__':
+    """ Запускает ETL жанров и персон с адаптивными интервалами опроса. """
+
+    probe_conn = psycopg2.connect(**dsl)
+    probe_conn.autocommit = True
+
+    schedules = [
+        EntitySchedule(
+            name='genre',
+            run=lambda: run_genre_etl().extracted,
+            probe=make_probe(probe_conn, GenreETL.probe_sql),
+            batch_size=GenreETL.batch_size,
+            **schedule['genre'],
+        ),
+        EntitySchedule(
+            name='person',
+            run=lambda: run_person_etl().extracted,
+            probe=make_probe(probe_conn, PersonETL.probe_sql),
+            batch_size=PersonETL.batch_size,
+            **schedule['person'],
+        ),
+    ]
+
+    logger.info('start ETL scheduler')
+    AdaptiveScheduler(schedules).run_forever()
@@ -0,0 +1,29 @@
+-- Журнал удаленных жанров и персон схемы cinema для переноса удалений в Elasticsearch.
+-- Удаленных записей нет в выборках изменений по updated_at, поэтому без журнала
+-- их документы и подсказки автодополнения остались бы в индексах навсегда.
+
+CREATE TABLE IF NOT EXISTS cinema.tombstone (
+    seq bigserial PRIMARY KEY,
+    entity text NOT NULL,
+    entity_id uuid NOT NULL,
+    deleted_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS tombstone_entity_seq_idx ON cinema.tombstone (entity, seq);
+
+
+CREATE OR REPLACE FUNCTION cinema.tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO cinema.tombstone (entity, entity_id) VALUES (TG_ARGV[0], OLD.id);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS person_tombstone ON cinema.person;
+CREATE TRIGGER person_tombstone BEFORE DELETE ON cinema.person
+    FOR EACH ROW EXECUTE PROCEDURE cinema.tombstone('person');
+
+DROP TRIGGER IF EXISTS genre_tombstone ON cinema.genre;
+CREATE TRIGGER genre_tombstone BEFORE DELETE ON cinema.genre
+    FOR EACH ROW EXECUTE PROCEDURE cinema.tombstone('genre');
@@ -0,0 +1,139 @@
+import time
+from typing import Optional, Tuple
+
+import psycopg2
+from psycopg2.extensions import AsIs, register_adapter
+from psycopg2.extensions import connection as pg_connection
+from utils.logger import logger
+
+# активные клиентские сессии и наибольшее отставание реплик; replay_lag виден ролям с pg_monitor
+SIGNALS_SQL = '''
+    SELECT
+        (
+            SELECT count(*)
+            FROM pg_stat_activity
+            WHERE state = 'active' AND backend_type = 'client backend' AND pid <> pg_backend_pid()
+        ),
+        (
+            SELECT COALESCE(extract(epoch from max(replay_lag)), 0)
+            FROM pg_stat_replication
+        )
+'''
+
+
+class PgGovernor:
+    """
+    Ограничитель нагрузки ETL на Postgres. Перед пачкой, не чаще раза в interval секунд,
+    замеряет время пробного запроса, активные сессии и отставание реплик. Пока сигнал
+    вне бюджета, ETL ждет с растущей паузой, а доля пачки от batch_size уменьшается вдвое.
+    Дольше max_wait секунд ETL не ждет и продолжает уменьшенными пачками под statement_timeout.
+    """
+
+    def __init__(
+        self,
+        dsl: dict,
+        interval: float,
+        max_latency: float,
+        max_active_sessions: int,
+        max_replica_lag: float,
+        max_pause: float,
+        max_wait: float = 300,
+    ):
+        self.dsl = dsl
+        self.interval = interval
+        self.max_latency = max_latency
+        self.max_active_sessions = max_active_sessions
+        self.max_replica_lag = max_replica_lag
+        self.max_pause = max_pause
+        self.max_wait = max_wait
+
+        self.scale = 1.0
+        self._sampled_at = 0.0
+        self._conn: Optional[pg_connection] = None
+
+    def sample(self) -> Tuple[float, int, float]:
+        """ Задержка пробного запроса (с), активные сессии и отставание реплик (с). """
+        if self._conn is None:
+            # пробный запрос дольше бюджета задержки сам по себе признак перегрузки
+            self._conn = psycopg2.connect(
+                **{**self.dsl, 'options': f'-c statement_timeout={max(int(self.max_latency * 10000), 100)}'}
+            )
+            self._conn.autocommit = True
+
+        started = time.monotonic()
+        with self._conn.cursor() as cur:
+            cur.execute(SIGNALS_SQL)
+            active_sessions, replica_lag = cur.fetchone()
+
+        return time.monotonic() - started, active_sessions, float(replica_lag)
+
+    def _over_budget(self) -> Optional[str]:
+        try:
+            latency, active_sessions, replica_lag = self.sample()
+        except psycopg2.Error as e:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            return f'probe failed: {e}'.strip()
+
+        if latency > self.max_latency:
+            return f'latency {latency:.3f} s'
+        if active_sessions > self.max_active_sessions:
+            return f'{active_sessions} active sessions'
+        if replica_lag > self.max_replica_lag:
+            return f'replica lag {replica_lag:.1f} s'
+        return None
+
+    def throttle(self):
+        """ Держит ETL, пока нагрузка на Postgres вне бюджета. """
+        if time.monotonic() - self._sampled_at < self.interval:
+            return
+
+        pause = self.interval
+        deadline = time.monotonic() + self.max_wait
+        while reason := self._over_budget():
+            self._decrease()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                logger.error(
+                    'postgres is over budget (%s) for %.0f s: continue with batch scale %.2f',
+                    reason, self.max_wait, self.scale
+                )
+                break
+            logger.warning('postgres is over budget (%s): pause %.1f s, batch scale %.2f', reason, pause, self.scale)
+            time.sleep(min(pause, left))
+            pause = min(pause * 2, self.max_pause)
+        else:
+            self.scale = min(self.scale + 0.1, 1.0)
+
+        self._sampled_at = time.monotonic()
+
+    def _decrease(self):
+        self.scale = max(self.scale / 2, 0.05)
+
+    def on_timeout(self):
+        """ Запрос ETL прерван statement_timeout или lock_timeout: пачка тяжела для текущей нагрузки. """
+        self._decrease()
+
+    def batch_size(self, limit: int) -> int:
+        return max(int(limit * self.scale), 1)
+
+
+class BatchLimit:
+    """
+    LIMIT пачки в параметрах запроса. Число пересчитывается ограничителем при каждом
+    выполнении, поэтому повтор запроса после таймаута идет уже с уменьшенной пачкой.
+    """
+
+    def __init__(self, limit: int, governor: Optional[PgGovernor] = None):
+        self.limit = limit
+        self.governor = governor
+
+    def __int__(self) -> int:
+        return self.governor.batch_size(self.limit) if self.governor else self.limit
+
+    def __repr__(self) -> str:
+        return f'BatchLimit({int(self)})'
+
+
+register_adapter(BatchLimit, lambda batch_limit: AsIs(int(batch_limit)))
@@ -18,12 +18,25 @@ log_config = {
             'maxBytes': 1048576,
             'backupCount': 0
         },
+        'slow_query_file': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'formatter': 'default',
+            'filename': 'slow_queries.log',
+            'maxBytes': 10485760,
+            'backupCount': 5
+        },
     },
     'loggers': {
         'default': {
             'level': 'DEBUG',
             'handlers': ['log_file', 'console'],
-        }
+        },
+        'slow_queries': {
+            'level': 'INFO',
+            'handlers': ['slow_query_file'],
+            'propagate': False,
+        },
     },
     'formatters': {
         'default': {
@@ -36,3 +49,4 @@ log_config = {
 
 logging.config.dictConfig(log_config)
 logger = logging.getLogger('default')
+slow_query_logger = logging.getLogger('slow_queries')
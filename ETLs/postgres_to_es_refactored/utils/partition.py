@@ -0,0 +1,42 @@
+import random
+import zlib
+from typing import Iterator, List
+
+from psycopg2.extensions import connection as pg_connection
+from utils.logger import logger
+
+
+class PartitionLock:
+    """
+    Распределяет хеш-партиции пространства id между репликами ETL через advisory-локи Postgres.
+    Локи сессионные: если реплика умерла, Postgres снимает их вместе с соединением.
+    """
+
+    def __init__(self, conn: pg_connection, name: str, partitions: int):
+        self.conn = conn
+        self.partitions = partitions
+        self.namespace = zlib.crc32(name.encode()) & 0x7fffffff
+        self.claimed: List[int] = []
+
+    def claim_each(self) -> Iterator[int]:
+        """
+        Захватывает свободные партиции по одной, начиная со случайной, и отпускает каждую
+        после обработки. Пока реплика обрабатывает партицию, другие разбирают следующие,
+        поэтому работа делится между всеми живыми репликами, а партиции упавшей
+        реплики в том же цикле достаются остальным.
+        """
+        start = random.randrange(self.partitions)
+        cur = self.conn.cursor()
+        for offset in range(self.partitions):
+            partition = (start + offset) % self.partitions
+            cur.execute('SELECT pg_try_advisory_lock(%s, %s)', (self.namespace, partition))
+            if not cur.fetchone()[0]:
+                continue
+
+            logger.info('claimed partition %s of %s', partition, self.partitions)
+            self.claimed.append(partition)
+            try:
+                yield partition
+            finally:
+                cur.execute('SELECT pg_advisory_unlock(%s, %s)', (self.namespace, partition))
+                self.claimed.remove(partition)
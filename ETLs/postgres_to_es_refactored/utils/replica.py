@@ -0,0 +1,30 @@
+import random
+from typing import List, Optional
+
+import psycopg2
+from psycopg2.extensions import connection as pg_connection
+
+# отставание реплики в секундах; если весь полученный WAL уже воспроизведен, реплика не отстает
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+
+def connect_replica(dsl: dict, hosts: List[str], **kwargs) -> Optional[pg_connection]:
+    """ Соединение с одной из реплик пула или None, если реплики не заданы. """
+    if not hosts:
+        return None
+
+    conn = psycopg2.connect(**{**dsl, 'host': random.choice(hosts)}, **kwargs)
+    # без долгих транзакций на реплике, чтобы не задерживать воспроизведение WAL
+    conn.autocommit = True
+    return conn
+
+
+def replica_lag(conn: pg_connection) -> float:
+    cur = conn.cursor()
+    cur.execute(REPLICA_LAG_SQL)
+    return float(cur.fetchone()[0] or 0)
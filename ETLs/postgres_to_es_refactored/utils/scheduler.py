@@ -0,0 +1,76 @@
+import random
+import time
+from typing import Any, Callable, List
+
+from utils.logger import logger
+
+
+class EntitySchedule:
+    """
+    Расписание ETL одной сущности.
+    Интервал уменьшается вдвое, если цикл выбрал полную пачку, и растет вдвое,
+    если изменений не было, оставаясь в пределах [min_interval, max_interval].
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[], int],
+        probe: Callable[[], Any],
+        batch_size: int,
+        min_interval: float,
+        max_interval: float,
+        jitter: float = 0.1,
+    ):
+        self.name = name
+        self.run = run
+        self.probe = probe
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+
+        self.interval = min_interval
+        self.next_run = 0.0
+        self.last_probe = None
+
+    def on_cycle(self, extracted: int):
+        if extracted >= self.batch_size:
+            self.interval = max(self.interval / 2, self.min_interval)
+        elif not extracted:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+        jitter = random.uniform(-self.jitter, self.jitter)
+        self.next_run = time.monotonic() + self.interval * (1 + jitter)
+
+
+class AdaptiveScheduler:
+    """ Запускает ETL сущностей по их расписаниям, пропуская циклы без изменений в данных. """
+
+    def __init__(self, schedules: List[EntitySchedule]):
+        self.schedules = schedules
+
+    def tick(self, schedule: EntitySchedule):
+        extracted = 0
+        try:
+            marker = schedule.probe()
+            if schedule.last_probe is not None and marker == schedule.last_probe:
+                logger.info('%s: no changes since %s, skip cycle', schedule.name, marker)
+            else:
+                extracted = schedule.run()
+                schedule.last_probe = marker
+
+        except Exception:
+            logger.exception('%s ETL cycle failed', schedule.name)
+
+        schedule.on_cycle(extracted)
+        logger.info('%s: extracted %s, next run in %.1f s', schedule.name, extracted, schedule.interval)
+
+    def run_forever(self):
+        while True:
+            schedule = min(self.schedules, key=lambda s: s.next_run)
+            delay = schedule.next_run - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.tick(schedule)
@@ -0,0 +1,58 @@
+import random
+import reprlib
+import time
+
+import psycopg2
+from utils.logger import logger, slow_query_logger
+
+
+def explain(cur, sql: str, params: tuple) -> str:
+    """
+    План запроса с фактическим временем выполнения и чтением буферов. Запрос повторяется
+    внутри точки сохранения: ошибка EXPLAIN (например, statement_timeout) откатывает
+    только ее, и транзакция ETL продолжается.
+    """
+    conn = cur.connection
+    in_transaction = not conn.autocommit
+
+    with conn.cursor() as explain_cur:
+        if in_transaction:
+            explain_cur.execute('SAVEPOINT slow_query_explain')
+        try:
+            explain_cur.execute(f'EXPLAIN (ANALYZE, BUFFERS) {sql}', params)
+            rows = explain_cur.fetchall()
+        finally:
+            if in_transaction:
+                explain_cur.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                explain_cur.execute('RELEASE SAVEPOINT slow_query_explain')
+
+    return '\n'.join(row[0] for row in rows)
+
+
+def execute(cur, sql: str, params: tuple, threshold: float, explain_rate: float):
+    """
+    Выполняет запрос и логирует его, если он дольше threshold секунд.
+    Для доли explain_rate медленных запросов план EXPLAIN (ANALYZE, BUFFERS)
+    сохраняется в ротируемый файл slow_queries.log.
+    """
+    started = time.monotonic()
+    cur.execute(sql, params)
+    duration = time.monotonic() - started
+
+    if duration < threshold:
+        return
+
+    # списков плейсхолдеров здесь нет: id передаются одним параметром IN %s
+    query = ' '.join(sql.split())
+    logger.warning('slow query %.3f s: %s params=%s', duration, query, reprlib.repr(params))
+
+    if random.random() >= explain_rate:
+        return
+
+    try:
+        plan = explain(cur, sql, params)
+    except psycopg2.Error as e:
+        logger.warning('can not explain slow query: %s', e)
+        return
+
+    slow_query_logger.info('%.3f s: %s\nparams=%s\n%s', duration, query, reprlib.repr(params), plan)
@@ -14,6 +14,10 @@ class BaseStorage:
     def retrieve_state(self) -> dict:
         pass
 
+    def save_key(self, state: dict, key: str) -> None:
+        """ Сохраняет изменившийся ключ состояния, по умолчанию - все состояние целиком. """
+        self.save_state(state)
+
 
 class JsonFileStorage(BaseStorage):
     def __init__(self, file_path: str):
@@ -32,6 +36,43 @@ class JsonFileStorage(BaseStorage):
             return {}
 
 
+class PostgresStorage(BaseStorage):
+    """ Общее для всех реплик ETL состояние в таблице Postgres. """
+
+    def __init__(self, conn, table: str = 'etl_state'):
+        self.conn = conn
+        self.conn.autocommit = True
+        self.table = table
+
+        with self.conn.cursor() as cur:
+            cur.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key text PRIMARY KEY,
+                    value text
+                )
+            ''')
+
+    def save_state(self, state: dict) -> None:
+        for key in state:
+            self.save_key(state, key)
+
+    def save_key(self, state: dict, key: str) -> None:
+        """ Только изменившийся ключ: остальные могли уйти вперед у других реплик. """
+        with self.conn.cursor() as cur:
+            cur.execute(
+                f'''
+                    INSERT INTO {self.table} (key, value) VALUES (%s, %s)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                ''',
+                (key, json.dumps(state[key], default=default_json_encoder))
+            )
+
+    def retrieve_state(self) -> dict:
+        with self.conn.cursor() as cur:
+            cur.execute(f'SELECT key, value FROM {self.table}')
+            return {row[0]: json.loads(row[1]) for row in cur.fetchall()}
+
+
 class State:
     def __init__(self, storage: BaseStorage):
         self.storage = storage
@@ -39,7 +80,11 @@ class State:
 
     def set_state(self, key: str, value: Any) -> None:
         self.state[key] = value
-        self.storage.save_state(self.state)
+        self.storage.save_key(self.state, key)
+
+    def refresh(self) -> None:
+        """ Перечитывает состояние из хранилища: его могли изменить другие реплики. """
+        self.state = self.storage.retrieve_state()
 
     def get_state(self, key: str, default: Any = None) -> Any:
         if key not in self.state:
@@ -1,6 +1,6 @@
 import datetime
 from functools import wraps
-from typing import Set
+from typing import List, Set
 
 
 def coroutine(func):
@@ -20,3 +20,9 @@ def default_json_encoder(o):
 
     if isinstance(o, Set):
         return list(o)
+
+
+def suggest_inputs(text: str, max_tails: int = 3) -> List[str]:
+    """ Варианты ввода для автодополнения: текст целиком и его хвосты со второго слова. """
+    words = text.split()
+    return [' '.join(words[i:]) for i in range(min(len(words), max_tails + 1))]